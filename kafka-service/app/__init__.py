@@ -1,3 +1,5 @@
+import os
+
 from flask import Flask
 from flask_cors import CORS
 
@@ -14,7 +16,26 @@ def create_app():
     CORS(app)  # Allow CORS for all domains on all api
     app.config.from_object('config.DevelopmentConfig')
 
-    from .routes import kafka_blueprint
+    from .routes import kafka_blueprint, kafka_handler
     app.register_blueprint(kafka_blueprint)
 
+    from .sockets import socketio, KafkaSocketIO
+    socketio.init_app(app, cors_allowed_origins='*')
+    socketio.on_namespace(KafkaSocketIO('/kafka', kafka_handler,
+                                        tick=float(os.environ.get('KAFKA_SOCKETIO_TICK', 0.2))))
+
     return app
+
+
+def create_asgi_app():
+    """
+    The create_asgi_app function wraps the creation of the asyncio serving mode of the api.
+    The streams and /latest are served by asyncio, the other routes by the Flask app of create_app,
+    and both share the same KafkaStreamHandler.
+
+    :return: The ASGI app object
+    """
+    from .asgi import KafkaASGI
+    from .routes import kafka_handler
+
+    return KafkaASGI(kafka_handler, wsgi_app=create_app())
@@ -0,0 +1,325 @@
+import asyncio
+import io
+import sys
+from urllib.parse import parse_qs
+
+from .broadcaster import OVERFLOW_POLICIES, available_encodings
+from .decimation import parse_decimation, parse_frequency
+from .snapshot import dumps
+
+"""
+This module provides KafkaASGI, the asyncio serving mode of the kafka-dispatcher.
+
+It serves the same KafkaStreamHandler as the Flask routes, without gevent:
+    GET <prefix>latest             the pre-encoded snapshot, with the same ETag, gzip, ?since= and ?store= handling
+    GET <prefix>latest/<device>    the latest message of a device
+    GET <prefix><device>           the SSE stream of a device, with the same frequency, decimate, encoding and
+                                   overflow options
+    GET <prefix>presence           the SSE stream of the online and offline transitions of the devices
+A stream is an async generator of the Broadcaster waiting on an asyncio.Event, so an idle client costs
+a coroutine and no thread. Every other route is handed to the Flask app in the executor, as plain WSGI.
+The consumer keeps running in the threads of the handler, the event loop never calls Kafka.
+Socket.IO needs the gevent deployment and is not served here.
+
+"""
+
+STREAM_HEADERS = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache')]
+
+
+class KafkaASGI:
+    """
+    KafkaASGI is an ASGI application serving a KafkaStreamHandler, see create_asgi_app.
+    """
+
+    def __init__(self, handler, wsgi_app=None, executor=None, prefix='/api/v1/kafka-stream/'):
+        """
+        Instantiated the class.
+
+        :param handler: The KafkaStreamHandler to serve
+        :param wsgi_app: The Flask app serving the other routes, they answer 404 without it
+        :param executor: The concurrent.futures executor running the blocking calls, the default one of the loop if None
+        :param prefix: The URL prefix of the routes
+        """
+        self.handler = handler
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.prefix = prefix
+        self.static = set()  # the one-segment routes of the Flask app, which are not device streams
+        if wsgi_app is not None:
+            for rule in wsgi_app.url_map.iter_rules():
+                name = rule.rule[len(prefix):]
+                if rule.rule.startswith(prefix) and '/' not in name and '<' not in name:
+                    self.static.add(name)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        path = scope['path']
+        name = path[len(self.prefix):] if path.startswith(self.prefix) else None
+        if scope['method'] == 'GET' and name is not None:
+            if name == 'latest':
+                await self.latest(scope, send)
+                return
+            if name == 'presence':
+                await self.presence(scope, receive, send)
+                return
+            if name.startswith('latest/') and '/' not in name[7:]:
+                await self.latest_device(name[7:], send)
+                return
+            if name and '/' not in name and name not in self.static:
+                await self.stream(name, scope, receive, send)
+                return
+        if self.wsgi_app is None or path.startswith('/socket.io'):
+            await respond(send, 404, {'status': 'Not found'})
+            return
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.handler.broadcaster.close()  # ends the streams
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def latest(self, scope, send):
+        """The asyncio twin of routes.get_latest_data_all."""
+        handler = self.handler
+        if not handler.running:
+            await respond(send, 200, {'status': 'No stream running'})
+            return
+        args = query_args(scope)
+        store = args.get('store')
+        if store is not None:
+            if store not in handler.stores:
+                await respond(send, 404, {'status': 'Unknown store'})
+                return
+            await respond(send, 200, await self.run(lambda: dumps(handler.stores[store].snapshot())))
+            return
+        since = _int(args.get('since'))
+        if since is not None:
+            await respond(send, 200, dumps(handler.get_latest_data_since(since)))
+            return
+
+        gzip = 'gzip' in header(scope, b'accept-encoding')
+        snapshot, gzipped = await self.run(self._snapshot, gzip)
+        etag = f'"{snapshot.etag}-gzip"' if gzipped is not None else f'"{snapshot.etag}"'
+        headers = [(b'etag', etag.encode('ascii')), (b'vary', b'Accept-Encoding'),
+                   (b'x-latest-version', str(snapshot.version).encode('ascii'))]
+        if gzipped is not None:
+            headers.append((b'content-encoding', b'gzip'))
+        if etag in header(scope, b'if-none-match') or header(scope, b'if-none-match') == '*':
+            await respond(send, 304, b'', headers=headers)
+            return
+        await respond(send, 200, gzipped if gzipped is not None else snapshot.body, headers=headers)
+
+    def _snapshot(self, gzip):
+        """Return the snapshot and its gzip variant, both may have to be built. Runs in the executor."""
+        snapshot = self.handler.snapshot.get()
+        return snapshot, snapshot.gzipped if gzip else None
+
+    async def latest_device(self, device_name, send):
+        """The asyncio twin of routes.get_latest_data."""
+        if not self.handler.running:
+            await respond(send, 200, {'status': 'No stream running'})
+            return
+        message = self.handler.get_latest_data_for_single(device_name)
+        if message is None:
+            await respond(send, 404, {'status': 'Device not ready'})
+            return
+        await respond(send, 200, message)
+
+    async def stream(self, device_name, scope, receive, send):
+        """The asyncio twin of routes.subscribe_to_device, the stream ends when the client disconnects."""
+        handler = self.handler
+        args = query_args(scope)
+        frequency = args.get('frequency')
+        encoding = args.get('encoding', 'json')
+        overflow = args.get('overflow')
+        decimation = args.get('decimate')
+        if not handler.running:
+            await respond(send, 200, {'status': 'No stream running'})
+            return
+        if encoding not in available_encodings():
+            await respond(send, 400, {'status': f"Unsupported encoding, use one of {', '.join(available_encodings())}"})
+            return
+        if overflow is not None and overflow not in OVERFLOW_POLICIES:
+            await respond(send, 400,
+                          {'status': f"Unsupported overflow policy, use one of {', '.join(OVERFLOW_POLICIES)}"})
+            return
+        try:
+            frequency = parse_frequency(frequency)
+        except ValueError as e:
+            await respond(send, 400, {'status': str(e)})
+            return
+        if decimation is not None:
+            if frequency:
+                await respond(send, 400, {'status': "Use either frequency or decimate"})
+                return
+            try:
+                parse_decimation(decimation)
+            except ValueError as e:
+                await respond(send, 400, {'status': str(e)})
+                return
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': STREAM_HEADERS})
+        if device_name not in handler.data:
+            print("Error: device name not found")
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await send_frames(handler.broadcaster.subscribe_async(device_name, handler.data.get(device_name), frequency,
+                                                              encoding, overflow, decimation), receive, send)
+
+    async def presence(self, scope, receive, send):
+        """The asyncio twin of routes.subscribe_to_presence."""
+        encoding = query_args(scope).get('encoding', 'json')
+        if not self.handler.running:
+            await respond(send, 200, {'status': 'No stream running'})
+            return
+        if encoding not in available_encodings():
+            await respond(send, 400, {'status': f"Unsupported encoding, use one of {', '.join(available_encodings())}"})
+            return
+        await send({'type': 'http.response.start', 'status': 200, 'headers': STREAM_HEADERS})
+        await send_frames(self.handler.presence.subscribe_async(encoding), receive, send)
+
+    async def call_wsgi(self, scope, receive, send):
+        """Hand a request to the Flask app in the executor, its response is buffered."""
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        status, headers, content = await self.run(self._run_wsgi, wsgi_environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    def _run_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return chunks.append
+
+        chunks = []
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], b''.join(chunks)
+
+    def run(self, func, *args):
+        """Run a blocking call in the executor."""
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+
+async def send_frames(frames, receive, send):
+    """
+    The send_frames function sends the SSE frames of an async generator as the body of a started response,
+    until the generator ends or the client disconnects.
+
+    :param frames: An async generator of SSE frames, like Broadcaster.subscribe_async
+    :param receive: The ASGI receive callable, watched for the disconnection of the client
+    :param send: The ASGI send callable
+    """
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(_cancel_on_disconnect(receive, asyncio.current_task(), disconnected))
+    try:
+        async for frame in frames:
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except asyncio.CancelledError:
+        if not disconnected.is_set():
+            raise
+    except OSError:
+        pass  # the client went away while a frame was sent
+    finally:
+        watcher.cancel()
+        await frames.aclose()
+
+
+async def _cancel_on_disconnect(receive, task, disconnected):
+    """Cancel the task serving a stream once its client disconnects."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+    task.cancel()
+
+
+async def respond(send, status, body, content_type=b'application/json', headers=()):
+    """
+    The respond function sends a whole response.
+
+    :param send: The ASGI send callable
+    :param status: The HTTP status code
+    :param body: The body in bytes, or an object sent as JSON
+    :param content_type: The content type of the body
+    :param headers: Other headers, as a list of (name, value) in bytes
+    """
+    if not isinstance(body, (bytes, bytearray)):
+        body = dumps(body)
+    headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode('ascii')), *headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def query_args(scope):
+    """Return the first value of every query argument."""
+    return {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+
+def header(scope, name):
+    """Return the value of a request header, an empty string if it is missing."""
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def wsgi_environ(scope, body):
+    """Build the WSGI environ of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
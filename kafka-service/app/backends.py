@@ -0,0 +1,33 @@
+from .latest_store import LatestStore
+from .redis_store import open_redis_store
+from .shared_store import open_shared_store
+
+"""
+This module provides open_latest_store, which opens the backend holding the latest state of the kafka-dispatcher:
+    memory   a LatestStore in the process, the default, for a single gunicorn worker
+    shared   a file mapped in memory by every worker of the host, see shared_store
+    redis    keys in a Redis server, readable by other services too, see redis_store
+With shared and redis, one process writes the backend and the others follow it with a LatestView.
+
+"""
+
+BACKENDS = ('memory', 'shared', 'redis')
+
+
+def open_latest_store(backend='memory', shards=16, tolerance=None, **options):
+    """
+    The open_latest_store function opens the latest store of a backend.
+
+    :param backend: One of BACKENDS
+    :param shards: Number of independently locked shards
+    :param tolerance: Allowed out-of-order delay in nanoseconds, see LatestStore
+    :param options: The keyword arguments of open_shared_store or open_redis_store
+    :return: A LatestStore, read_only when another process writes the backend
+    """
+    if backend == 'memory':
+        return LatestStore(shards, tolerance=tolerance)
+    if backend == 'shared':
+        return open_shared_store(shards=shards, tolerance=tolerance, **options)
+    if backend == 'redis':
+        return open_redis_store(shards=shards, tolerance=tolerance, **options)
+    raise ValueError(f"Unsupported latest store backend {backend}, use one of {', '.join(BACKENDS)}")
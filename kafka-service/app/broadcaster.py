@@ -0,0 +1,545 @@
+import asyncio
+import base64
+import threading
+from collections import deque
+from time import monotonic, sleep, time
+
+from .decimation import make_decimator, parse_decimation, parse_frequency
+from .snapshot import dumps
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is listed in requirements.txt
+    msgpack = None
+
+"""
+This module provides the Broadcaster class, which fans the latest device data out to stream subscribers.
+
+Subscribers block on a per-device condition instead of polling.
+Asyncio subscribers await an event instead, set from the event loop once per publish and per loop.
+Every update is encoded at most once per wire encoding, lazily, and the frame is shared by all
+the subscribers using that encoding.
+Subscribers asking for a sampling frequency or a decimation share one decimation group per (device, spec),
+see decimation.py: the updates of the device are fed to the Decimator of the group as they are published,
+and the strategies working on time buckets are flushed by a ticker aligned on wall-clock multiples of the bucket.
+A frequency is the decimation last:<frequency>.
+
+Each subscriber has a bounded queue of pending updates, and an overflow policy applied when it is full:
+    coalesce     only the newest update is kept, the client always gets the latest value
+    drop-oldest  the oldest pending update is dropped to make room
+    disconnect   the stream ends, the client is expected to reconnect
+Subscribers that stop reading while updates are pending for `slow_timeout` seconds are evicted,
+and streams that did not deliver an update for `idle_timeout` seconds are ended.
+
+Wire encodings, chosen per subscription:
+    json     data: <compact JSON of the message>
+    msgpack  data: <base64 of the MessagePack encoded message>
+    delta    event: full, with the compact JSON of the message, first, and whenever frames were skipped,
+             then event: delta, with the top level keys and the `values` fields that changed
+
+"""
+
+ENCODINGS = ('json', 'msgpack', 'delta')
+OVERFLOW_POLICIES = ('coalesce', 'drop-oldest', 'disconnect')
+KEEP_ALIVE = ": keep-alive\n\n"
+
+
+class _Update:
+    """A published message, with its frames encoded on first use."""
+
+    __slots__ = ('seq', 'message', 'previous', 'frames', 'published')
+
+    def __init__(self, seq, message, previous=None):
+        self.seq = seq
+        self.message = message
+        self.previous = previous  # the message published before it, the base of delta frames
+        self.frames = {}  # {frame kind: frame}
+        self.published = monotonic()
+
+    def frame(self, encoding, last_seen):
+        """Return the frame for a subscriber that last received seq `last_seen`. Needs the condition of the feed."""
+        kind = encoding
+        if encoding == 'delta':
+            kind = 'delta' if last_seen == self.seq - 1 and self.previous is not None else 'full'
+        frame = self.frames.get(kind)
+        if frame is None:
+            frame = _ENCODERS[kind](self.message, self.previous)
+            if frame is None:  # the change cannot be expressed as a delta
+                frame = self.frames.get('full') or encode_full(self.message)
+                self.frames['full'] = frame
+            self.frames[kind] = frame
+        return frame
+
+
+class _Subscriber:
+    """The pending updates of one stream client."""
+
+    __slots__ = ('queue', 'overflow', 'closed', 'last_pull', 'last_seen', 'last_update', 'event', 'loop')
+
+    def __init__(self, queue_size, overflow):
+        self.queue = deque(maxlen=1 if overflow == 'coalesce' else queue_size)
+        self.overflow = overflow
+        self.closed = None  # the reason the stream was ended by the broadcaster
+        self.last_pull = monotonic()  # when the generator of the client last ran
+        self.last_seen = 0  # the seq of the last update sent to the client
+        self.last_update = monotonic()  # when the last update was sent to the client
+        self.event = None  # for an asyncio subscriber, the asyncio.Event set when it has something to do
+        self.loop = None  # and the event loop it runs in
+
+    def wake(self):
+        """Wake an asyncio subscriber from any thread."""
+        if self.loop is not None:
+            _call_soon(self.loop, self.event.set)
+
+
+class _Channel:
+    """
+    A feed of messages: the subscribers of a device or of a decimation group, and the last update published to them.
+    """
+
+    __slots__ = ('name', 'condition', 'latest', 'seq', 'members', 'subscribers', 'loops', 'groups', 'decimator')
+
+    def __init__(self, name, message=None):
+        self.name = name  # the device_name
+        self.condition = threading.Condition(threading.Lock())
+        self.latest = None  # the latest _Update
+        self.seq = 0  # incremented on every publish, never wraps
+        self.members = set()  # the _Subscriber reading this feed
+        self.subscribers = 0  # the generators attached to this feed, evicted or not
+        self.loops = {}  # {event loop: number of asyncio members running in it}
+        self.groups = ()  # for a device, the decimation groups fed by its updates
+        self.decimator = None  # for a decimation group, its Decimator
+        if message is not None:
+            self.seq = 1
+            self.latest = _Update(1, message)
+
+    def publish(self, message, broadcaster):
+        with self.condition:
+            self.seq += 1
+            self.latest = update = _Update(self.seq, message, self.latest.message if self.latest else None)
+            now = update.published
+            for subscriber in list(self.members):
+                queue = subscriber.queue
+                if queue and now - subscriber.last_pull > broadcaster.slow_timeout:
+                    broadcaster._evict(self, subscriber, 'slow')
+                elif len(queue) == queue.maxlen:
+                    if subscriber.overflow == 'disconnect':
+                        broadcaster._evict(self, subscriber, 'overflow')
+                        continue
+                    broadcaster.dropped += 1
+                    queue.append(update)
+                else:
+                    queue.append(update)
+            self.condition.notify_all()
+            for loop in self.loops:
+                _call_soon(loop, self.wake, loop)
+            self._feed(message, broadcaster)
+
+    def feed(self, message, broadcaster):
+        """Hand an update of a device to its decimation groups only."""
+        with self.condition:
+            self._feed(message, broadcaster)
+
+    def _feed(self, message, broadcaster):
+        for group in self.groups:
+            decimated = group.decimator.feed(message)
+            if decimated is not None:
+                group.publish(decimated, broadcaster)
+
+    def wake(self, loop):
+        """Set the events of the asyncio members of the feed running in loop. Runs in loop."""
+        with self.condition:
+            members = [subscriber for subscriber in self.members if subscriber.loop is loop]
+        for subscriber in members:
+            subscriber.event.set()
+
+
+class Broadcaster:
+    """
+    Broadcaster is a publish/subscribe hub keyed by device_name.
+    The ingestion path calls `publish`, and every stream client iterates over `subscribe`.
+    """
+
+    def __init__(self, heartbeat=15, queue_size=16, overflow='coalesce', slow_timeout=30, idle_timeout=0,
+                 on_emit=None):
+        """
+        Instantiated the class.
+
+        :param heartbeat: Seconds without updates after which an SSE comment is sent to keep the connection alive
+        :param queue_size: Maximum number of updates pending per subscriber
+        :param overflow: What to do when the queue of a subscriber is full, one of OVERFLOW_POLICIES
+        :param slow_timeout: Seconds a subscriber may leave updates pending before it is evicted
+        :param idle_timeout: Seconds without any update after which a stream is ended, 0 never ends it
+        :param on_emit: Called as on_emit(device_name, seconds) with the time from the publish of an update
+            to its frame, for every frame handed to a client but the first one
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unsupported overflow policy {overflow}, use one of {OVERFLOW_POLICIES}")
+        self.heartbeat = heartbeat
+        self.queue_size = max(1, queue_size)
+        self.overflow = overflow
+        self.slow_timeout = slow_timeout
+        self.idle_timeout = idle_timeout
+        self.on_emit = on_emit
+        self.running = True
+        self.dropped = 0  # updates dropped from the queue of a subscriber
+        self.evicted = {'overflow': 0, 'slow': 0, 'idle': 0}  # streams ended by the broadcaster, by reason
+        self._lock = threading.Lock()
+        self._channels = {}  # {device_name: _Channel}
+        self._groups = {}  # {(device_name, decimation spec): _Channel of the decimation group}
+
+    def publish(self, device_name, msg_json):
+        """
+        The publish function hands an update to the subscribers of the device and wakes them.
+        It is a dictionary lookup and nothing else when the device has no subscribers.
+        The frames are encoded by the first subscriber needing them, once per encoding.
+
+        :param device_name: The device the update belongs to
+        :param msg_json: The latest message of the device
+        """
+        channel = self._channels.get(device_name)
+        if channel is None:
+            return
+        channel.publish(msg_json, self)
+
+    def feed(self, device_name, msg_json):
+        """
+        The feed function hands an update to the decimation groups of the device, and not to its plain subscribers.
+        The batched consumer calls it with the messages superseded by a newer one of the same batch,
+        so the decimations see every message while the plain streams get the newest one.
+
+        :param device_name: The device the update belongs to
+        :param msg_json: A message of the device, older than the next one published
+        """
+        channel = self._channels.get(device_name)
+        if channel is None or not channel.groups:
+            return
+        channel.feed(msg_json, self)
+
+    def subscribe(self, device_name, initial=None, frequency=0, encoding='json', overflow=None, decimation=None):
+        """
+        The subscribe function is a generator of SSE frames for a single device.
+        It yields the current frame first, then blocks until the next publish.
+        Updates published while the client is busy wait in its queue, subject to the overflow policy.
+        With a frequency, the client is served by the shared ticker of (device_name, frequency),
+        which forwards the newest message at every wall-clock multiple of the frequency, if it changed.
+        With a decimation, the client is served by the shared decimation group of (device_name, decimation).
+        The generator returns when the broadcaster evicts the client.
+
+        :param device_name: The device to subscribe to
+        :param initial: The current message of the device, sent as the first frame
+        :param frequency: Seconds between two frames, 0 streams every update
+        :param encoding: The wire encoding of the frames, one of ENCODINGS
+        :param overflow: The overflow policy of this client, defaults to the one of the broadcaster
+        :param decimation: A decimation spec, see decimation.parse_decimation, instead of a frequency
+        :return: A generator of SSE frames
+        """
+        spec, channel, group, feed, subscriber = self._open(device_name, initial, frequency, encoding, overflow,
+                                                            decimation)
+        try:
+            frame = self._first_frame(feed, subscriber, encoding)
+            if frame is not None:
+                yield frame
+            while self.running:
+                with feed.condition:
+                    subscriber.last_pull = monotonic()
+                    if not subscriber.queue and subscriber.closed is None:
+                        feed.condition.wait(self.heartbeat)
+                        subscriber.last_pull = monotonic()
+                    frame = self._next_frame(feed, subscriber, encoding)
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self._close(device_name, spec, channel, group, feed, subscriber)
+
+    async def subscribe_async(self, device_name, initial=None, frequency=0, encoding='json', overflow=None,
+                              decimation=None):
+        """
+        The subscribe_async function is the asyncio variant of subscribe, an async generator of SSE frames.
+        It awaits an event set from the event loop instead of blocking a thread, so it must run in an event loop,
+        and any number of subscribers can wait in the same loop. The frames are the same as with subscribe.
+
+        :param device_name: The device to subscribe to
+        :param initial: The current message of the device, sent as the first frame
+        :param frequency: Seconds between two frames, 0 streams every update
+        :param encoding: The wire encoding of the frames, one of ENCODINGS
+        :param overflow: The overflow policy of this client, defaults to the one of the broadcaster
+        :param decimation: A decimation spec, see decimation.parse_decimation, instead of a frequency
+        :return: An async generator of SSE frames
+        """
+        loop = asyncio.get_running_loop()
+        spec, channel, group, feed, subscriber = self._open(device_name, initial, frequency, encoding, overflow,
+                                                            decimation, loop)
+        try:
+            frame = self._first_frame(feed, subscriber, encoding)
+            if frame is not None:
+                yield frame
+            while self.running:
+                with feed.condition:
+                    subscriber.last_pull = monotonic()
+                    waiting = not subscriber.queue and subscriber.closed is None
+                    if waiting:
+                        subscriber.event.clear()
+                if waiting:
+                    heartbeat = loop.call_later(self.heartbeat, subscriber.event.set)  # cheaper than wait_for
+                    try:
+                        await subscriber.event.wait()
+                    finally:
+                        heartbeat.cancel()
+                with feed.condition:
+                    subscriber.last_pull = monotonic()
+                    frame = self._next_frame(feed, subscriber, encoding)
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self._close(device_name, spec, channel, group, feed, subscriber)
+
+    def _open(self, device_name, initial, frequency, encoding, overflow, decimation, loop=None):
+        """Check the options of a subscription and add its subscriber to the feed it reads."""
+        if encoding not in available_encodings():
+            raise ValueError(f"Unsupported encoding {encoding}, use one of {available_encodings()}")
+        overflow = overflow or self.overflow
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unsupported overflow policy {overflow}, use one of {OVERFLOW_POLICIES}")
+        frequency = parse_frequency(frequency)
+        if decimation and frequency:
+            raise ValueError("Use either a frequency or a decimation")
+        spec = parse_decimation(decimation) if decimation else ('last', frequency) if frequency else None
+        channel = self._attach(device_name, initial)
+        group = self._attach_group(device_name, spec, channel) if spec else None
+        feed = group or channel
+        subscriber = _Subscriber(self.queue_size, overflow)
+        with feed.condition:
+            if loop is not None:
+                subscriber.event = asyncio.Event()
+                subscriber.loop = loop
+                feed.loops[loop] = feed.loops.get(loop, 0) + 1
+            feed.members.add(subscriber)
+        return spec, channel, group, feed, subscriber
+
+    def _first_frame(self, feed, subscriber, encoding):
+        """Return the frame of the current message of the feed, None if there is none yet."""
+        with feed.condition:
+            update = feed.latest
+            if update is None:
+                return None
+            while subscriber.queue and subscriber.queue[0].seq <= update.seq:
+                subscriber.queue.popleft()  # published since the subscriber joined, and sent now
+            subscriber.last_seen = update.seq
+            return update.frame(encoding, None)
+
+    def _next_frame(self, feed, subscriber, encoding):
+        """
+        Return the next frame of a subscriber once its wait is over: the oldest pending update,
+        or a keep-alive comment. None ends the stream. Runs with the condition of feed held.
+        """
+        if not self.running or subscriber.closed is not None:
+            return None
+        if subscriber.queue:
+            update = subscriber.queue.popleft()
+            frame = update.frame(encoding, subscriber.last_seen)
+            subscriber.last_seen = update.seq
+            subscriber.last_update = now = monotonic()
+            if self.on_emit is not None:
+                self.on_emit(feed.name, now - update.published)
+            return frame
+        if self.idle_timeout and monotonic() - subscriber.last_update > self.idle_timeout:
+            self._evict(feed, subscriber, 'idle')
+            return None
+        return KEEP_ALIVE
+
+    def _close(self, device_name, spec, channel, group, feed, subscriber):
+        with feed.condition:
+            feed.members.discard(subscriber)
+            if subscriber.loop is not None:
+                count = feed.loops.pop(subscriber.loop) - 1
+                if count:
+                    feed.loops[subscriber.loop] = count
+        if group is not None:
+            self._detach_group(device_name, spec, channel, group)
+        self._detach(device_name, channel)
+
+    def ticker_count(self):
+        """
+        The ticker_count function returns the number of running decimation tickers.
+
+        :return: The number of (device, spec) groups decimating on time buckets
+        """
+        return sum(1 for group in list(self._groups.values()) if group.decimator.interval)
+
+    def group_count(self):
+        """
+        The group_count function returns the number of decimation groups.
+
+        :return: The number of (device, spec) groups
+        """
+        return len(self._groups)
+
+    def subscriber_count(self, device_name=None):
+        """
+        The subscriber_count function returns the number of active stream subscribers.
+        Evicted clients whose connection is still being torn down are not counted.
+
+        :param device_name: Count only the subscribers of this device
+        :return: The number of subscribers
+        """
+        feeds = list(self._channels.items()) + [(key[0], group) for key, group in list(self._groups.items())]
+        return sum(len(feed.members) for name, feed in feeds if device_name is None or name == device_name)
+
+    def close(self):
+        """
+        The close function wakes every subscriber so their generators return.
+        """
+        self.running = False
+        for channel in list(self._channels.values()) + list(self._groups.values()):
+            with channel.condition:
+                channel.condition.notify_all()
+                for loop in channel.loops:
+                    _call_soon(loop, channel.wake, loop)
+
+    def _evict(self, feed, subscriber, reason):
+        """End the stream of a subscriber and drop its pending updates. Runs with the condition of feed held."""
+        subscriber.closed = reason
+        subscriber.queue.clear()
+        feed.members.discard(subscriber)
+        self.evicted[reason] += 1
+        feed.condition.notify_all()
+        subscriber.wake()
+
+    def _attach(self, device_name, initial=None):
+        with self._lock:
+            channel = self._channels.get(device_name)
+            if channel is None:
+                channel = self._channels[device_name] = _Channel(device_name)
+            with channel.condition:
+                if channel.latest is None and initial is not None:
+                    channel.seq += 1
+                    channel.latest = _Update(channel.seq, initial)
+            channel.subscribers += 1
+            return channel
+
+    def _detach(self, device_name, channel):
+        with self._lock:
+            channel.subscribers -= 1
+            if channel.subscribers <= 0 and self._channels.get(device_name) is channel:
+                del self._channels[device_name]
+
+    def _attach_group(self, device_name, spec, channel):
+        with self._lock:
+            group = self._groups.get((device_name, spec))
+            if group is None:
+                decimator = make_decimator(spec)
+                with channel.condition:
+                    group = _Channel(device_name, channel.latest.message if channel.latest else None)
+                    group.decimator = decimator
+                    if channel.latest is not None:
+                        decimator.start(channel.latest.message)
+                    channel.groups += (group,)
+                self._groups[(device_name, spec)] = group
+                if decimator.interval:
+                    ticker = threading.Thread(target=self._tick, args=(device_name, spec, group), daemon=True)
+                    ticker.start()
+            group.subscribers += 1
+            return group
+
+    def _detach_group(self, device_name, spec, channel, group):
+        with self._lock:
+            group.subscribers -= 1
+            if group.subscribers <= 0 and self._groups.get((device_name, spec)) is group:
+                del self._groups[(device_name, spec)]
+                with channel.condition:
+                    channel.groups = tuple(fed for fed in channel.groups if fed is not group)
+
+    def _tick(self, device_name, spec, group):
+        """The ticker of a decimation group working on time buckets, it exits once the group has no subscriber left."""
+        interval = group.decimator.interval
+        while self.running:
+            sleep(interval - time() % interval)
+            if self._groups.get((device_name, spec)) is not group:
+                return
+            message = group.decimator.flush()
+            if message is not None:
+                group.publish(message, self)
+
+
+def _call_soon(loop, callback, *args):
+    """Schedule callback in an event loop from any thread, unless the loop was closed in the meantime."""
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass
+
+
+def available_encodings():
+    """
+    The available_encodings function returns the wire encodings usable with the installed packages.
+
+    :return: A tuple of encoding names
+    """
+    if msgpack is None:
+        return tuple(encoding for encoding in ENCODINGS if encoding != 'msgpack')
+    return ENCODINGS
+
+
+def encode_json(msg_json, previous=None):
+    """
+    The encode_json function turns a message into an SSE frame holding compact JSON.
+
+    :param msg_json: The message to send
+    :param previous: Unused, the encoders all take the previously published message
+    :return: The SSE frame
+    """
+    return f"data: {dumps(msg_json).decode('utf-8')}\n\n"
+
+
+def encode_msgpack(msg_json, previous=None):
+    """
+    The encode_msgpack function turns a message into an SSE frame holding base64 encoded MessagePack.
+
+    :param msg_json: The message to send
+    :param previous: Unused, the encoders all take the previously published message
+    :return: The SSE frame
+    """
+    return f"data: {base64.b64encode(msgpack.packb(msg_json)).decode('ascii')}\n\n"
+
+
+def encode_full(msg_json, previous=None):
+    """
+    The encode_full function turns a message into the `full` event of the delta encoding.
+
+    :param msg_json: The message to send
+    :param previous: Unused, the encoders all take the previously published message
+    :return: The SSE frame
+    """
+    return f"event: full\ndata: {dumps(msg_json).decode('utf-8')}\n\n"
+
+
+def encode_delta(msg_json, previous):
+    """
+    The encode_delta function turns the changes between two messages into the `delta` event of the delta encoding.
+    It holds the top level keys whose value changed, and the `values` fields that changed.
+    A client applies it by updating its last message with the top level keys, then its values with `values`.
+
+    :param msg_json: The message to send
+    :param previous: The message the client received last
+    :return: The SSE frame, or None when keys were removed and a full frame has to be sent
+    """
+    values = msg_json.get('values')
+    previous_values = previous.get('values')
+    if type(values) is not dict or type(previous_values) is not dict \
+            or not values.keys() >= previous_values.keys() or not msg_json.keys() >= previous.keys():
+        return None
+    delta = {key: value for key, value in msg_json.items() if key != 'values' and previous.get(key) != value}
+    delta['values'] = {key: value for key, value in values.items()
+                       if key not in previous_values or previous_values[key] != value}
+    return f"event: delta\ndata: {dumps(delta).decode('utf-8')}\n\n"
+
+
+_ENCODERS = {
+    'json': encode_json,
+    'msgpack': encode_msgpack,
+    'full': encode_full,
+    'delta': encode_delta,
+}
@@ -0,0 +1,107 @@
+import os
+import threading
+from collections import deque
+from time import time
+
+from .snapshot import dumps
+
+"""
+This module provides the DeadLetterBuffer class, which quarantines the messages the dispatcher cannot process.
+
+A bad message is recorded and skipped, the consumer keeps going.
+The last `capacity` records are kept in memory, and each record can also be appended to a local JSONL file,
+rotated once it exceeds `spill_bytes`, keeping one previous file.
+
+"""
+
+
+class DeadLetterBuffer:
+    """
+    DeadLetterBuffer is a bounded record of the messages that failed to decode or process.
+    """
+
+    def __init__(self, capacity=1000, spill_path='', spill_bytes=64 * 1024 * 1024, max_value=4096):
+        """
+        Instantiated the class.
+
+        :param capacity: Number of records kept in memory, the oldest ones are dropped first
+        :param spill_path: JSONL file every record is appended to, an empty path disables the spill
+        :param spill_bytes: Size after which the spill file is rotated to `spill_path`.1
+        :param max_value: Number of characters of the message value kept in a record
+        """
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.spill_bytes = spill_bytes
+        self.max_value = max_value
+        self.total = 0
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max(1, capacity))
+        self._spill = None
+
+    def add(self, topic, value, error, partition=None, offset=None):
+        """
+        The add function quarantines a message.
+
+        :param topic: The topic of the message
+        :param value: The message value, bytes or an already decoded object
+        :param error: The exception raised while handling the message
+        :param partition: The partition of the message, when known
+        :param offset: The offset of the message, when known
+        :return: The record
+        """
+        if isinstance(value, (bytes, bytearray)):
+            value = bytes(value[:self.max_value]).decode('utf-8', errors='replace')
+        elif not isinstance(value, str):
+            try:
+                value = dumps(value).decode('utf-8')
+            except (TypeError, ValueError):
+                value = repr(value)
+        record = {
+            'time': time(),
+            'topic': topic,
+            'partition': partition,
+            'offset': offset,
+            'error': type(error).__name__,
+            'message': str(error)[:512],
+            'value': value[:self.max_value],
+        }
+        with self._lock:
+            self.total += 1
+            self._records.append(record)
+            if self.spill_path:
+                self._write(record)
+        return record
+
+    def records(self, limit=None):
+        """
+        The records function returns the quarantined records, the most recent last.
+
+        :param limit: Only return the last `limit` records
+        :return: A list of records
+        """
+        with self._lock:
+            records = list(self._records)
+        return records[-limit:] if limit else records
+
+    def close(self):
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def _write(self, record):
+        """Append a record to the spill file. Runs with self._lock held."""
+        try:
+            if self._spill is None:
+                self._spill = open(self.spill_path, 'ab')
+            self._spill.write(dumps(record) + b'\n')
+            self._spill.flush()
+            if self._spill.tell() > self.spill_bytes:
+                self._spill.close()
+                self._spill = None
+                os.replace(self.spill_path, self.spill_path + '.1')
+        except OSError as e:
+            print(f"Error writing the dead letter file: {e}")
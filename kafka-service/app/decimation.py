@@ -0,0 +1,228 @@
+import math
+import threading
+
+from .timestamps import parse_duration
+
+"""
+This module provides the decimation strategies of the live streams, which thin out the updates of a device
+before they reach the stream clients.
+
+A strategy is chosen per subscription with a spec, `<strategy>:<parameter>`:
+    nth:<n>                 every n-th update
+    last:<duration>         the last update of every time bucket, like the frequency option
+    envelope:<duration>     per time bucket, the mean of every numeric field in `values`,
+                            with their `min` and `max` and the number of `samples`, so short peaks still show
+    deadband:<threshold>    an update only when a numeric field moved by more than threshold since the last update
+                            sent, or any other field changed
+Durations are like 500ms, 1s or 1m, time buckets are aligned on wall-clock multiples of the duration.
+A frequency, in seconds, is the spec last:<frequency>. Durations and frequencies shorter than MIN_INTERVAL
+are refused, the ticker of the bucket would spin.
+The Broadcaster runs one Decimator per (device, spec), shared by all the clients using the same spec.
+
+"""
+
+STRATEGIES = ('nth', 'last', 'envelope', 'deadband')
+MIN_INTERVAL = 0.01  # seconds, the shortest time bucket
+
+
+def parse_decimation(text):
+    """
+    The parse_decimation function reads a decimation spec.
+
+    :param text: A spec like nth:10, last:1s, envelope:500ms or deadband:0.5
+    :return: The normalized spec, a tuple of (strategy, parameter)
+    """
+    strategy, _, parameter = str(text).partition(':')
+    strategy = strategy.strip()
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unsupported decimation {text!r}, use one of {', '.join(STRATEGIES)}")
+    try:
+        if strategy == 'nth':
+            value = int(parameter)
+        elif strategy == 'deadband':
+            value = float(parameter)
+        else:
+            value = parse_duration(parameter)
+    except ValueError:
+        raise ValueError(f"Invalid parameter for the {strategy} decimation: {parameter!r}") from None
+    if not value > 0 and not (strategy == 'deadband' and value == 0):
+        raise ValueError(f"The parameter of the {strategy} decimation must be positive")
+    if strategy in ('last', 'envelope') and value < MIN_INTERVAL:
+        raise ValueError(f"The {strategy} decimation must be at least {MIN_INTERVAL * 1000:g}ms")
+    return strategy, value
+
+
+def parse_frequency(value):
+    """
+    The parse_frequency function reads the frequency option of a stream.
+
+    :param value: Seconds between two frames, as a number or a string, None or 0 for every update
+    :return: The number of seconds, 0 for every update
+    """
+    if value is None or value == '':
+        return 0
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid frequency {value!r}, use a number of seconds") from None
+    if seconds == 0:
+        return 0
+    if not math.isfinite(seconds) or seconds < MIN_INTERVAL:
+        raise ValueError(f"The frequency must be 0, or a finite number of seconds of at least {MIN_INTERVAL:g}")
+    return seconds
+
+
+def make_decimator(spec):
+    """
+    The make_decimator function returns a new Decimator for a spec returned by parse_decimation.
+
+    :param spec: A tuple of (strategy, parameter)
+    :return: The Decimator
+    """
+    strategy, parameter = spec
+    return _DECIMATORS[strategy](parameter)
+
+
+class Decimator:
+    """
+    A Decimator is fed every update of a device, and tells which ones go to the clients.
+    Strategies with an interval are also flushed at the end of every time bucket.
+    """
+
+    interval = 0  # seconds between two flushes, 0 if the strategy never needs one
+
+    def __init__(self, parameter):
+        self.parameter = parameter
+        self._lock = threading.Lock()
+
+    def start(self, message):
+        """Called with the message the clients receive first, before any update is fed."""
+
+    def feed(self, message):
+        """Return the message to send for an update, or None to hold it back."""
+        return message
+
+    def flush(self):
+        """Return the message to send at the end of a time bucket, or None if there is nothing to send."""
+        return None
+
+
+class EveryNth(Decimator):
+
+    def __init__(self, parameter):
+        super().__init__(parameter)
+        self.count = 0
+
+    def feed(self, message):
+        with self._lock:
+            self.count += 1
+            if self.count < self.parameter:
+                return None
+            self.count = 0
+        return message
+
+
+class LastPerBucket(Decimator):
+
+    def __init__(self, parameter):
+        super().__init__(parameter)
+        self.interval = parameter
+        self.pending = None
+
+    def feed(self, message):
+        with self._lock:
+            self.pending = message
+        return None
+
+    def flush(self):
+        with self._lock:
+            message, self.pending = self.pending, None
+        return message
+
+
+class Envelope(Decimator):
+
+    def __init__(self, parameter):
+        super().__init__(parameter)
+        self.interval = parameter
+        self.last = None  # the newest message of the bucket
+        self.samples = 0
+        self.fields = {}  # {field: [min, max, sum, count]} of the bucket
+
+    def feed(self, message):
+        values = message.get('values')
+        with self._lock:
+            self.last = message
+            self.samples += 1
+            if type(values) is dict:
+                fields = self.fields
+                for field, value in values.items():
+                    if type(value) not in (int, float) or value != value:
+                        continue
+                    envelope = fields.get(field)
+                    if envelope is None:
+                        fields[field] = [value, value, value, 1]
+                        continue
+                    if value < envelope[0]:
+                        envelope[0] = value
+                    elif value > envelope[1]:
+                        envelope[1] = value
+                    envelope[2] += value
+                    envelope[3] += 1
+        return None
+
+    def flush(self):
+        with self._lock:
+            last, samples, fields = self.last, self.samples, self.fields
+            if last is None:
+                return None
+            self.last, self.samples, self.fields = None, 0, {}
+        message = dict(last)
+        values = last.get('values')
+        if type(values) is dict:
+            message['values'] = {field: fields[field][2] / fields[field][3] if field in fields else value
+                                 for field, value in values.items()}
+        message['min'] = {field: envelope[0] for field, envelope in fields.items()}
+        message['max'] = {field: envelope[1] for field, envelope in fields.items()}
+        message['samples'] = samples
+        return message
+
+
+class Deadband(Decimator):
+
+    def __init__(self, parameter):
+        super().__init__(parameter)
+        self.reference = None  # the values of the last message sent
+
+    def start(self, message):
+        self.reference = message.get('values')
+
+    def feed(self, message):
+        values = message.get('values')
+        with self._lock:
+            reference = self.reference
+            if type(values) is dict and type(reference) is dict and not self._moved(values, reference):
+                return None
+            self.reference = values
+        return message
+
+    def _moved(self, values, reference):
+        threshold = self.parameter
+        for field, value in values.items():
+            if field not in reference:
+                return True
+            previous = reference[field]
+            if type(value) in (int, float) and type(previous) in (int, float):
+                if abs(value - previous) > threshold:
+                    return True
+            elif value != previous:
+                return True
+        return False
+
+
+_DECIMATORS = {
+    'nth': EveryNth,
+    'last': LastPerBucket,
+    'envelope': Envelope,
+    'deadband': Deadband,
+}
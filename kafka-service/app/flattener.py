@@ -0,0 +1,144 @@
+import threading
+
+"""
+This module provides the Flattener class, a flatten_json that learns the payload layout of every device.
+
+The `values` of a device almost always have the same nested shape, so the first message of a device is
+flattened the general way and its layout is compiled into a function that reads every leaf directly
+and reuses the same flattened key strings. The compiled function checks the shape as it goes,
+and any mismatch falls back to the general path.
+
+"""
+
+
+class ShapeMismatch(LookupError):
+    """Raised by a compiled layout when a payload does not have the cached shape."""
+
+
+class Flattener:
+    """
+    Flattener flattens message values with a compiled layout cached per device.
+    Devices whose shape keeps changing, and topics that opt out, always take the general path.
+    """
+
+    def __init__(self, uncached_topics=(), max_mismatches=3):
+        """
+        Instantiated the class.
+
+        :param uncached_topics: Topics whose payloads are never cached, such as 'ml_result'
+        :param max_mismatches: Number of shape changes after which a device stops being cached
+        """
+        self.uncached_topics = frozenset(uncached_topics)
+        self.max_mismatches = max_mismatches
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._layouts = {}  # {device_name: compiled layout, or None once the device is not cached}
+        self._mismatches = {}  # {device_name: number of shape changes}
+
+    def flatten(self, device_name, values, topic=None):
+        """
+        The flatten function returns the flattened values of a message of device_name.
+        The result is the same as flatten_json(values).
+
+        :param device_name: The device the message comes from, used as the cache key
+        :param values: The nested values of the message
+        :param topic: The topic of the message, payloads of `uncached_topics` skip the cache
+        :return: A dictionary of {flattened_key: value}
+        """
+        if topic in self.uncached_topics or type(values) is not dict:
+            return flatten_json(values)
+        layout = self._layouts.get(device_name, False)
+        if layout:
+            try:
+                result = layout(values)
+                self.hits += 1
+                return result
+            except LookupError:
+                layout = self._mismatch(device_name)
+        if layout is None:
+            return flatten_json(values)
+        self.misses += 1
+        self._layouts[device_name] = compile_layout(values)
+        return flatten_json(values)
+
+    def discard(self, device_name):
+        """
+        The discard function forgets the cached layout of a device.
+
+        :param device_name: The device to forget
+        """
+        self._layouts.pop(device_name, None)
+        self._mismatches.pop(device_name, None)
+
+    def __len__(self):
+        return len(self._layouts)
+
+    def _mismatch(self, device_name):
+        """Count a shape change, returns None once the device should no longer be cached."""
+        with self._lock:
+            count = self._mismatches.get(device_name, 0) + 1
+            self._mismatches[device_name] = count
+            if count >= self.max_mismatches:
+                self._layouts[device_name] = None
+                return None
+            return False
+
+
+def compile_layout(values):
+    """
+    The compile_layout function builds a function that flattens payloads shaped like values.
+    The generated code only refers to keys through a constant tuple, never by their text,
+    so nothing from the payload ends up in the source code.
+
+    :param values: A nested dictionary, as found in the `values` of a message
+    :return: A function flattening a payload, raising ShapeMismatch when it has another shape
+    """
+    keys = []
+    lines = []
+    items = []
+    leaves = []
+
+    def constant(key):
+        keys.append(key)
+        return f"K[{len(keys) - 1}]"
+
+    def visit(var, node, prefix):
+        lines.append(f"    if type({var}) is not dict or len({var}) != {len(node)}: raise ShapeMismatch")
+        for key, value in node.items():
+            name = f"v{len(lines)}"
+            lines.append(f"    {name} = {var}[{constant(key)}]")
+            if type(value) is dict:
+                visit(name, value, prefix + key + '_')
+            else:
+                items.append(f"{constant(prefix + key)}: {name}")
+                leaves.append(f"type({name}) is dict")
+
+    visit("values", values, '')
+    if leaves:
+        lines.append(f"    if {' or '.join(leaves)}: raise ShapeMismatch")
+    lines.append(f"    return {{{', '.join(items)}}}")
+    source = "def flatten(values, K=K):\n" + "\n".join(lines) + "\n"
+    namespace = {'K': tuple(keys), 'ShapeMismatch': ShapeMismatch}
+    exec(compile(source, '<flatten layout>', 'exec'), namespace)
+    return namespace['flatten']
+
+
+def flatten_json(input_json):
+    """
+    The flatten_json function flattens nested dictionaries, joining the keys with an underscore.
+
+    :param input_json: The nested dictionary
+    :return: A flat dictionary
+    """
+    out = {}
+
+    def flatten(x, name=''):
+        if type(x) is dict:
+            for a in x:
+                flatten(x[a], name + a + '_')
+        else:
+            out[name[:-1]] = x
+
+    flatten(input_json)
+    return out
@@ -0,0 +1,226 @@
+import threading
+from time import time
+
+import numpy as np
+
+"""
+This module provides the HistoryStore class, which keeps a short in-memory history of every device.
+
+Each device owns a ring buffer made of one float64 NumPy array per flattened field,
+plus one array of message times, instead of a list of message dictionaries.
+
+"""
+
+EVICTION_POLICIES = ('lru', 'reject')
+
+
+class DeviceHistory:
+    """
+    DeviceHistory is the ring buffer of a single device.
+    Samples are rows of a column-major float64 array, so every flattened field is one contiguous column.
+    Missing values are stored as NaN, and fields that turn out to hold text are not recorded.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.times = np.full(capacity, np.nan)
+        self.columns = np.full((capacity, 0), np.nan, order='F')
+        self.fields = {}  # {field: column index}
+        self._row_fields = []  # field read into each column, None for text fields
+        self.head = 0  # index of the next write
+        self.size = 0
+        self.last_append = 0.0
+        self.newest = -np.inf  # time of the newest sample, samples can arrive late
+        self.reserved = 0  # bytes accounted for this device in the HistoryStore budget
+
+    def append(self, timestamp, values, new_fields=()):
+        """
+        The append function writes a sample at the head of the ring, overwriting the oldest one when full.
+
+        :param timestamp: The message time of the sample, in epoch seconds
+        :param values: The flattened values of the message
+        :param new_fields: Fields of values that should get a column before the write
+        """
+        with self.lock:
+            if new_fields:
+                self._add_columns(new_fields)
+            head = self.head
+            self.times[head] = timestamp
+            row = [values.get(field) if field is not None else None for field in self._row_fields]
+            try:
+                self.columns[head] = row
+            except (TypeError, ValueError):
+                self.columns[head] = self._numeric_row(row)
+            self.head = (head + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.last_append = timestamp
+            self.newest = max(self.newest, timestamp)
+
+    def query(self, since=None):
+        """
+        The query function returns the samples of the ring in chronological order.
+
+        :param since: Only return samples stamped at or after this epoch time
+        :return: A tuple of (times, {field: values}) as NumPy arrays
+        """
+        with self.lock:
+            order = (np.arange(self.head - self.size, self.head)) % self.capacity
+            times = self.times[order]
+            columns = self.columns[order]
+            fields = dict(self.fields)
+        if since is not None:
+            keep = times >= since
+            times = times[keep]
+            columns = columns[keep]
+        return times, {field: columns[:, index] for field, index in fields.items()}
+
+    def _add_columns(self, new_fields):
+        columns = np.full((self.capacity, len(self._row_fields) + len(new_fields)), np.nan, order='F')
+        columns[:, :len(self._row_fields)] = self.columns
+        self.columns = columns
+        for field in new_fields:
+            self.fields[field] = len(self._row_fields)
+            self._row_fields.append(field)
+
+    def _numeric_row(self, row):
+        """Convert a row with text in it, and stop reading the fields that held text."""
+        result = []
+        for index, value in enumerate(row):
+            try:
+                result.append(float(value) if value is not None else np.nan)
+            except (TypeError, ValueError):
+                self._row_fields[index] = None
+                result.append(np.nan)
+        return result
+
+
+class HistoryStore:
+    """
+    HistoryStore holds a DeviceHistory for every device, within a global memory budget.
+    Samples more than `max_age` seconds older than the newest sample of their device are never returned,
+    so a device whose clock is off still has a history.
+    When the budget is exhausted, the `eviction` policy either drops the least recently
+    updated device ('lru') or refuses to grow ('reject').
+    """
+
+    def __init__(self, capacity=600, max_age=300, memory_budget=256 * 1024 * 1024, eviction='lru'):
+        """
+        Instantiated the class.
+
+        :param capacity: Number of samples kept per device, 0 disables the history
+        :param max_age: Number of seconds of history returned per device
+        :param memory_budget: Maximum number of bytes used by all ring buffers
+        :param eviction: What to do when the budget is exhausted, 'lru' or 'reject'
+        """
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"Unsupported eviction policy {eviction}, use one of {EVICTION_POLICIES}")
+        self.capacity = capacity
+        self.max_age = max_age
+        self.memory_budget = memory_budget
+        self.eviction = eviction
+        self.evicted = 0  # number of device histories dropped to stay within the budget
+        self.rejected = 0  # number of samples not stored because of the budget
+        self._lock = threading.Lock()
+        self._devices = {}  # {device_name: DeviceHistory}
+        self._nbytes = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def append(self, device_name, values, timestamp=None):
+        """
+        The append function records the flattened values of a device.
+        Calls for the same device must not run concurrently, the latest store guarantees that
+        by calling it under the shard lock of the device.
+
+        :param device_name: The device the values belong to
+        :param values: The flattened values of the message
+        :param timestamp: The message time of the sample in epoch seconds, defaults to now
+        """
+        if not self.enabled or type(values) is not dict:
+            return
+        if timestamp is None:
+            timestamp = time()
+        history = self._devices.get(device_name)
+        column_bytes = self.capacity * 8
+        if history is None:
+            history = DeviceHistory(self.capacity)
+            if not self._reserve(history, column_bytes, device_name):
+                return
+            with self._lock:
+                self._devices[device_name] = history
+        new_fields = ()
+        if not history.fields.keys() >= values.keys():
+            new_fields = [field for field in values if field not in history.fields]
+        if new_fields and not self._reserve(history, column_bytes * len(new_fields), device_name):
+            new_fields = []
+        history.append(timestamp, values, new_fields)
+
+    def query(self, device_name, seconds=None):
+        """
+        The query function returns the history of a device, oldest sample first.
+
+        :param device_name: The device to look up
+        :param seconds: Only return the samples of the last `seconds` seconds before the newest one, capped at `max_age`
+        :return: A dictionary of {'time': [...], 'values': {field: [...]}}, or None for an unknown device
+        """
+        history = self._devices.get(device_name)
+        if history is None:
+            return None
+        if seconds is None or seconds > self.max_age:
+            seconds = self.max_age
+        times, fields = history.query(since=history.newest - seconds)
+        return {
+            'time': times.tolist(),
+            'values': {field: _to_list(column) for field, column in fields.items()},
+        }
+
+    def discard(self, device_name):
+        """
+        The discard function drops the history of a device and releases its memory.
+
+        :param device_name: The device to drop
+        """
+        with self._lock:
+            history = self._devices.pop(device_name, None)
+            if history is not None:
+                self._nbytes -= history.reserved
+
+    def __contains__(self, device_name):
+        return device_name in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _reserve(self, history, nbytes, device_name):
+        """Account for nbytes more memory for history, evicting other devices if the policy allows it."""
+        with self._lock:
+            while self._nbytes + nbytes > self.memory_budget:
+                if self.eviction == 'reject' or not self._evict_one(exclude=device_name):
+                    self.rejected += 1
+                    return False
+            self._nbytes += nbytes
+            history.reserved += nbytes
+            return True
+
+    def _evict_one(self, exclude):
+        """Drop the least recently updated device. Runs with self._lock held."""
+        candidates = ((history.last_append, name) for name, history in self._devices.items() if name != exclude)
+        oldest = min(candidates, default=None)
+        if oldest is None:
+            return False
+        history = self._devices.pop(oldest[1])
+        self._nbytes -= history.reserved
+        self.evicted += 1
+        return True
+
+
+def _to_list(column):
+    """Convert a float column to a list, with NaN turned into None so it serializes to JSON null."""
+    return [None if value != value else value for value in column.tolist()]
@@ -1,9 +1,29 @@
 import json
 import os
 import threading
-from time import sleep
+from functools import partial
+from time import monotonic, perf_counter, sleep, time
 
-from confluent_kafka import Consumer, KafkaError, KafkaException
+from confluent_kafka import Consumer, KafkaError, KafkaException, TopicPartition
+
+from .backends import open_latest_store
+from .broadcaster import Broadcaster
+from .dead_letter import DeadLetterBuffer
+from .flattener import Flattener
+from .history import HistoryStore
+from .latency import LatencyTracker
+from .presence import PresenceIndex
+from .rolling_stats import RollingStats, parse_windows
+from .latest_store import LatestStore, message_time_ns
+from .metrics import KafkaMetrics
+from .pipelines import MAIN_STORE, PipelineRegistry
+from .snapshot import SnapshotCache
+from .warm_start import WarmStart
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is listed in requirements.txt
+    orjson = None
 
 """
 This module provides the KafkaService class, which is used to consume data from Kafka.
@@ -22,13 +42,20 @@ class KafkaService:
     It can be used to consume data from a single topic or multiple topics.
     """
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, metrics=None, lookback=None):
         """
         Instantiated the class.
         It sets up the Kafka consumer configs and assigns it to self.consumer.
+        With metrics, librdkafka statistics are enabled every KAFKA_STATS_INTERVAL_MS milliseconds
+        to report the consumer lag, and partition assignments are counted.
+        With a lookback, assigned partitions are rewound to the first message of the last `lookback` seconds
+        instead of starting at the end, and the consumer is catching up until it reaches the former end.
 
         :param self: Represent the instance of the class
         :param config: Pass in a dictionary of configuration options
+        :param metrics: A KafkaMetrics to report to
+        :param lookback: A dictionary of {topic: seconds}, '*' applying to the other topics,
+            defaults to KAFKA_REWIND_LOOKBACK
         :return: A consumer object
         :doc-author: Yukkei
         """
@@ -45,6 +72,17 @@ class KafkaService:
         else:
             self.config = config
 
+        self.metrics = metrics
+        if lookback is None:
+            lookback = parse_lookback(os.environ.get('KAFKA_REWIND_LOOKBACK', ''))
+        self.lookback = lookback
+        self.catchup = {}  # {(topic, partition): offset of the last message to catch up to}
+        self._catchup_started = None
+        self._catchup_messages = 0
+        if metrics is not None:
+            self.config = dict(self.config)
+            self.config.setdefault('statistics.interval.ms', int(os.environ.get('KAFKA_STATS_INTERVAL_MS', 5000)))
+            self.config['stats_cb'] = self._on_stats
         self.consumer = Consumer(self.config)
 
     def subscribe(self, topics):
@@ -56,7 +94,10 @@ class KafkaService:
         :doc-author: Yukkei
         """
         consumer = self.consumer
-        consumer.subscribe(topics, on_assign=on_assign)
+        if not topics:
+            consumer.unsubscribe()
+            return
+        consumer.subscribe(topics, on_assign=self._on_assign)
         # consumer.subscribe(topics)
 
     def consume(self):
@@ -69,14 +110,16 @@ class KafkaService:
 
         return self.consumer.poll(timeout=10)
 
-    def batch_consume(self, batch_size=50):
+    def batch_consume(self, batch_size=50, timeout=1):
         """
         This consumes a batch of messages from the Kafka queue.
 
+        :param batch_size: The maximum number of messages to return
+        :param timeout: How long (in seconds) to wait for the batch to fill up
         :return: A list of messages that have been consumed
         :doc-author: Yukkei
         """
-        return self.consumer.consume(num_messages=batch_size, timeout=1)
+        return self.consumer.consume(num_messages=batch_size, timeout=timeout)
 
     def commit(self):
         """
@@ -144,12 +187,65 @@ class KafkaService:
             self.consumer.close()
         except Exception as e:
             print(f"Error closing Kafka consumer: {e}")
+        if self.metrics is not None:
+            self.metrics.drop_consumer_lag(self)
 
     def reset_consumer(self):
         """Method to reset the Kafka consumer."""
         self.close()  # Close the current consumer
         self.consumer = Consumer(self.config)  # Reinitialize the consumer
 
+    def catching_up(self, msgs):
+        """
+        The catching_up function tells whether a poll result is part of the catch-up after a rewind,
+        and ends the catch-up once every rewound partition reached its former end, or a poll came back empty.
+
+        :param msgs: The messages of the poll, an empty list for an empty poll
+        :return: True if the messages were consumed while catching up
+        """
+        if not self.catchup:
+            return False
+        for msg in msgs:
+            key = (msg.topic(), msg.partition())
+            target = self.catchup.get(key)
+            if target is not None and not msg.error() and msg.offset() >= target:
+                del self.catchup[key]
+        self._catchup_messages += len(msgs)
+        if self.metrics is not None:
+            self.metrics.catchup_messages.inc(len(msgs))
+        if not msgs or not self.catchup:
+            self._end_catchup()
+        return True
+
+    def _end_catchup(self):
+        elapsed = monotonic() - self._catchup_started
+        print(f"Caught up {self._catchup_messages} messages in {elapsed:.1f}s")
+        if self.metrics is not None:
+            self.metrics.catchup_active.set(0)
+            self.metrics.catchup_seconds.set(elapsed)
+            self.metrics.catchup_rate.set(self._catchup_messages / elapsed if elapsed > 0 else 0)
+        self.catchup = {}
+
+    def _on_assign(self, consumer, partitions):
+        if self.metrics is not None:
+            self.metrics.rebalances.inc()
+        if not self.lookback:
+            on_assign(consumer, partitions)
+            return
+        self.catchup = rewind_on_assign(consumer, partitions, self.lookback)
+        if self.catchup:
+            self._catchup_started = monotonic()
+            self._catchup_messages = 0
+            if self.metrics is not None:
+                self.metrics.catchup_active.set(1)
+
+    def _on_stats(self, stats_json):
+        """The stats_cb of librdkafka, called from poll with the statistics as a JSON string."""
+        try:
+            self.metrics.set_consumer_lag(self, consumer_lag(loads(stats_json)))
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f"Error reading the consumer statistics: {e}")
+
 
 class KafkaStreamHandler:
     """
@@ -158,65 +254,437 @@ class KafkaStreamHandler:
     It can also be used to get the latest data stream from a single device.
     """
 
-    def __init__(self, scale=1):
+    def __init__(self, scale=1, batch_size=None, linger=None, shards=None):
+        """
+        Instantiated the class.
+
+        :param scale: Number of consumer threads to start
+        :param batch_size: Maximum number of messages pulled per poll, 1 falls back to the single message loop
+        :param linger: How long (in seconds) a poll waits for a batch to fill up
+        :param shards: Number of independently locked shards in the latest store
+        """
+        if shards is None:
+            shards = int(os.environ.get('KAFKA_STORE_SHARDS', 16))
+        tolerance = os.environ.get('KAFKA_LATE_TOLERANCE_MS')
+        if batch_size is None:
+            batch_size = int(os.environ.get('KAFKA_BATCH_SIZE', 500))
+        if linger is None:
+            linger = float(os.environ.get('KAFKA_BATCH_LINGER', 0.1))
         self.scale = scale
+        self.batch_size = batch_size
+        self.linger = linger
         self.consumer_thread_pool = {}
-        self.data = {}  # {device_name: measurement} use to store the last measurement
-        self.flag = {}  # {device_name: write_flag} use to indicate if the measurement is new
+        tolerance = int(float(tolerance) * 1_000_000) if tolerance else None
+        backend = os.environ.get('KAFKA_LATEST_BACKEND', 'shared' if os.environ.get('KAFKA_SHARED_STORE') else 'memory')
+        options = {}
+        if backend == 'shared':
+            options = dict(
+                path=os.environ.get('KAFKA_SHARED_STORE') or '/dev/shm/kafka-latest',
+                devices=int(os.environ.get('KAFKA_SHARED_STORE_DEVICES', 8192)),
+                slot_bytes=int(os.environ.get('KAFKA_SHARED_STORE_SLOT_BYTES', 4096)),
+            )
+        elif backend == 'redis':
+            options = dict(
+                url=os.environ.get('KAFKA_REDIS_URL', 'redis://localhost:6379/0'),
+                prefix=os.environ.get('KAFKA_REDIS_PREFIX', 'kafka-latest'),
+                flush_interval=float(os.environ.get('KAFKA_REDIS_FLUSH_INTERVAL', 0.05)),
+            )
+        # {device_name: measurement} use to store the last measurement,
+        # read-only in the workers following the process that consumes Kafka into a shared backend
+        self.data = open_latest_store(backend, shards, tolerance, **options)
+        self.latest_limits = dict(  # the bounds of every latest store, 0 disables a bound
+            max_devices=int(os.environ.get('KAFKA_LATEST_MAX_DEVICES', 0)),
+            ttl=float(os.environ.get('KAFKA_LATEST_TTL', 0)),
+            memory_budget=int(float(os.environ.get('KAFKA_LATEST_MEMORY_MB', 0)) * 1024 * 1024),
+        )
+        self.evict_interval = float(os.environ.get('KAFKA_LATEST_EVICT_INTERVAL', 1))
+        if not self.data.read_only:
+            self.data.set_limits(**self.latest_limits)  # the workers following the writer drop what it evicts
+        self.data.on_evict = self._on_evict
+        self.follow_interval = float(os.environ.get('KAFKA_FOLLOW_INTERVAL', 0.05))
+        self.stores = {MAIN_STORE: self.data}  # {store name: LatestStore} written by the topic pipelines
+        self._stores_lock = threading.Lock()
+        self.pipelines = PipelineRegistry.from_config(  # the topics consumed and the stages of each
+            os.environ.get('KAFKA_TOPICS', 'sensor_data,ml_result,slb_out'),
+            os.environ.get('KAFKA_PIPELINES', ''),
+        )
+        self.flattener = Flattener(  # caches the payload layout of every device
+            uncached_topics=[topic for topic in os.environ.get('KAFKA_FLATTEN_UNCACHED_TOPICS', 'ml_result').split(',')
+                             if topic],
+        )
+        self.snapshot = SnapshotCache(  # pre-encoded JSON of self.data served by /latest
+            self.data,
+            interval=float(os.environ.get('KAFKA_SNAPSHOT_INTERVAL', 1.0)),
+            gzip_level=int(os.environ.get('KAFKA_SNAPSHOT_GZIP_LEVEL', 6)),
+        )
+        self.broadcaster = Broadcaster(  # wakes the stream subscribers of a device when it is updated
+            queue_size=int(os.environ.get('KAFKA_STREAM_QUEUE_SIZE', 16)),
+            overflow=os.environ.get('KAFKA_STREAM_OVERFLOW', 'coalesce'),
+            slow_timeout=float(os.environ.get('KAFKA_STREAM_SLOW_TIMEOUT', 30)),
+            idle_timeout=float(os.environ.get('KAFKA_STREAM_IDLE_TIMEOUT', 0)),
+        )
+        self.history = HistoryStore(  # ring buffer of the last samples of every device
+            capacity=int(os.environ.get('KAFKA_HISTORY_SAMPLES', 600)),
+            max_age=float(os.environ.get('KAFKA_HISTORY_SECONDS', 300)),
+            memory_budget=int(float(os.environ.get('KAFKA_HISTORY_MEMORY_MB', 256)) * 1024 * 1024),
+            eviction=os.environ.get('KAFKA_HISTORY_EVICTION', 'lru'),
+        )
+        self.stats = RollingStats(  # running count, mean, variance, min, max and EWMA of every field
+            windows=parse_windows(os.environ.get('KAFKA_STATS_WINDOWS', '10s,1m,5m')),
+            buckets=int(os.environ.get('KAFKA_STATS_BUCKETS', 6)),
+            memory_budget=int(float(os.environ.get('KAFKA_STATS_MEMORY_MB', 64)) * 1024 * 1024),
+        )
+        self.presence = PresenceIndex(  # when every device was last seen, and its online/offline transitions
+            offline_after=float(os.environ.get('KAFKA_OFFLINE_AFTER', 30)),
+            interval=float(os.environ.get('KAFKA_PRESENCE_INTERVAL', 1)),
+        )
+        self.warm_start = WarmStart(  # saves self.data to a local file, and restores it at startup
+            self.data,
+            path=os.environ.get('KAFKA_WARM_START_FILE', ''),
+            interval=float(os.environ.get('KAFKA_WARM_START_INTERVAL', 30)),
+        )
+        self.dead_letters = DeadLetterBuffer(  # the messages that could not be decoded or processed
+            capacity=int(os.environ.get('KAFKA_DEAD_LETTER_CAPACITY', 1000)),
+            spill_path=os.environ.get('KAFKA_DEAD_LETTER_FILE', ''),
+            spill_bytes=int(float(os.environ.get('KAFKA_DEAD_LETTER_SPILL_MB', 64)) * 1024 * 1024),
+        )
+        self.reset_backoff = float(os.environ.get('KAFKA_RESET_BACKOFF', 1))
+        self.reset_backoff_max = float(os.environ.get('KAFKA_RESET_BACKOFF_MAX', 60))
+        self.metrics = KafkaMetrics()  # served by /metrics
+        self.metrics.callback('kafka_stream_subscribers', 'Active stream subscribers',
+                              self.broadcaster.subscriber_count)
+        self.metrics.callback('kafka_stream_dropped_total', 'Updates dropped from the queue of a stream subscriber',
+                              lambda: self.broadcaster.dropped, kind='counter')
+        self.metrics.callback('kafka_stream_evicted_total', 'Stream subscribers disconnected by the dispatcher',
+                              lambda: {(reason,): count for reason, count in self.broadcaster.evicted.items()},
+                              kind='counter', labels=('reason',))
+        self.metrics.callback('kafka_latest_devices', 'Devices in each latest store',
+                              lambda: {(name,): len(store) for name, store in list(self.stores.items())},
+                              labels=('store',))
+        self.metrics.callback('kafka_latest_bytes', 'Estimated memory of the messages in each latest store',
+                              lambda: {(name,): store.nbytes for name, store in list(self.stores.items())},
+                              labels=('store',))
+        self.metrics.callback('kafka_latest_evicted_total', 'Devices evicted from each latest store',
+                              lambda: {(name, reason): count for name, store in list(self.stores.items())
+                                       for reason, count in store.evicted.items()},
+                              kind='counter', labels=('store', 'reason'))
+        self.metrics.callback('kafka_history_bytes', 'Memory used by the in-memory history',
+                              lambda: self.history.nbytes)
+        self.metrics.callback('kafka_stats_bytes', 'Memory used by the rolling statistics',
+                              lambda: self.stats.nbytes)
+        self.metrics.callback('kafka_devices', 'Devices seen by the dispatcher, online or offline',
+                              lambda: {(status,): count for status, count in self.presence.counts().items()},
+                              labels=('status',))
+        self.metrics.callback('kafka_shared_store_skipped_total', 'Messages not copied to the shared store',
+                              lambda: {(reason,): count for reason, count in getattr(self.data, 'skipped', {}).items()},
+                              kind='counter', labels=('reason',))
+        self.metrics.callback('kafka_dead_letter_buffer', 'Quarantined messages kept in memory',
+                              lambda: len(self.dead_letters))
+        self.latency = LatencyTracker(  # produce, store and emit latency of the messages, served by /admin/latency
+            self.metrics.latency,
+            max_classes=int(os.environ.get('KAFKA_LATENCY_MAX_CLASSES', 50)),
+        )
+        self.broadcaster.on_emit = self.latency.emitted
         self.running = False  # flag to stop the thread
         # self.thread = None  # thread to run the kafka consumer
 
-    def storing_latest(self):
+    def storing_latest(self, kafka_service=None):
         """
         The storing_latest function is a thread that runs in the background.
-        It consumes messages from Kafka and stores them in a dictionary called `self.data`,
+        It consumes messages from Kafka and stores them in the LatestStore called `self.data`,
         which is keyed by device_name (the name of the device that sent the message).
-        The `self.flag` dictionary keeps track of whether the message is new or not.
+        The store keeps a write flag per device to track whether the message is new or not.
+        Every message goes through the pipeline of its topic in `self.pipelines`.
+        A message that cannot be decoded or processed goes to `self.dead_letters`,
+        the consumer is only recreated on broker errors, waiting longer after each failed attempt.
 
+        :param kafka_service: An already subscribed KafkaService, a new one is created if omitted
         :doc-author: Yukkei
         """
         print("begin storing latest data")
-        kafka_service = KafkaService()
-        kafka_service.subscribe(['sensor_data', 'ml_result', 'slb_out'])
-        sleep(1)
+        if kafka_service is None:
+            kafka_service = KafkaService(metrics=self.metrics)
+            kafka_service.subscribe(self.pipelines.topics())
+            sleep(1)
+        subscribed = self.pipelines.version
+        backoff = self.reset_backoff
+        caught_up = set()
         while self.running:
-
-            msg = kafka_service.consume()
-            no_message_counter = 0
-            # print("message received")
+            try:
+                if self.pipelines.version != subscribed:
+                    subscribed = self.pipelines.version
+                    kafka_service.subscribe(self.pipelines.topics())
+                msg = kafka_service.consume()
+                polled = self.latency.poll()
+                if msg is not None and msg.error():
+                    if msg.error().code() == KafkaError._PARTITION_EOF:
+                        continue
+                    raise KafkaException(msg.error())
+            except KafkaException as e:
+                print(f"Error: {e}")
+                backoff = self._reset_consumer(kafka_service, backoff)
+                continue
+            backoff = self.reset_backoff
+            catching_up = kafka_service.catching_up([msg] if msg else [])
             if msg:
-                try:
-                    msg_json = json.loads(msg.value().decode('utf-8'))
-                    msg_json['values'] = flatten_json(msg_json['values'])
-                    device_name = msg_json.get("device_name", "")
-                    identifier = msg_json.get("identifier", "")
-                    if device_name:
-                        if identifier:
-                            device_name = f"{device_name}_{identifier}"
-                        if device_name in self.data and str(msg_json.get('time')) > str(
-                                self.data[device_name].get('time')):
-                            # flatten the json
-                            self.data[device_name] = msg_json
-                            self.flag[device_name] += 1
-                            if self.flag[device_name] > 100:
-                                self.flag[device_name] = 0
-                        elif device_name not in self.data:
-                            self.data[device_name] = msg_json
-                            self.flag[device_name] = 0
-                except Exception as e:
-                    kafka_service.reset_consumer()
-                    kafka_service.subscribe(['sensor_data', 'ml_result', 'slb_out'])
-                    print(f"Error: {e}")
-            else:
-                no_message_counter += 1
-                print("No message received: ", no_message_counter)
-                if no_message_counter > 60:
-                    kafka_service.reset_consumer()
-                    kafka_service.subscribe(['sensor_data', 'ml_result', 'slb_out'])
+                pipeline = self.pipelines.get(msg.topic())
+                value = msg.value()
+                self.metrics.messages.inc(1, (msg.topic(),))
+                self.metrics.bytes.inc(len(value) if value else 0, (msg.topic(),))
+                if pipeline is not None:
+                    try:
+                        begin = perf_counter()
+                        msg_json = json.loads(value.decode('utf-8'))
+                        device_name = device_key(msg_json)
+                        flatten_begin = perf_counter()
+                        if pipeline.flatten:
+                            msg_json['values'] = self.flattener.flatten(device_name, msg_json['values'], msg.topic())
+                        self.metrics.decode_seconds.observe(flatten_begin - begin)
+                        self.metrics.flatten_seconds.observe(perf_counter() - flatten_begin)
+                        if device_name and self._process(pipeline, device_name, msg_json, None, not catching_up,
+                                                         polled) and catching_up and pipeline.fanout:
+                            caught_up.add(device_name)
+                    except Exception as e:
+                        self._quarantine(msg.topic(), value, e, msg.partition(), msg.offset())
+            if caught_up and not kafka_service.catchup:
+                self._publish_caught_up(caught_up)
             sleep(0)
 
         kafka_service.close()
 
+    def storing_latest_batch(self, kafka_service=None):
+        """
+        The storing_latest_batch function is the batched version of storing_latest.
+        Every poll pulls up to `self.batch_size` messages, waiting at most `self.linger` seconds.
+        The batch is decoded in one pass and collapsed to the newest record per device and store,
+        so only one record per device is written to the store and published to the plain streams.
+        The records it superseded are still handed to the history, the rolling statistics and the decimations
+        just before it, so they see every message as with the single message loop.
+        While the consumer catches up after a rewind, messages only update the stores:
+        the history and the stream subscribers get the newest message of each device once the catch-up is over.
+        A message that cannot be decoded or processed goes to `self.dead_letters` and the batch goes on,
+        only broker errors recreate the consumer.
+
+        :param kafka_service: An already subscribed KafkaService, a new one is created if omitted
+        """
+        print("begin storing latest data in batches")
+        if kafka_service is None:
+            kafka_service = KafkaService(metrics=self.metrics)
+            kafka_service.subscribe(self.pipelines.topics())
+            sleep(1)
+        subscribed = self.pipelines.version
+        backoff = self.reset_backoff
+        caught_up = set()
+        while self.running:
+            try:
+                if self.pipelines.version != subscribed:
+                    subscribed = self.pipelines.version
+                    kafka_service.subscribe(self.pipelines.topics())
+                msgs = kafka_service.batch_consume(self.batch_size, self.linger)
+                polled = self.latency.poll()
+                catching_up = kafka_service.catching_up(msgs)
+                if msgs:
+                    traffic = {}
+                    begin = perf_counter()
+                    superseded = {} if not catching_up else None
+                    latest = collapse_batch(msgs, traffic, on_error=self._quarantine_message,
+                                            store_of=self.pipelines.store_of, superseded=superseded)
+                    self.metrics.decode_seconds.observe(perf_counter() - begin)
+                    for topic, (count, size) in traffic.items():
+                        self.metrics.messages.inc(count, (topic,))
+                        self.metrics.bytes.inc(size, (topic,))
+                    flatten_seconds = 0
+                    for key, (msg_json, topic, time_ns) in latest.items():
+                        device_name = key[1]
+                        pipeline = self.pipelines.get(topic)
+                        if pipeline is None:
+                            continue
+                        try:
+                            begin = perf_counter()
+                            earlier = superseded.get(key) if superseded else None
+                            if earlier:
+                                earlier = self._earlier(device_name, earlier)
+                            if pipeline.flatten:
+                                msg_json['values'] = self.flattener.flatten(device_name, msg_json['values'], topic)
+                            flatten_seconds += perf_counter() - begin
+                            if self._process(pipeline, device_name, msg_json, time_ns, not catching_up, polled,
+                                             earlier) and catching_up and pipeline.fanout:
+                                caught_up.add(device_name)
+                        except Exception as e:
+                            self._quarantine(topic, msg_json, e)
+                    self.metrics.flatten_seconds.observe(flatten_seconds)
+                if caught_up and not kafka_service.catchup:
+                    self._publish_caught_up(caught_up)
+                backoff = self.reset_backoff
+            except KafkaException as e:
+                print(f"Error: {e}")
+                backoff = self._reset_consumer(kafka_service, backoff)
+            except Exception as e:  # the messages of the batch are lost, not the consumer thread
+                print(f"Error: {e}")
+
+        kafka_service.close()
+
+    def following_latest_store(self):
+        """
+        The following_latest_store function is the thread of the workers that do not consume Kafka.
+        Every `self.follow_interval` seconds it copies the devices the writer process updated
+        in the shared backend, and hands them to the history and the stream subscribers.
+        """
+        print("begin following the latest store")
+        while self.running:
+            self._follow_latest_store()
+            sleep(self.follow_interval)
+
+    def _follow_latest_store(self):
+        for device_name, msg_json in self.data.sync():
+            self.latency.label(device_name, msg_json, '')  # the topic is only known to the writer process
+            self._on_change(device_name, msg_json)
+
+    def _reset_consumer(self, kafka_service, backoff=0):
+        """
+        Wait `backoff` seconds, then recreate the consumer of kafka_service and subscribe it again.
+        Returns the wait before the next reset, doubled up to `self.reset_backoff_max`.
+        """
+        deadline = monotonic() + backoff
+        while self.running and monotonic() < deadline:
+            sleep(min(1.0, deadline - monotonic()))
+        if not self.running:
+            return backoff
+        self.metrics.resets.inc()
+        kafka_service.reset_consumer()
+        kafka_service.subscribe(self.pipelines.topics())
+        return min(max(backoff * 2, self.reset_backoff), self.reset_backoff_max)
+
+    def _quarantine(self, topic, value, error, partition=None, offset=None):
+        """Record a message that could not be decoded or processed in the dead letter buffer."""
+        self.dead_letters.add(topic, value, error, partition, offset)
+        self.metrics.dead_letters.inc(1, (topic, type(error).__name__))
+
+    def _quarantine_message(self, msg, error):
+        """The on_error callback of collapse_batch."""
+        self._quarantine(msg.topic(), msg.value(), error, msg.partition(), msg.offset())
+
+    def store_latest(self, device_name, msg_json, time_ns=None, notify=True):
+        """
+        The store_latest function writes a decoded message to `self.data`
+        if it is newer than the one already stored for the device, bumps its write flag,
+        appends it to the history of the device and publishes it to the stream subscribers of the device.
+        It is safe to call from several consumer threads at once.
+
+        :param device_name: The key the message is stored under
+        :param msg_json: The decoded and flattened message
+        :param time_ns: The message time in epoch nanoseconds, parsed from msg_json if omitted
+        :param notify: False only updates `self.data`, without history nor stream subscribers
+        :return: True if the message was stored
+        """
+        on_change = partial(self._on_change, time_ns=time_ns) if notify else None
+        return self.data.update(device_name, msg_json, on_change=on_change, time_ns=time_ns)
+
+    def store(self, name):
+        """
+        The store function returns the latest store of a pipeline, creating it on first use.
+        The main store is `self.data`, other stores have a single shard and are not snapshotted.
+
+        :param name: The store name of a pipeline
+        :return: A LatestStore
+        """
+        store = self.stores.get(name)
+        if store is None:
+            with self._stores_lock:
+                store = self.stores.get(name)
+                if store is None:
+                    store = LatestStore(shards=1, tolerance=self.data.tolerance)
+                    store.set_limits(**self.latest_limits)
+                    self.stores[name] = store
+        return store
+
+    def _process(self, pipeline, device_name, msg_json, time_ns=None, notify=True, polled=None, earlier=None):
+        """
+        Run the filter, store and fanout stages of a pipeline on a decoded message. Returns True if it was stored.
+        With polled, the (epoch time, clock) of the poll that returned it, see LatencyTracker.poll,
+        the latency of a stored message is recorded, unless the consumer is catching up.
+        With earlier, the messages of the device it superseded in a batch, see _earlier, are handed to the fanout
+        before it when it is stored.
+        """
+        if pipeline.filter:
+            if not pipeline.accepts(device_name):
+                return False
+            msg_json['values'] = pipeline.select(msg_json['values'])
+        if time_ns is None:
+            time_ns = message_time_ns(msg_json)
+        on_change = None
+        if notify and pipeline.fanout:
+            on_change = partial(self._on_change, time_ns=time_ns)
+            if earlier:
+                on_change = partial(self._on_changes, earlier, time_ns=time_ns)
+        stored = self.store(pipeline.store).update(device_name, msg_json, on_change=on_change, time_ns=time_ns)
+        if stored and notify and polled is not None:
+            self.latency.stored(device_name, msg_json, pipeline.topic, time_ns, *polled)
+        return stored
+
+    def _earlier(self, device_name, superseded):
+        """
+        Run the flatten and filter stages on the messages a batch superseded, see collapse_batch.
+        Returns the (message, time in epoch nanoseconds) of those going to the fanout of their pipeline.
+        """
+        earlier = []
+        for msg_json, topic, time_ns in superseded:
+            pipeline = self.pipelines.get(topic)
+            if pipeline is None or not pipeline.fanout:
+                continue
+            if pipeline.flatten:
+                msg_json['values'] = self.flattener.flatten(device_name, msg_json['values'], topic)
+            if pipeline.filter:
+                if not pipeline.accepts(device_name):
+                    continue
+                msg_json['values'] = pipeline.select(msg_json['values'])
+            earlier.append((msg_json, time_ns))
+        return earlier
+
+    def _publish_caught_up(self, devices):
+        """Hand the newest message of the devices updated during a catch-up to the history and the subscribers."""
+        for device_name in devices:
+            msg_json = self.data.get(device_name)
+            if msg_json is not None:
+                self._on_change(device_name, msg_json)
+        devices.clear()
+
+    def _on_evict(self, device_name):
+        """Forget what is kept about a device evicted from `self.data`, or dropped by a view following the writer."""
+        self.flattener.discard(device_name)
+        self.history.discard(device_name)
+        self.stats.discard(device_name)
+        self.presence.discard(device_name)
+        self.latency.discard(device_name)
+
+    def evicting_latest_stores(self):
+        """
+        The evicting_latest_stores function is the thread that sweeps the latest stores every `self.evict_interval`
+        seconds, evicting the devices past their time to live even when nothing is written.
+        Writes evict the devices over the count and memory bounds themselves.
+        """
+        while self.running:
+            for store in list(self.stores.values()):
+                store.evict()
+            sleep(self.evict_interval)
+
+    def _on_change(self, device_name, msg_json, time_ns=None):
+        """Runs under the shard lock of device_name every time a message is stored, time_ns is its message time."""
+        if time_ns is None:
+            time_ns = message_time_ns(msg_json)
+        self.history.append(device_name, msg_json['values'], timestamp=time_ns / 1e9)
+        self.stats.update(device_name, msg_json['values'], timestamp=time_ns / 1e9)
+        self.presence.touch(device_name)
+        self.broadcaster.publish(device_name, msg_json)
+
+    def _on_changes(self, earlier, device_name, msg_json, time_ns=None):
+        """The on_change of the newest message of a device in a batch, preceded by the messages it superseded."""
+        for older, older_ns in earlier:
+            self.history.append(device_name, older['values'], timestamp=older_ns / 1e9)
+            self.stats.update(device_name, older['values'], timestamp=older_ns / 1e9)
+            self.broadcaster.feed(device_name, older)
+        self._on_change(device_name, msg_json, time_ns)
+
     def get_latest_data_for_single(self, device_name):
         """
         The get_latest_data_for_single function returns the latest data for a single device.
@@ -226,10 +694,7 @@ class KafkaStreamHandler:
         :return: The latest data for a single device
         :doc-author: Yukkei
         """
-        if device_name in self.data:
-            return self.data[device_name]
-        else:
-            return None
+        return self.data.get(device_name)
 
     def get_latest_data_for_all(self):
         """
@@ -239,19 +704,87 @@ class KafkaStreamHandler:
         :return: A dictionary of the latest data for all sensors
         :doc-author: Yukkei
         """
-        return self.data
+        return self.data.snapshot()
+
+    def get_latest_data_since(self, since):
+        """
+        The get_latest_data_since function returns the devices that changed after a store version.
+
+        :param since: The version returned by a previous call, or by the X-Latest-Version header of /latest
+        :return: A dictionary of {'version': current version, 'data': {device_name: measurement}}
+        """
+        version, data = self.data.changed_since(since)
+        return {'version': version, 'data': data}
+
+    def get_history(self, device_name, seconds=None):
+        """
+        The get_history function returns the recent samples of a device from the in-memory ring buffer.
+        Every message newer than the previous one of the device is recorded, in batched mode too,
+        even when a newer message of the same batch replaced it before it reached the latest store.
+
+        :param device_name: Specify which device's history is being requested
+        :param seconds: How many seconds of history to return, defaults to all that is kept
+        :return: A dictionary of {'time': [...], 'values': {field: [...]}}, or None if the device has no history
+        """
+        return self.history.query(device_name, seconds)
+
+    def get_stats(self, device_name):
+        """
+        The get_stats function returns the rolling statistics of every numeric field of a device.
+        Like the history, they are computed from every message newer than the previous one of the device.
+
+        :param device_name: Specify which device's statistics are being requested
+        :return: A dictionary of {'time', 'windows': {label: seconds}, 'fields': {field: statistics}},
+            or None if the device has no statistics
+        """
+        return self.stats.query(device_name)
+
+    def get_stale_devices(self, older_than=None, limit=None):
+        """
+        The get_stale_devices function lists the devices that sent nothing for a while,
+        from the last seen index instead of comparing the time of every device.
+        A device is seen when one of its messages is stored.
 
-    def get_latest_data_stream(self, device_name, frequency=0):
+        :param older_than: Seconds of silence, defaults to KAFKA_OFFLINE_AFTER
+        :param limit: Maximum number of devices returned
+        :return: A dictionary of {'time', 'older_than', 'devices': [[device_name, last_seen], ...]},
+            the least recently seen device first
+        """
+        if older_than is None:
+            older_than = self.presence.offline_after
+        now = time()
+        return {'time': now, 'older_than': older_than, 'devices': self.presence.stale(older_than, now, limit)}
+
+    def get_latency(self):
+        """
+        The get_latency function returns the latency of the messages from the sensor to the stream clients,
+        estimated from the kafka_latency_seconds histogram: produce is from the `time` of a message to its poll,
+        store from the poll to the latest store, and emit from the store to the frame sent to a stream client.
+
+        :return: A dictionary of {stage: {topic: {device_class: {'count', 'mean', 'p50', 'p90', 'p99'}}}}, in seconds
+        """
+        return self.latency.report()
+
+    def get_latest_data_stream(self, device_name, frequency=0, encoding='json', overflow=None, decimation=None):
         """
         The get_latest_data_stream function is a generator that yields the latest data from a device.
             It takes in two arguments:
                 1) device_name - The name of the device to get data from.
-                This must be one of the devices listed in `self.data`, or else an error will be thrown.
-                2) frequency - How often (in seconds) to check for new data on this stream.
+                This must be one of the devices listed in `self.data`, or else the generator ends immediately.
+                2) frequency - The time (in seconds) between two yielded messages,
+                served by a ticker shared with every client of the device using the same frequency.
+                3) encoding - The wire encoding of the frames, 'json', 'msgpack' or 'delta'.
+                4) overflow - What to do when the client falls behind, 'coalesce', 'drop-oldest' or 'disconnect'.
+                5) decimation - Instead of a frequency, how the updates are thinned out, like nth:10 or envelope:1s,
+                computed once for every client of the device using the same spec.
+            The generator blocks on the broadcaster between updates, so an idle client costs no CPU.
 
         :param self: Represent the instance of the class
         :param device_name: Specify which device's data stream you want to get
         :param frequency: The sampling frequency of the data stream
+        :param encoding: The wire encoding of the frames, see broadcaster.ENCODINGS
+        :param overflow: The overflow policy of the client queue, see broadcaster.OVERFLOW_POLICIES
+        :param decimation: The decimation spec of the stream, see decimation.parse_decimation
         :return: generator of the latest data from a device
         :doc-author: Yukkei
         """
@@ -259,14 +792,8 @@ class KafkaStreamHandler:
             print("Error: device name not found")
             return
 
-        last_seen_flag = -1
-        while self.running:
-            sleep(frequency)
-            current_flag = self.flag.get(device_name, 0)
-            if current_flag != last_seen_flag:
-                last_seen_flag = current_flag
-
-                yield f"data: {self.data[device_name]}\n\n"
+        yield from self.broadcaster.subscribe(device_name, self.data.get(device_name), frequency, encoding, overflow,
+                                              decimation)
 
     def start(self):
         """
@@ -274,13 +801,28 @@ class KafkaStreamHandler:
         It sets the running variable to True, which is used in storing_latest()
             to determine whether it should continue running.
         It also creates a thread that runs storing_latest(), and then starts that thread.
+        The latest store is restored from the warm start snapshot first, when one is configured.
+        A worker that does not write the shared latest store follows it instead of consuming Kafka.
 
         :doc-author: Yukkei
         """
         print("Kafka stream starting")
         self.running = True
+        self.broadcaster.running = True
+        self.presence.start()
+        if any(self.latest_limits.values()) and not self.data.read_only:
+            self.evict_thread = threading.Thread(target=self.evicting_latest_stores, daemon=True)
+            self.evict_thread.start()
+        if self.data.read_only:
+            self.consumer_thread_pool[0] = threading.Thread(target=self.following_latest_store)
+            self.consumer_thread_pool[0].start()
+            print("Kafka stream started, following the latest store")
+            return
+        self.warm_start.load()
+        self.warm_start.start()
+        target = self.storing_latest_batch if self.batch_size > 1 else self.storing_latest
         for i in range(self.scale):
-            self.consumer_thread_pool[i] = threading.Thread(target=self.storing_latest)
+            self.consumer_thread_pool[i] = threading.Thread(target=target)
             self.consumer_thread_pool[i].start()
 
         print("Kafka stream started")
@@ -294,9 +836,14 @@ class KafkaStreamHandler:
         :doc-author: Yukkei
         """
         self.running = False
+        self.broadcaster.close()
+        self.presence.stop()
         sleep(2)
-        for i in range(self.scale):
-            self.consumer_thread_pool[i].join()
+        for thread in self.consumer_thread_pool.values():
+            thread.join()
+        self.warm_start.stop()
+        self.dead_letters.close()
+        self.data.close()
         # self.kafka_service.close()
         # self.thread.join()
 
@@ -317,15 +864,166 @@ def on_assign(consumer, partitions):
     consumer.assign(partitions)
 
 
-def flatten_json(input_json):
-    out = {}
+def rewind_on_assign(consumer, partitions, lookback):
+    """
+    The rewind_on_assign function is an on_assign that starts every partition at the first message
+    of the last `lookback` seconds of its topic, found with offsets_for_times.
+    Partitions of topics without a lookback, or without any message that recent, start at the end like on_assign.
+    If the broker cannot be queried, every partition starts at the end.
 
-    def flatten(x, name=''):
-        if type(x) is dict:
-            for a in x:
-                flatten(x[a], name + a + '_')
-        else:
-            out[name[:-1]] = x
+    :param consumer: The consumer the partitions are assigned to
+    :param partitions: The assigned partitions
+    :param lookback: A dictionary of {topic: seconds}, '*' applying to the other topics
+    :return: A dictionary of {(topic, partition): offset of the last message at assignment time}
+        of the rewound partitions
+    """
+    now_ms = int(time() * 1000)
+    queries = []
+    for p in partitions:
+        seconds = lookback.get(p.topic, lookback.get('*', 0))
+        if seconds > 0:
+            queries.append(TopicPartition(p.topic, p.partition, now_ms - int(seconds * 1000)))
+    catchup = {}
+    try:
+        offsets = {}
+        if queries:
+            offsets = {(tp.topic, tp.partition): tp.offset for tp in consumer.offsets_for_times(queries, timeout=10)}
+        for p in partitions:
+            offset = offsets.get((p.topic, p.partition), -1)
+            if offset >= 0:
+                _, high = consumer.get_watermark_offsets(p, timeout=10)
+                if high > offset:
+                    catchup[(p.topic, p.partition)] = high - 1
+            p.offset = offset if offset >= 0 else -1
+    except KafkaException as e:
+        print(f"Error rewinding the assigned partitions: {e}")
+        catchup = {}
+        for p in partitions:
+            p.offset = -1
+    consumer.assign(partitions)
+    return catchup
 
-    flatten(input_json)
-    return out
+
+def parse_lookback(text):
+    """
+    The parse_lookback function reads the rewind lookback of every topic,
+    written as 'sensor_data=300,ml_result=3600', or as a single number for every topic.
+
+    :param text: The lookback setting
+    :return: A dictionary of {topic: seconds}, the number of a bare value is stored under '*'
+    """
+    lookback = {}
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        topic, _, seconds = item.rpartition('=')
+        lookback[topic.strip() or '*'] = float(seconds)
+    return lookback
+
+
+def loads(raw):
+    """
+    The loads function decodes a raw Kafka message value,
+    using orjson when it is installed and the standard json module otherwise.
+    Payloads orjson rejects but json accepts, such as NaN values, are decoded by json.
+
+    :param raw: The message value in bytes
+    :return: The decoded message
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+
+def consumer_lag(stats):
+    """
+    The consumer_lag function reads the lag of every assigned partition from librdkafka statistics.
+    Partitions whose lag is not known yet are left out.
+
+    :param stats: The decoded statistics passed to stats_cb
+    :return: A dictionary of {(topic, partition): lag in messages}
+    """
+    lag = {}
+    for topic, topic_stats in stats.get('topics', {}).items():
+        for partition, partition_stats in topic_stats.get('partitions', {}).items():
+            partition_lag = partition_stats.get('consumer_lag', -1)
+            if partition != '-1' and partition_lag >= 0:
+                lag[(topic, partition)] = partition_lag
+    return lag
+
+
+def device_key(msg_json):
+    """
+    The device_key function returns the key a message is stored under,
+    which is the device_name suffixed with the identifier when one is present.
+    The key is always a string, so a numeric device_name cannot put a non-string key in the JSON of /latest.
+
+    :param msg_json: The decoded message
+    :return: The device key, or an empty string if the message has no device_name
+    """
+    device_name = msg_json.get("device_name", "")
+    identifier = msg_json.get("identifier", "")
+    if not device_name:
+        return ""
+    if identifier:
+        return f"{device_name}_{identifier}"
+    return str(device_name)
+
+
+def collapse_batch(msgs, traffic=None, on_error=None, store_of=None, superseded=None):
+    """
+    The collapse_batch function decodes a batch of Kafka messages and keeps only
+    the newest message of each device. Malformed messages are skipped.
+
+    :param msgs: The messages returned by KafkaService.batch_consume
+    :param traffic: A dictionary updated with {topic: [messages, bytes]} of the batch
+    :param on_error: Called with the message and the exception for every message that cannot be decoded,
+        the error is printed if omitted
+    :param store_of: Called with the topic, returns the store of its messages, or None to skip them without decoding.
+        The newest message is then kept per (store, device_name)
+    :param superseded: A dictionary filled with {key: [(decoded message, topic, time), ...]}, the messages
+        that were the newest of their device when read and were replaced by a newer one of the batch, in order.
+        Together with the returned message, they are the messages the single message loop would have stored
+    :return: A dictionary of {device_name: (decoded message, topic, message time in epoch nanoseconds)},
+        keyed by (store, device_name) with store_of
+    """
+    latest = {}
+    for msg in msgs:
+        error = msg.error()
+        if error:
+            if error.code() == KafkaError._PARTITION_EOF:
+                continue
+            raise KafkaException(error)
+        value = msg.value()
+        topic = msg.topic()
+        if traffic is not None:
+            counts = traffic.setdefault(topic, [0, 0])
+            counts[0] += 1
+            counts[1] += len(value) if value else 0
+        if store_of is not None:
+            store = store_of(topic)
+            if store is None:
+                continue
+        try:
+            msg_json = loads(value)
+            device_name = device_key(msg_json)
+            if not device_name or 'values' not in msg_json:
+                continue
+        except (ValueError, TypeError, AttributeError) as e:
+            if on_error is None:
+                print(f"Error: {e}")
+            else:
+                on_error(msg, e)
+            continue
+        time_ns = message_time_ns(msg_json)
+        key = device_name if store_of is None else (store, device_name)
+        current = latest.get(key)
+        if current is None or time_ns > current[2]:
+            latest[key] = (msg_json, topic, time_ns)
+            if current is not None and superseded is not None:
+                superseded.setdefault(key, []).append(current)
+    return latest
@@ -0,0 +1,135 @@
+import re
+import threading
+from time import perf_counter, time
+
+"""
+This module provides the LatencyTracker class, which follows the messages from the sensor to the stream clients.
+
+Every stored message is measured through three stages, recorded in one histogram labelled by stage, topic
+and device class:
+    produce  from the `time` the sensor stamped in the message to the poll that returned it
+    store    from that poll to the message being stored in its latest store
+    emit     from the store to the frame handed to the connection of a stream client, once per client
+The produce stage compares the clock of the sensor with the clock of the dispatcher,
+so a sensor clock ahead of the dispatcher is recorded as 0. Messages without a `time` are not recorded in it.
+In batched mode only the newest message of a device in a batch is stored, and measured.
+A rate-limited stream is measured from the tick that sent it, not from the store.
+
+The device class of a device is its device_name without a trailing number, e.g. sensor-12 and sensor_13
+are both of class sensor. Past `max_classes` classes, new ones are recorded as `other`
+to keep the number of series bounded.
+
+"""
+
+STAGES = ('produce', 'store', 'emit')
+OTHER = 'other'
+_TRAILING_NUMBER = re.compile(r'[\W_]*\d+$')
+
+
+def device_class(device_name):
+    """
+    The device_class function returns the class of a device, its name without a trailing number.
+
+    :param device_name: The device_name of a message
+    :return: The device class
+    """
+    return _TRAILING_NUMBER.sub('', device_name) or device_name
+
+
+class LatencyTracker:
+    """
+    LatencyTracker records the latency of the messages through the produce, store and emit stages.
+    """
+
+    def __init__(self, histogram, max_classes=50, clock=perf_counter, wall_clock=time):
+        """
+        Instantiated the class.
+
+        :param histogram: The Histogram recording the latencies, labelled by stage, topic and device class
+        :param max_classes: Maximum number of device classes, the devices of the other classes are recorded as `other`
+        :param clock: The monotonic clock of the store stage
+        :param wall_clock: The epoch clock of the produce stage, compared with the `time` of the messages
+        """
+        self.histogram = histogram
+        self.max_classes = max_classes
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self._lock = threading.Lock()
+        self._classes = set()
+        self._labels = {}  # {device key: (topic, device class)}, set when a message of the device is stored
+
+    def poll(self):
+        """
+        The poll function reads both clocks when a poll returns, for the stored function of the messages it returned.
+
+        :return: A tuple of (epoch time, clock)
+        """
+        return self.wall_clock(), self.clock()
+
+    def stored(self, device_key, msg_json, topic, time_ns, polled_at, poll_perf):
+        """
+        The stored function records the produce and store stages of a message that was just stored.
+
+        :param device_key: The key the message is stored under
+        :param msg_json: The message
+        :param topic: The topic it was consumed from
+        :param time_ns: The message time in epoch nanoseconds
+        :param polled_at: The epoch time of the poll that returned the message, see poll
+        :param poll_perf: The clock of that poll
+        """
+        labels = self.label(device_key, msg_json, topic)
+        if msg_json.get('time') is not None:
+            self.histogram.observe(max(0.0, polled_at - time_ns / 1e9), ('produce',) + labels)
+        self.histogram.observe(self.clock() - poll_perf, ('store',) + labels)
+
+    def emitted(self, device_key, seconds):
+        """
+        The emitted function records the emit stage of a frame sent to a stream client, the on_emit of the Broadcaster.
+
+        :param device_key: The device of the stream
+        :param seconds: Seconds from the publish of the update to the frame
+        """
+        labels = self._labels.get(device_key)
+        if labels is not None:
+            self.histogram.observe(seconds, ('emit',) + labels)
+
+    def discard(self, device_key):
+        """
+        The discard function forgets the labels of a device, its frames are not measured until it is stored again.
+
+        :param device_key: The device
+        """
+        self._labels.pop(device_key, None)
+
+    def report(self):
+        """
+        The report function returns the count, mean and quantiles of every stage, topic and device class.
+
+        :return: A dictionary of {stage: {topic: {device_class: {'count': n, 'mean': s, 'p50': s, 'p90': s, 'p99': s}}}}
+        """
+        report = {stage: {} for stage in STAGES}
+        for (stage, topic, name), summary in sorted(self.histogram.summary().items()):
+            report.setdefault(stage, {}).setdefault(topic, {})[name] = summary
+        return report
+
+    def label(self, device_key, msg_json, topic):
+        """
+        The label function returns the (topic, device class) labels of a device, setting them on first use.
+
+        :param device_key: The key the message is stored under
+        :param msg_json: A message of the device
+        :param topic: The topic of the message, empty when it is not known
+        :return: The labels
+        """
+        labels = self._labels.get(device_key)
+        if labels is not None and labels[0] == topic:
+            return labels
+        name = device_class(str(msg_json.get('device_name') or device_key))
+        with self._lock:
+            if name not in self._classes:
+                if len(self._classes) < self.max_classes:
+                    self._classes.add(name)
+                else:
+                    name = OTHER
+            labels = self._labels[device_key] = (topic, name)
+        return labels
@@ -0,0 +1,462 @@
+import fcntl
+import os
+import threading
+from collections import OrderedDict
+from sys import getsizeof
+from time import monotonic, time_ns
+
+from .timestamps import parse_time_ns
+
+"""
+This module provides the LatestStore class, a thread-safe store of the latest message of every device.
+
+Devices are sharded by key and every shard has its own lock,
+so consumer threads working on different partitions rarely wait on each other.
+Every stored message gets a version from a global counter, so readers can ask for the devices changed since a version.
+Message times are parsed once into epoch nanoseconds, and newest-wins compares those integers.
+
+LatestStore is also the in-process backend of the latest state. The other backends subclass it:
+the store of the process consuming Kafka copies what it stores elsewhere from `_stored`,
+and the other processes follow it with a LatestView, which `sync` keeps up to date.
+
+A store can be bounded with `set_limits`: a maximum number of devices, a time to live since the last update
+of a device, and a memory budget for the messages, estimated with message_nbytes.
+The devices are evicted least recently updated first, from the front of the same ordered dictionary
+that serves `changed_since`, so an eviction costs O(1) whatever the store size.
+A write that takes the store over a limit evicts at most EVICT_BATCH devices once the shard lock is released,
+and `evict`, called periodically, sweeps the devices past their time to live when nothing is written.
+An evicted device is gone from the store: it is not reported by `changed_since`, and comes back as a new
+device with its next message. Only the writer evicts: it copies every eviction to its backend from `_removed`,
+and the LatestViews drop the device with `_drop` when they sync, keeping the versions of the writer.
+
+"""
+
+
+EVICT_BATCH = 2  # devices evicted at most by a write over a limit, more than one so the store shrinks back
+EVICTION_REASONS = ('count', 'ttl', 'memory')
+
+
+class _Shard:
+    """One slice of the LatestStore, guarded by its own lock."""
+
+    __slots__ = ('lock', 'data', 'flag', 'version', 'time_ns', 'nbytes', 'late', 'late_total', 'out_of_order')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}  # {device_name: measurement}
+        self.flag = {}  # {device_name: write_flag}
+        self.version = {}  # {device_name: version of the last update}
+        self.time_ns = {}  # {device_name: message time of the measurement in epoch nanoseconds}
+        self.nbytes = {}  # {device_name: estimated size of the measurement}
+        self.late = {}  # {device_name: number of late messages}
+        self.late_total = 0
+        self.out_of_order = 0
+
+
+class LatestStore:
+    """
+    LatestStore keeps the newest message of every device.
+    It can be read like a dictionary keyed by device_name,
+    and is written through `update`, which applies newest-wins atomically.
+    """
+
+    read_only = False  # True for the stores that only mirror a store written by another process
+
+    def __init__(self, shards=16, tolerance=None):
+        """
+        Instantiated the class.
+        Every device has a watermark at its newest message time minus `tolerance`.
+        Older messages above the watermark are counted as out of order, the ones below it as late.
+        Without a tolerance every older message is late.
+
+        :param shards: Number of independently locked shards
+        :param tolerance: Allowed out-of-order delay in nanoseconds, None disables the watermark
+        """
+        self._shards = tuple(_Shard() for _ in range(max(1, shards)))
+        self.tolerance = tolerance
+        # the version starts at the current time in microseconds, so the versions handed out
+        # after a restart are still greater than the ones clients got from the previous process
+        self.version = time_ns() // 1000
+        self._version_lock = threading.Lock()
+        self._recent = OrderedDict()  # {device_name: version}, the most recently updated device last
+        self._seen = {}  # {device_name: monotonic time of the last update}, in the order of self._recent
+        self.nbytes = 0  # estimated size of the stored measurements
+        self.max_devices = 0
+        self.ttl = 0
+        self.memory_budget = 0
+        self.evicted = dict.fromkeys(EVICTION_REASONS, 0)  # devices evicted, by reason
+        self.on_evict = None  # called as on_evict(device_name) after a device was evicted
+
+    def set_limits(self, max_devices=0, ttl=0, memory_budget=0):
+        """
+        The set_limits function bounds the store, 0 disables a limit.
+
+        :param max_devices: Maximum number of devices, the least recently updated ones are evicted past it
+        :param ttl: Seconds after the last update of a device after which it is evicted
+        :param memory_budget: Bytes of estimated message size past which the least recently updated devices are evicted
+        """
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+
+    def _shard(self, device_name):
+        return self._shards[hash(device_name) % len(self._shards)]
+
+    def update(self, device_name, msg_json, on_change=None, time_ns=None):
+        """
+        The update function stores msg_json for device_name if it is newer than the stored message.
+        The compare and the write happen under the shard lock, so concurrent writers cannot lose updates.
+
+        :param device_name: The key the message is stored under
+        :param msg_json: The decoded and flattened message
+        :param on_change: Called as on_change(device_name, msg_json) under the shard lock when the message is stored,
+            so listeners see the updates of a device in order
+        :param time_ns: The message time in epoch nanoseconds, parsed from msg_json['time'] if omitted
+        :return: True if the message was stored, False if it was not newer than the stored one
+        """
+        if time_ns is None:
+            time_ns = message_time_ns(msg_json)
+        shard = self._shard(device_name)
+        with shard.lock:
+            current = shard.time_ns.get(device_name)
+            if current is None:
+                shard.flag[device_name] = 0
+            elif time_ns > current:
+                shard.flag[device_name] += 1
+            else:
+                if time_ns < current:
+                    self._count_late(shard, device_name, current - time_ns)
+                return False
+            previous = shard.data.get(device_name)
+            shard.data[device_name] = msg_json
+            shard.time_ns[device_name] = time_ns
+            nbytes = shard.nbytes.get(device_name, 0)
+            if previous is None or len(previous) != len(msg_json) \
+                    or len(previous.get('values') or ()) != len(msg_json.get('values') or ()):
+                shard.nbytes[device_name] = message_nbytes(msg_json)  # the layout changed, estimate it again
+            # the version is taken after the write, so a reader that sees it also sees the message
+            with self._version_lock:
+                self.version += 1
+                self.nbytes += shard.nbytes[device_name] - nbytes
+                shard.version[device_name] = self.version
+                self._recent[device_name] = self.version
+                self._recent.move_to_end(device_name)
+                self._seen[device_name] = monotonic()
+                self._stored(device_name, msg_json, time_ns, shard.flag[device_name], self.version)
+            if on_change is not None:
+                on_change(device_name, msg_json)
+        if self.max_devices or self.ttl or self.memory_budget:
+            self._evict(EVICT_BATCH)
+        return True
+
+    def _stored(self, device_name, msg_json, time_ns, flag, version):
+        """Called under the shard lock and the version lock after every write, in version order."""
+
+    def _removed(self, device_name, version):
+        """Called under the shard lock and the version lock after every eviction, in version order."""
+
+    def _apply(self, device_name, msg_json, time_ns, flag, version):
+        """Write a message stored by another LatestStore as it is, keeping its flag and version."""
+        shard = self._shard(device_name)
+        with shard.lock:
+            shard.data[device_name] = msg_json
+            shard.time_ns[device_name] = time_ns
+            shard.flag[device_name] = flag
+            shard.version[device_name] = version
+            nbytes = shard.nbytes.get(device_name, 0)
+            shard.nbytes[device_name] = message_nbytes(msg_json)
+            with self._version_lock:
+                self.nbytes += shard.nbytes[device_name] - nbytes
+                self._recent[device_name] = version
+                self._recent.move_to_end(device_name)
+                self._seen[device_name] = monotonic()
+        if self.max_devices or self.ttl or self.memory_budget:
+            self._evict(EVICT_BATCH)
+
+    def evict(self, limit=None):
+        """
+        The evict function evicts the devices over the limits of the store, the least recently updated first.
+        Each device is evicted under its own shard lock, so writers only wait for one device at a time.
+
+        :param limit: Maximum number of devices evicted, all the devices over the limits if None
+        :return: The number of devices evicted
+        """
+        if not (self.max_devices or self.ttl or self.memory_budget):
+            return 0
+        return self._evict(limit)
+
+    def _evict(self, limit=None):
+        evicted = 0
+        while limit is None or evicted < limit:
+            with self._version_lock:
+                if not self._recent:
+                    break
+                device_name, version = next(iter(self._recent.items()))
+                if self.max_devices and len(self._recent) > self.max_devices:
+                    reason = 'count'
+                elif self.memory_budget and self.nbytes > self.memory_budget:
+                    reason = 'memory'
+                elif self.ttl and monotonic() - self._seen[device_name] > self.ttl:
+                    reason = 'ttl'
+                else:
+                    break
+                del self._recent[device_name]
+                del self._seen[device_name]
+            if self._remove(device_name, version):
+                self.evicted[reason] += 1
+                evicted += 1
+                if self.on_evict is not None:
+                    self.on_evict(device_name)
+        return evicted
+
+    def _remove(self, device_name, version):
+        """Drop a device taken off the front of self._recent, unless it was written again in the meantime."""
+        shard = self._shard(device_name)
+        with shard.lock:
+            if shard.version.get(device_name) != version:
+                return False
+            with self._version_lock:
+                self._forget(shard, device_name)
+                self.version += 1  # the snapshot of /latest is built again without the device
+                self._removed(device_name, self.version)
+        return True
+
+    def _forget(self, shard, device_name):
+        """Drop everything kept about a device. Runs with its shard lock and the version lock held."""
+        del shard.data[device_name]
+        del shard.time_ns[device_name]
+        del shard.flag[device_name]
+        del shard.version[device_name]
+        shard.late.pop(device_name, None)
+        self.nbytes -= shard.nbytes.pop(device_name, 0)
+        self._recent.pop(device_name, None)
+        self._seen.pop(device_name, None)
+
+    def flag(self, device_name, default=0):
+        """
+        The flag function returns how many times the message of a device has been replaced.
+
+        :param device_name: The device to look up
+        :param default: Returned when the device is unknown
+        :return: The write counter of the device
+        """
+        return self._shard(device_name).flag.get(device_name, default)
+
+    def changed_since(self, since):
+        """
+        The changed_since function returns the devices updated after a version.
+        It only walks the devices that changed, most recent first, so its cost does not depend on the store size.
+        The returned version is safe to pass back as `since`: no update up to it is missed,
+        some updates after it may be returned twice.
+
+        :param since: A version previously returned by this store, or by the previous process
+        :return: A tuple of (current version, {device_name: measurement})
+        """
+        with self._version_lock:
+            version = self.version
+            changed = []
+            for device_name in reversed(self._recent):
+                if self._recent[device_name] <= since:
+                    break
+                changed.append(device_name)
+        result = {}
+        for device_name in changed:
+            msg_json = self.get(device_name)
+            if msg_json is not None:
+                result[device_name] = msg_json
+        return version, result
+
+    def _count_late(self, shard, device_name, delay):
+        """Classify an older message against the watermark. Runs with the shard lock held."""
+        if self.tolerance is not None and delay <= self.tolerance:
+            shard.out_of_order += 1
+        else:
+            shard.late_total += 1
+            shard.late[device_name] = shard.late.get(device_name, 0) + 1
+
+    @property
+    def late(self):
+        """Number of messages older than the watermark of their device."""
+        return sum(shard.late_total for shard in self._shards)
+
+    @property
+    def out_of_order(self):
+        """Number of older messages that were still within the tolerance."""
+        return sum(shard.out_of_order for shard in self._shards)
+
+    def event_time_ns(self, device_name, default=None):
+        """
+        The event_time_ns function returns the message time of the stored message of a device.
+
+        :param device_name: The device to look up
+        :param default: Returned when the device is unknown
+        :return: The message time in epoch nanoseconds
+        """
+        return self._shard(device_name).time_ns.get(device_name, default)
+
+    def watermark(self, device_name):
+        """
+        The watermark function returns the time below which messages of a device are late.
+
+        :param device_name: The device to look up
+        :return: The watermark in epoch nanoseconds, or None for an unknown device
+        """
+        newest = self.event_time_ns(device_name)
+        if newest is None:
+            return None
+        return newest - (self.tolerance or 0)
+
+    def late_count(self, device_name):
+        """
+        The late_count function returns how many late messages a device sent.
+
+        :param device_name: The device to look up
+        :return: The number of messages that arrived below the watermark of the device
+        """
+        return self._shard(device_name).late.get(device_name, 0)
+
+    def device_version(self, device_name, default=0):
+        """
+        The device_version function returns the store version of the last update of a device.
+
+        :param device_name: The device to look up
+        :param default: Returned when the device is unknown
+        :return: The version of the last update
+        """
+        return self._shard(device_name).version.get(device_name, default)
+
+    def get(self, device_name, default=None):
+        return self._shard(device_name).data.get(device_name, default)
+
+    def snapshot(self):
+        """
+        The snapshot function copies the latest message of every device into a plain dictionary.
+
+        :return: A dictionary of {device_name: measurement}
+        """
+        result = {}
+        for shard in self._shards:
+            with shard.lock:
+                result.update(shard.data)
+        return result
+
+    def shard_items(self):
+        """
+        The shard_items function walks the store one shard at a time, holding each shard lock only to copy references.
+
+        :return: A generator of lists of (device_name, message time in epoch nanoseconds, measurement), one per shard
+        """
+        for shard in self._shards:
+            with shard.lock:
+                items = [(device_name, shard.time_ns[device_name], msg_json)
+                         for device_name, msg_json in shard.data.items()]
+            yield items
+
+    def __getitem__(self, device_name):
+        return self._shard(device_name).data[device_name]
+
+    def __contains__(self, device_name):
+        return device_name in self._shard(device_name).data
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self._shards)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def close(self):
+        """Release what the backend holds outside the process."""
+
+
+class LatestView(LatestStore):
+    """
+    LatestView is a read-only LatestStore following the store of another process.
+    It keeps the versions of that store, so versions handed out by any process can be passed back as `since`.
+    It has no limits of its own: the devices the writer evicts are dropped by `sync`.
+    """
+
+    read_only = True
+
+    def __init__(self, shards=16, tolerance=None):
+        super().__init__(shards, tolerance)
+        self.version = 0
+
+    def update(self, device_name, msg_json, on_change=None, time_ns=None):
+        raise TypeError("The latest store is written by the process consuming Kafka only")
+
+    def set_limits(self, max_devices=0, ttl=0, memory_budget=0):
+        raise TypeError("The latest store is bounded by the process consuming Kafka only")
+
+    def _drop(self, device_name):
+        """Forget a device the writer evicted, without moving the version. Returns True if it was known."""
+        shard = self._shard(device_name)
+        with shard.lock:
+            if device_name not in shard.data:
+                return False
+            with self._version_lock:
+                self._forget(shard, device_name)
+        if self.on_evict is not None:
+            self.on_evict(device_name)
+        return True
+
+    def sync(self):
+        """
+        The sync function copies the messages the other process stored since the previous sync.
+
+        :return: A list of (device_name, measurement) of the updated devices, in the order they were written
+        """
+        raise NotImplementedError
+
+    def _reset(self):
+        """Forget every device, when the followed store started over."""
+        self._shards = tuple(_Shard() for _ in self._shards)
+        with self._version_lock:
+            self._recent.clear()
+            self._seen.clear()
+            self.nbytes = 0
+        self.version = 0
+
+
+def writer_lock(path):
+    """
+    The writer_lock function elects the process consuming Kafka among the workers of a host.
+    The lock is held until the process closes the returned file descriptor or exits.
+
+    :param path: The lock file
+    :return: The locked file descriptor, or None when another process holds the lock
+    """
+    lock = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock)
+        return None
+    return lock
+
+
+def message_time_ns(msg_json):
+    """
+    The message_time_ns function returns the time of a message in epoch nanoseconds.
+    Messages without a usable time are stamped with the current time.
+
+    :param msg_json: The decoded message
+    :return: The message time in epoch nanoseconds
+    """
+    parsed = parse_time_ns(msg_json.get('time'))
+    return time_ns() if parsed is None else parsed
+
+
+def message_nbytes(msg_json):
+    """
+    The message_nbytes function estimates the memory of a decoded message: its dictionary, its keys and values,
+    and one level into the dictionaries it holds, such as `values`. Objects shared with other messages are counted too.
+
+    :param msg_json: The decoded message
+    :return: The estimated size in bytes
+    """
+    nbytes = getsizeof(msg_json)
+    for key, value in msg_json.items():
+        nbytes += getsizeof(key) + getsizeof(value)
+        if type(value) is dict:
+            nbytes += sum(getsizeof(field) + getsizeof(item) for field, item in value.items())
+    return nbytes
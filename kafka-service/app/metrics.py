@@ -0,0 +1,284 @@
+import threading
+from bisect import bisect_left
+
+"""
+This module provides the Metrics class, a registry of counters, gauges and histograms,
+and KafkaMetrics, the registry behind the /metrics endpoint of the kafka-dispatcher.
+
+Metrics are rendered in the Prometheus text exposition format.
+Counters only go up, so rates such as messages per second are computed by the scraper, e.g.
+rate(kafka_messages_total[1m]). Gauges are either set, or read from a callback at scrape time.
+
+"""
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+END_TO_END_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    """A named metric with label names, holding one value per combination of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}  # {label values: value}
+        if not self.labels:
+            self._values[()] = self._initial()
+
+    def _initial(self):
+        return 0
+
+    def samples(self):
+        """Return a list of (name suffix, {label: value}, value)."""
+        with self._lock:
+            values = list(self._values.items())
+        return [('', dict(zip(self.labels, key)), value) for key, value in values]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """
+        The inc function adds amount to the counter of the given label values.
+
+        :param amount: The increment, never negative
+        :param labels: A tuple of label values, in the order of the label names
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        """
+        The set function sets the gauge of the given label values.
+
+        :param value: The new value
+        :param labels: A tuple of label values, in the order of the label names
+        """
+        with self._lock:
+            self._values[labels] = value
+
+
+class CallbackMetric(_Metric):
+    """A counter or a gauge whose value is owned by another object, and read when scraped."""
+
+    def __init__(self, name, documentation, callback, kind='gauge', labels=()):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if not self.labels:
+            return [('', {}, value)]
+        return [('', dict(zip(self.labels, key)), sample) for key, sample in value.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def _initial(self):
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value, labels=()):
+        """
+        The observe function records one observation.
+
+        :param value: The observed value, such as a duration in seconds
+        :param labels: A tuple of label values, in the order of the label names
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = self._initial()
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, (counts, total, count) in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                samples.append(('_bucket', dict(labels, le=_format_value(bound)), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        The summary function estimates quantiles of every label combination from the bucket counts,
+        interpolating linearly inside a bucket like histogram_quantile does in Prometheus.
+        A quantile falling in the +Inf bucket is reported as the largest bound.
+
+        :param quantiles: The quantiles to estimate, between 0 and 1
+        :return: A dictionary of {label values: {'count': n, 'mean': seconds, 'p50': seconds, ...}}
+        """
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        summary = {}
+        for key, (counts, total, count) in values:
+            if not count:
+                continue
+            entry = summary[key] = {'count': count, 'mean': total / count}
+            for q in quantiles:
+                entry[f"p{q * 100:g}"] = self._quantile(counts, q * count)
+        return summary
+
+    def _quantile(self, counts, rank):
+        cumulative = 0
+        for index, bucket in enumerate(counts):
+            if bucket and cumulative + bucket >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket
+            cumulative += bucket
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Metrics is a registry of metrics, rendered together by `render`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # {name: metric}, in registration order
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, callback, kind='gauge', labels=()):
+        """
+        The callback function registers a metric read from callback when scraped.
+
+        :param name: The metric name
+        :param documentation: The HELP text
+        :param callback: Returns the value, or a dictionary of {label values: value} when labels are given
+        :param kind: 'gauge' or 'counter'
+        :param labels: The label names
+        :return: The metric
+        """
+        return self._register(CallbackMetric(name, documentation, callback, kind, labels))
+
+    def render(self):
+        """
+        The render function returns every metric in the Prometheus text exposition format.
+
+        :return: The exposition as a string
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+class KafkaMetrics(Metrics):
+    """
+    KafkaMetrics is the registry of the kafka-dispatcher, with the metrics of the consumer path as attributes.
+    The KafkaStreamHandler adds the gauges read from its own state.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = self.counter('kafka_messages_total', 'Messages consumed', ('topic',))
+        self.bytes = self.counter('kafka_bytes_total', 'Bytes of message values consumed', ('topic',))
+        self.decode_seconds = self.histogram('kafka_decode_seconds', 'Time spent decoding the messages of a poll')
+        self.flatten_seconds = self.histogram('kafka_flatten_seconds', 'Time spent flattening the messages of a poll')
+        self._lags = {}  # {consumer: {(topic, partition): lag}}, in the order of their last statistics
+        self.consumer_lag = self.callback('kafka_consumer_lag',
+                                          'Consumer lag in messages, from the librdkafka statistics',
+                                          self._merged_lag, labels=('topic', 'partition'))
+        self.rebalances = self.counter('kafka_rebalances_total', 'Partition assignments received by the consumer')
+        self.resets = self.counter('kafka_consumer_resets_total', 'Times the consumer was closed and recreated')
+        self.dead_letters = self.counter('kafka_dead_letters_total', 'Messages quarantined instead of processed',
+                                         ('topic', 'reason'))
+        self.catchup_active = self.gauge('kafka_catchup_active', '1 while the consumer catches up after a rewind')
+        self.catchup_messages = self.counter('kafka_catchup_messages_total', 'Messages consumed while catching up')
+        self.catchup_seconds = self.gauge('kafka_catchup_seconds', 'Duration of the last catch-up')
+        self.catchup_rate = self.gauge('kafka_catchup_messages_per_second', 'Throughput of the last catch-up')
+        self.latency = self.histogram('kafka_latency_seconds',
+                                      'Latency of the messages through a stage: produce, store or emit',
+                                      ('stage', 'topic', 'device_class'), buckets=END_TO_END_BUCKETS)
+
+    def set_consumer_lag(self, consumer, lag):
+        """
+        The set_consumer_lag function records the lag reported by the statistics of one consumer.
+        Each consumer thread reports the partitions assigned to it, the reports are merged when scraped.
+
+        :param consumer: The consumer reporting, any hashable object
+        :param lag: A dictionary of {(topic, partition): lag in messages}, see kafka_handler.consumer_lag
+        """
+        with self._lock:
+            self._lags.pop(consumer, None)
+            self._lags[consumer] = lag
+
+    def drop_consumer_lag(self, consumer):
+        """
+        The drop_consumer_lag function forgets the lag of a consumer that was closed.
+
+        :param consumer: The consumer passed to set_consumer_lag
+        """
+        with self._lock:
+            self._lags.pop(consumer, None)
+
+    def _merged_lag(self):
+        """The lag of every partition, from the newest statistics reporting it after a rebalance moved it."""
+        with self._lock:
+            reports = list(self._lags.values())
+        merged = {}
+        for lag in reports:
+            merged.update(lag)
+        return merged
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(value)
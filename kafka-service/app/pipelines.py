@@ -0,0 +1,176 @@
+import json
+import threading
+
+"""
+This module provides the PipelineRegistry class, which holds the processing pipeline of every consumed topic.
+
+A pipeline is the ordered subset of the stages below that messages of its topic go through:
+    decode   parse the message value and find its device, always on
+    flatten  flatten the nested values, off for topics whose payloads are small or already flat
+    filter   keep only the devices starting with one of `devices`, and only the `fields` listed
+    store    newest-wins write to the latest store named `store`, always on
+    fanout   append to the history and publish to the stream subscribers, only for the main store
+             since they are keyed by device name like /latest, other stores skip it
+Topics of the registry are the topics the consumer subscribes to. The consumer thread compares
+the registry version with the one it subscribed with, so topics can be added or removed at runtime.
+
+"""
+
+STAGES = ('decode', 'flatten', 'filter', 'store', 'fanout')
+DEFAULT_STAGES = ('decode', 'flatten', 'store', 'fanout')
+MAIN_STORE = 'latest'
+
+
+class Pipeline:
+    """The stages applied to the messages of one topic."""
+
+    __slots__ = ('topic', 'stages', 'store', 'devices', 'fields', 'flatten', 'filter', 'fanout')
+
+    def __init__(self, topic, stages=DEFAULT_STAGES, store=MAIN_STORE, devices=None, fields=None):
+        """
+        Instantiated the class.
+
+        :param topic: The Kafka topic
+        :param stages: The stages to run, a subset of STAGES, run in the order of STAGES
+        :param store: The name of the latest store the messages are written to, MAIN_STORE is the one behind /latest
+        :param devices: With the filter stage, the device name prefixes to keep, None keeps every device
+        :param fields: With the filter stage, the flattened fields to keep, None keeps every field
+        """
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unsupported stages {sorted(unknown)}, use some of {STAGES}")
+        if not topic or not isinstance(topic, str):
+            raise ValueError("A pipeline needs a topic")
+        if not store or not isinstance(store, str):
+            raise ValueError("A pipeline needs a store name")
+        self.topic = topic
+        self.stages = tuple(stage for stage in STAGES if stage in stages or stage in ('decode', 'store'))
+        if store != MAIN_STORE:
+            self.stages = tuple(stage for stage in self.stages if stage != 'fanout')
+        self.store = store
+        self.devices = tuple(devices) if devices else None
+        self.fields = frozenset(fields) if fields else None
+        self.flatten = 'flatten' in self.stages
+        self.filter = 'filter' in self.stages and (self.devices is not None or self.fields is not None)
+        self.fanout = 'fanout' in self.stages
+
+    def accepts(self, device_name):
+        """
+        The accepts function tells whether the filter stage keeps the messages of a device.
+
+        :param device_name: The device key of the message
+        :return: True if the message goes on to the store
+        """
+        return self.devices is None or device_name.startswith(self.devices)
+
+    def select(self, values):
+        """
+        The select function applies the field filter to the values of a message.
+
+        :param values: The values of the message
+        :return: The values restricted to `fields`
+        """
+        if self.fields is None or type(values) is not dict:
+            return values
+        return {field: value for field, value in values.items() if field in self.fields}
+
+    def describe(self):
+        """
+        The describe function returns the pipeline as the JSON accepted by PipelineRegistry.add.
+
+        :return: A dictionary
+        """
+        return {
+            'topic': self.topic,
+            'stages': list(self.stages),
+            'store': self.store,
+            'devices': list(self.devices) if self.devices is not None else None,
+            'fields': sorted(self.fields) if self.fields is not None else None,
+        }
+
+
+class PipelineRegistry:
+    """
+    PipelineRegistry maps every consumed topic to its Pipeline.
+    Readers look pipelines up without locking, writers replace the whole mapping.
+    """
+
+    def __init__(self, pipelines=()):
+        """
+        Instantiated the class.
+
+        :param pipelines: The initial Pipeline objects
+        """
+        self._lock = threading.Lock()
+        self._pipelines = {pipeline.topic: pipeline for pipeline in pipelines}
+        self.version = 0  # incremented when the topics change, the consumer subscribes again
+
+    @classmethod
+    def from_config(cls, topics, overrides=''):
+        """
+        The from_config function builds the registry from the settings of the service.
+
+        :param topics: Comma-separated topics, consumed with the default stages
+        :param overrides: JSON of {topic: {"stages": [...], "store": ..., "devices": [...], "fields": [...]}},
+            for topics needing other stages, which are consumed too
+        :return: A PipelineRegistry
+        """
+        pipelines = {topic.strip(): Pipeline(topic.strip()) for topic in topics.split(',') if topic.strip()}
+        for topic, options in (json.loads(overrides) if overrides else {}).items():
+            pipelines[topic] = Pipeline(topic, **options)
+        return cls(pipelines.values())
+
+    def get(self, topic):
+        return self._pipelines.get(topic)
+
+    def store_of(self, topic):
+        """
+        The store_of function returns the store name of the messages of a topic.
+
+        :param topic: The Kafka topic
+        :return: The store name, or None when the topic has no pipeline
+        """
+        pipeline = self._pipelines.get(topic)
+        return pipeline.store if pipeline is not None else None
+
+    def topics(self):
+        return list(self._pipelines)
+
+    def add(self, pipeline):
+        """
+        The add function registers the pipeline of a topic, replacing the previous one.
+
+        :param pipeline: The Pipeline
+        """
+        with self._lock:
+            pipelines = dict(self._pipelines)
+            new_topic = pipeline.topic not in pipelines
+            pipelines[pipeline.topic] = pipeline
+            self._pipelines = pipelines
+            if new_topic:
+                self.version += 1
+
+    def remove(self, topic):
+        """
+        The remove function stops consuming a topic.
+
+        :param topic: The Kafka topic
+        :return: True if the topic had a pipeline
+        """
+        with self._lock:
+            if topic not in self._pipelines:
+                return False
+            pipelines = dict(self._pipelines)
+            del pipelines[topic]
+            self._pipelines = pipelines
+            self.version += 1
+            return True
+
+    def describe(self):
+        return [pipeline.describe() for pipeline in self._pipelines.values()]
+
+    def __contains__(self, topic):
+        return topic in self._pipelines
+
+    def __len__(self):
+        return len(self._pipelines)
@@ -0,0 +1,180 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+from .broadcaster import Broadcaster
+
+"""
+This module provides the PresenceIndex class, which knows when every device was last seen
+and which devices went silent.
+
+A device is seen when the dispatcher stores one of its messages, at the receive time.
+Devices are kept in two dictionaries ordered by last seen time, the online ones and the offline ones.
+As receive times only grow, seeing a device moves it to the end of the online dictionary, so an update is O(1),
+and the devices silent for more than a duration are a prefix of each dictionary, so listing them
+costs the number of devices listed, not the number of devices.
+
+A background thread moves the devices silent for `offline_after` seconds to the offline dictionary
+every `interval` seconds, and publishes the transitions found since the previous check as one message:
+    {"time": epoch seconds, "online": [[device_name, last_seen], ...], "offline": [[device_name, last_seen], ...]}
+A device seen for the first time, or seen again after going offline, is online.
+
+"""
+
+CHANNEL = 'presence'
+
+
+class PresenceIndex:
+    """
+    PresenceIndex is the last seen index of the devices, with the stream of their online and offline transitions.
+    """
+
+    def __init__(self, offline_after=30, interval=1, queue_size=64):
+        """
+        Instantiated the class.
+
+        :param offline_after: Seconds without any message after which a device is offline
+        :param interval: Seconds between two checks for offline devices, and between two transition messages
+        :param queue_size: Transition messages queued per stream client, the oldest ones are dropped past it
+        """
+        self.offline_after = offline_after
+        self.interval = interval
+        self.broadcaster = Broadcaster(queue_size=queue_size, overflow='drop-oldest')
+        self.running = False
+        self.latest = None  # the latest transition message, the first frame of a new stream
+        self._lock = threading.Lock()
+        self._online = OrderedDict()  # {device_name: last seen}, the least recently seen device first
+        self._offline = OrderedDict()  # {device_name: last seen}, the least recently seen device first
+        self._came_online = {}  # {device_name: last seen} since the last check
+        self._last_seen = 0.0  # the latest time given to a device, so that the order holds if the clock goes back
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def touch(self, device_name, now=None):
+        """
+        The touch function records that a device was just seen.
+
+        :param device_name: The device
+        :param now: The receive time in epoch seconds, defaults to now
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            now = self._last_seen = max(now, self._last_seen)
+            online = self._online
+            if device_name in online:
+                online.move_to_end(device_name)
+            else:
+                self._offline.pop(device_name, None)
+                self._came_online[device_name] = now
+            online[device_name] = now
+
+    def stale(self, older_than, now=None, limit=None):
+        """
+        The stale function lists the devices not seen for `older_than` seconds, the least recently seen first.
+
+        :param older_than: Seconds of silence
+        :param now: The current epoch time, defaults to now
+        :param limit: Maximum number of devices returned
+        :return: A list of [device_name, last_seen]
+        """
+        if now is None:
+            now = time()
+        cutoff = now - older_than
+        stale = []
+        with self._lock:
+            # the offline devices went silent before any of the online devices
+            for devices in (self._offline, self._online):
+                for device_name, last_seen in devices.items():
+                    if last_seen >= cutoff or limit is not None and len(stale) >= limit:
+                        break
+                    stale.append([device_name, last_seen])
+        return stale
+
+    def check(self, now=None):
+        """
+        The check function moves the devices silent for `offline_after` seconds to the offline devices,
+        and publishes the transitions since the previous check to the stream subscribers.
+
+        :param now: The current epoch time, defaults to now
+        :return: The transition message, or None if no device changed
+        """
+        if now is None:
+            now = time()
+        cutoff = now - self.offline_after
+        went_offline = []
+        with self._lock:
+            online = self._online
+            while online:
+                device_name, last_seen = next(iter(online.items()))
+                if last_seen >= cutoff:
+                    break
+                del online[device_name]
+                self._offline[device_name] = last_seen
+                if self._came_online.pop(device_name, None) is None:
+                    went_offline.append([device_name, last_seen])
+            came_online, self._came_online = self._came_online, {}
+        if not went_offline and not came_online:
+            return None
+        message = {'time': now, 'online': [list(item) for item in came_online.items()], 'offline': went_offline}
+        self.latest = message
+        self.broadcaster.publish(CHANNEL, message)
+        return message
+
+    def discard(self, device_name):
+        """
+        The discard function forgets a device, it is online again if it is seen later.
+
+        :param device_name: The device
+        """
+        with self._lock:
+            self._online.pop(device_name, None)
+            self._offline.pop(device_name, None)
+            self._came_online.pop(device_name, None)
+
+    def subscribe(self, encoding='json'):
+        """
+        The subscribe function is a generator of SSE frames of the transition messages.
+        Its first frame is the latest transition message, if any was published.
+
+        :param encoding: The wire encoding of the frames, see broadcaster.ENCODINGS
+        :return: A generator of SSE frames
+        """
+        return self.broadcaster.subscribe(CHANNEL, self.latest, encoding=encoding)
+
+    def subscribe_async(self, encoding='json'):
+        """The asyncio variant of subscribe."""
+        return self.broadcaster.subscribe_async(CHANNEL, self.latest, encoding=encoding)
+
+    def counts(self):
+        return {'online': len(self._online), 'offline': len(self._offline)}
+
+    def start(self):
+        """
+        The start function starts the background thread checking for offline devices.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.running = True
+        self.broadcaster.running = True
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        The stop function stops the background thread and ends the streams.
+        """
+        self.running = False
+        self._stopped.set()
+        self.broadcaster.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def __len__(self):
+        return len(self._online) + len(self._offline)
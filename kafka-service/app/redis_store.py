@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+
+from .latest_store import LatestStore, LatestView, writer_lock
+from .snapshot import dumps
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is listed in requirements.txt
+    orjson = None
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is listed in requirements.txt
+    redis = None
+
+"""
+This module provides the Redis backend of the latest store, for processes that are not on the host
+of the kafka-dispatcher, or that should keep the latest data when it restarts.
+
+The process consuming Kafka writes a RedisLatestStore, which batches the stored messages and sends them
+every `flush_interval` seconds in one redis-py transaction pipeline (MULTI/EXEC),
+so the cost per message does not include a round trip.
+Any other process reads the same keys with a RedisLatestView, or directly:
+    <prefix>:latest    hash of {device_name: JSON [version, time_ns, flag, measurement]}, read with HMGET or HGETALL
+    <prefix>:changes   sorted set of the device names scored by the version of their last update
+    <prefix>:version   the version of the last flush
+    <prefix>:evicted   sorted set of the device names the writer evicted, scored by the version of the eviction,
+                       the newest EVICTED_KEPT only. The views drop them, they are gone from the two keys above
+
+"""
+
+EVICTED_KEPT = 65536  # evictions kept for the views, a view lagging more evictions behind keeps the devices it missed
+
+
+def open_redis_store(url, prefix='kafka-latest', lock_path=None, flush_interval=0.05, shards=16, tolerance=None):
+    """
+    The open_redis_store function opens the Redis backend of the latest store.
+    The process holding `lock_path` writes it, the other workers of the host follow it.
+
+    :param url: The Redis URL
+    :param prefix: The prefix of the keys
+    :param lock_path: The lock file electing the writer, defaults to /tmp/<prefix>.lock
+    :param flush_interval: Seconds between two flushes of the writer
+    :param shards: Number of independently locked shards in the local copy of the store
+    :param tolerance: Allowed out-of-order delay in nanoseconds, see LatestStore
+    :return: A RedisLatestStore in the writer, a RedisLatestView in every other process
+    """
+    if redis is None:
+        raise RuntimeError("The redis backend needs the redis package, see requirements.txt")
+    lock = writer_lock(lock_path or f"/tmp/{prefix}.lock")
+    if lock is None:
+        return RedisLatestView(redis.Redis.from_url(url, socket_timeout=5), prefix, shards, tolerance)
+    return RedisLatestStore(redis.Redis.from_url(url, socket_timeout=5), prefix, flush_interval, lock, shards=shards,
+                            tolerance=tolerance)
+
+
+class RedisLatestStore(LatestStore):
+    """
+    RedisLatestStore is the LatestStore of the writer process, the stored messages are flushed to Redis
+    from a background thread. A device updated several times between two flushes is only sent once.
+    The devices already in Redis are restored when it starts.
+    """
+
+    def __init__(self, client, prefix='kafka-latest', flush_interval=0.05, lock=None, shards=16, tolerance=None):
+        """
+        Instantiated the class.
+
+        :param client: A redis.Redis client
+        :param prefix: The prefix of the keys
+        :param flush_interval: Seconds between two flushes
+        :param lock: The file descriptor returned by writer_lock, released by close
+        :param shards: Number of independently locked shards
+        :param tolerance: Allowed out-of-order delay in nanoseconds
+        """
+        super().__init__(shards, tolerance)
+        self.client = client
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.errors = 0
+        self._lock_fd = lock
+        self._pending = {}  # {device_name: (version, time_ns, flag, measurement)} stored since the last flush
+        self._evicted = {}  # {device_name: version} evicted since the last flush
+        self._flush_lock = threading.Lock()
+        self._restore()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _restore(self):
+        try:
+            version = self.client.get(f"{self.prefix}:version")
+            records = self.client.hgetall(f"{self.prefix}:latest")
+        except redis.RedisError as e:
+            print(f"Error restoring the latest store from Redis: {e}")
+            return
+        self.version = max(self.version, int(version or 0))
+        restored = sorted((_loads(value) + [name.decode('utf-8')] for name, value in records.items()),
+                          key=lambda record: record[0])
+        for record_version, time_ns, flag, msg_json, device_name in restored:
+            self._apply(device_name, msg_json, time_ns, flag, record_version)
+        print(f"Redis store: {len(restored)} devices restored from {self.prefix}:latest")
+
+    def _stored(self, device_name, msg_json, time_ns, flag, version):
+        self._pending[device_name] = (version, time_ns, flag, msg_json)
+
+    def _removed(self, device_name, version):
+        self._pending.pop(device_name, None)
+        self._evicted[device_name] = version
+
+    def flush(self):
+        """
+        The flush function sends the devices stored and evicted since the previous flush in one transaction.
+        The evictions go first, so a device evicted and stored again since is sent as stored.
+
+        :return: The number of devices sent
+        """
+        with self._flush_lock:
+            with self._version_lock:
+                pending, self._pending = self._pending, {}
+                evicted, self._evicted = self._evicted, {}
+            if not pending and not evicted:
+                return 0
+            pipeline = self.client.pipeline(transaction=True)
+            if evicted:
+                pipeline.hdel(f"{self.prefix}:latest", *evicted)
+                pipeline.zrem(f"{self.prefix}:changes", *evicted)
+                pipeline.zadd(f"{self.prefix}:evicted", evicted)
+                pipeline.zremrangebyrank(f"{self.prefix}:evicted", 0, -EVICTED_KEPT - 1)
+            if pending:
+                pipeline.hset(f"{self.prefix}:latest", mapping={device_name: dumps(record)
+                                                                 for device_name, record in pending.items()})
+                pipeline.zadd(f"{self.prefix}:changes",
+                              {device_name: record[0] for device_name, record in pending.items()})
+            pipeline.set(f"{self.prefix}:version",
+                         max(max(record[0] for record in pending.values()) if pending else 0,
+                             max(evicted.values()) if evicted else 0))
+            try:
+                pipeline.execute()
+            except redis.RedisError as e:
+                self.errors += 1
+                print(f"Error flushing the latest store to Redis: {e}")
+                with self._version_lock:
+                    # keep what was not stored or evicted again since, for the next flush
+                    for device_name in self._evicted:
+                        pending.pop(device_name, None)
+                    pending.update(self._pending)
+                    self._pending = pending
+                    evicted.update(self._evicted)
+                    self._evicted = evicted
+                return 0
+            self.flushes += 1
+            return len(pending) + len(evicted)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Send the last messages, and let another process become the writer."""
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        self.client.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+class RedisLatestView(LatestView):
+    """
+    RedisLatestView follows the keys of the writer in Redis.
+    """
+
+    def __init__(self, client, prefix='kafka-latest', shards=16, tolerance=None):
+        """
+        Instantiated the class.
+
+        :param client: A redis.Redis client
+        :param prefix: The prefix of the keys
+        :param shards: Number of independently locked shards
+        :param tolerance: Allowed out-of-order delay in nanoseconds, only used to answer watermark
+        """
+        super().__init__(shards, tolerance)
+        self.client = client
+        self.prefix = prefix
+
+    def sync(self):
+        try:
+            version = int(self.client.get(f"{self.prefix}:version") or 0)
+            if version == self.version:
+                return []
+            if version < self.version:
+                self._reset()  # the keys were deleted and written again
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.zrangebyscore(f"{self.prefix}:evicted", f"({self.version}", version, withscores=True)
+            pipeline.zrangebyscore(f"{self.prefix}:changes", f"({self.version}", version)
+            evicted, devices = pipeline.execute()
+            values = self.client.hmget(f"{self.prefix}:latest", devices) if devices else []
+        except redis.RedisError as e:
+            print(f"Error reading the latest store from Redis: {e}")
+            return []
+        for device_name, eviction in evicted:
+            device_name = device_name.decode('utf-8')
+            if self.device_version(device_name) < eviction:
+                self._drop(device_name)
+        changes = []
+        for device_name, value in zip(devices, values):
+            if value is None:
+                continue
+            record_version, time_ns, flag, msg_json = _loads(value)
+            device_name = device_name.decode('utf-8')
+            # messages flushed after the version was read are left to the next sync
+            if self.device_version(device_name) < record_version <= version:
+                changes.append((record_version, device_name, msg_json, time_ns, flag))
+        changes.sort(key=lambda record: record[0])
+        for record_version, device_name, msg_json, time_ns, flag in changes:
+            self._apply(device_name, msg_json, time_ns, flag, record_version)
+        self.version = version
+        return [(device_name, msg_json) for _, device_name, msg_json, _, _ in changes]
+
+    def close(self):
+        self.client.close()
+
+
+def _loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
@@ -0,0 +1,312 @@
+import threading
+from time import time
+
+import numpy as np
+
+from .timestamps import parse_duration
+
+"""
+This module provides the RollingStats class, which keeps running statistics of every flattened field of every device.
+
+For each field it keeps, since the first sample and over every window such as 10s, 1m and 5m:
+    count, mean, variance, min and max, updated with Welford's algorithm
+    an exponentially weighted moving average whose time constant is the window
+A window is a ring of `buckets` time buckets, so a sample costs the same whatever the rate,
+and a window covers between `window` and `window` plus one bucket of the most recent samples.
+Buckets are merged with Chan's formula when they are read.
+
+"""
+
+def parse_windows(text):
+    """
+    The parse_windows function reads the windows setting.
+
+    :param text: Comma-separated durations like '10s,1m,5m', a number without unit is in seconds
+    :return: A dictionary of {label: seconds}, in the order of the setting
+    """
+    windows = {}
+    for label in text.split(','):
+        label = label.strip()
+        if not label:
+            continue
+        windows[label] = parse_duration(label)
+    return windows
+
+
+class DeviceStats:
+    """
+    DeviceStats holds the statistics of a single device, one column per flattened field.
+    The count, mean, M2, min and max of the bucket being filled in every window, and of the totals,
+    are stacked in a (5, windows + 1, fields) array, so a sample updates all of them at once.
+    A bucket is copied to the (5, windows, buckets, fields) ring when the next one starts.
+    """
+
+    def __init__(self, windows, buckets):
+        self.lock = threading.Lock()
+        self.windows = np.asarray(windows, dtype=float)
+        self.buckets = buckets
+        self.width = [window / buckets for window in windows]
+        self._tau = self.windows[:, None]  # time constants of the EWMA
+        self.fields = {}  # {field: column index}
+        self.known = {}  # the fields above, and the fields holding text that are skipped
+        self.last_update = 0.0
+        self.reserved = 0  # bytes accounted for this device in the RollingStats budget
+        self.live = _moments((len(windows) + 1, 0))  # the bucket being filled in every window, then the totals
+        self.live_ids = [None] * len(windows)
+        self.moments = _moments((len(windows), buckets, 0))
+        self.bucket_ids = np.full((len(windows), buckets), -1, dtype=np.int64)
+        self.ewma = np.zeros((len(windows), 0))
+        self.ewma_time = np.zeros(0)
+
+    def update(self, timestamp, row):
+        """
+        The update function adds a sample.
+
+        :param timestamp: The message time of the sample, in epoch seconds
+        :param row: The values of the sample as a float array in column order, NaN for missing values
+        """
+        valid = row == row
+        if not valid.all():
+            if not valid.any():
+                return
+            self._update_some(timestamp, row, valid)
+            return
+        with self.lock:
+            self._roll(timestamp)
+            count, mean, m2, minimum, maximum = self.live
+            count += 1
+            delta = row - mean
+            mean += delta / count
+            m2 += delta * (row - mean)
+            np.minimum(minimum, row, out=minimum)
+            np.maximum(maximum, row, out=maximum)
+            self.ewma += -np.expm1(np.minimum(self.ewma_time - timestamp, 0.0) / self._tau) * (row - self.ewma)
+            np.maximum(self.ewma_time, timestamp, out=self.ewma_time)  # a late sample does not move the EWMA back
+            self.last_update = timestamp
+
+    def _update_some(self, timestamp, row, valid):
+        """Same as update, for a sample missing some fields."""
+        x = np.where(valid, row, 0.0)
+        with self.lock:
+            self._roll(timestamp)
+            count, mean, m2, minimum, maximum = self.live
+            count += valid
+            delta = (x - mean) * valid
+            mean += delta / np.maximum(count, 1)
+            m2 += delta * (x - mean)
+            np.fmin(minimum, row, out=minimum)
+            np.fmax(maximum, row, out=maximum)
+            self.ewma += -np.expm1(np.minimum(self.ewma_time - timestamp, 0.0) / self._tau) * (x - self.ewma) * valid
+            self.ewma_time[valid] = np.maximum(self.ewma_time[valid], timestamp)
+            self.last_update = timestamp
+
+    def _roll(self, timestamp):
+        """Move the buckets that are over to the ring, a late sample goes to the current bucket."""
+        for index, width in enumerate(self.width):
+            bucket = int(timestamp // width)
+            live = self.live_ids[index]
+            if live is not None and bucket <= live:
+                continue
+            if live is not None:
+                self.moments[:, index, live % self.buckets] = self.live[:, index]
+                self.bucket_ids[index, live % self.buckets] = live
+            self.live[:, index] = _EMPTY[:, None]
+            self.live_ids[index] = bucket
+
+    def query(self, labels, now):
+        """
+        The query function returns the statistics of every field.
+
+        :param labels: The labels of the windows, in the order of the windows
+        :param now: The current epoch time
+        :return: A dictionary of {field: {'count', 'mean', 'variance', 'min', 'max', 'windows': {label: {...}}}}
+        """
+        with self.lock:
+            self._roll(now)
+            fields = dict(self.fields)
+            total = _summary(*self.live[:, -1])
+            windows = []
+            for index, live in enumerate(self.live_ids):
+                keep = self.bucket_ids[index] >= live - self.buckets
+                buckets = np.concatenate([self.moments[:, index, keep], self.live[:, index, None]], axis=1)
+                windows.append(_summary(*_merge(*buckets), ewma=self.ewma[index]))
+        result = {}
+        for field, column in fields.items():
+            stats = {name: values[column] for name, values in total.items()}
+            if stats['count'] == 0:
+                continue
+            stats['windows'] = {label: {name: values[column] for name, values in window.items()}
+                                for label, window in zip(labels, windows)}
+            result[field] = stats
+        return result
+
+    def add_fields(self, new_fields):
+        """Add a column for each new field. Runs before the first sample holding them."""
+        with self.lock:
+            grow = len(new_fields)
+            self.live = np.concatenate([self.live, _moments(self.live.shape[1:-1] + (grow,))], axis=-1)
+            self.moments = np.concatenate([self.moments, _moments(self.moments.shape[1:-1] + (grow,))], axis=-1)
+            self.ewma = np.concatenate([self.ewma, np.zeros((len(self.windows), grow))], axis=-1)
+            self.ewma_time = np.concatenate([self.ewma_time, np.full(grow, -np.inf)])
+            for field in new_fields:
+                self.known[field] = self.fields[field] = len(self.fields)
+
+    def nbytes_per_field(self):
+        windows = len(self.windows)
+        return (5 * windows * self.buckets + 5 * (windows + 1) + windows + 1) * 8
+
+
+class RollingStats:
+    """
+    RollingStats holds a DeviceStats for every device, within a global memory budget.
+    Devices that do not fit in the budget get no statistics, text fields are skipped.
+    """
+
+    def __init__(self, windows=None, buckets=6, memory_budget=64 * 1024 * 1024):
+        """
+        Instantiated the class.
+
+        :param windows: A dictionary of {label: seconds}, as returned by parse_windows, 10s, 1m and 5m by default
+        :param buckets: Number of time buckets per window
+        :param memory_budget: Maximum number of bytes used by the statistics, 0 disables them
+        """
+        if windows is None:
+            windows = parse_windows('10s,1m,5m')
+        self.windows = windows
+        self.buckets = max(1, buckets)
+        self.memory_budget = memory_budget
+        self.rejected = 0  # number of times new fields did not fit in the budget
+        self._lock = threading.Lock()
+        self._devices = {}  # {device_name: DeviceStats}
+        self._nbytes = 0
+
+    @property
+    def enabled(self):
+        return self.memory_budget > 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def update(self, device_name, values, timestamp=None):
+        """
+        The update function adds the flattened values of a device to its statistics.
+        Calls for the same device must not run concurrently, the latest store guarantees that
+        by calling it under the shard lock of the device.
+
+        :param device_name: The device the values belong to
+        :param values: The flattened values of the message
+        :param timestamp: The epoch time of the sample, defaults to now
+        """
+        if not self.enabled or type(values) is not dict:
+            return
+        if timestamp is None:
+            timestamp = time()
+        stats = self._devices.get(device_name)
+        if stats is None:
+            if not any(type(value) in (int, float) for value in values.values()):
+                return  # nothing to track, a device only sending text gets no DeviceStats
+            stats = DeviceStats(list(self.windows.values()), self.buckets)
+        if not stats.known.keys() >= values.keys():
+            if not self._add_fields(device_name, stats, values):
+                return
+        try:
+            row = np.array([values.get(field) for field in stats.fields], dtype=float)  # None becomes NaN
+        except (TypeError, ValueError):
+            row = np.array([value if type(value) in (int, float) else None
+                            for value in map(values.get, stats.fields)], dtype=float)
+        stats.update(timestamp, row)
+
+    def query(self, device_name):
+        """
+        The query function returns the statistics of a device.
+
+        :param device_name: The device to look up
+        :return: A dictionary of {'time': now, 'windows': {label: seconds}, 'fields': {field: statistics}},
+            or None for an unknown device
+        """
+        stats = self._devices.get(device_name)
+        if stats is None or not stats.fields:
+            return None
+        now = time()
+        return {
+            'time': now,
+            'windows': dict(self.windows),
+            'fields': stats.query(list(self.windows), now),
+        }
+
+    def discard(self, device_name):
+        """
+        The discard function drops the statistics of a device and releases its memory.
+
+        :param device_name: The device to drop
+        """
+        with self._lock:
+            stats = self._devices.pop(device_name, None)
+            if stats is not None:
+                self._nbytes -= stats.reserved
+
+    def __contains__(self, device_name):
+        return device_name in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _add_fields(self, device_name, stats, values):
+        """Add the new numeric fields of values to stats, return False if the device has no field to update."""
+        new_fields = []
+        for field, value in values.items():
+            if field in stats.known:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                new_fields.append(field)
+            else:
+                stats.known[field] = None  # text and flags are not tracked
+        if new_fields:
+            nbytes = stats.nbytes_per_field() * len(new_fields)
+            with self._lock:
+                if self._nbytes + nbytes > self.memory_budget:
+                    self.rejected += 1
+                    return bool(stats.fields)
+                self._nbytes += nbytes
+                stats.reserved += nbytes
+                self._devices.setdefault(device_name, stats)
+            stats.add_fields(new_fields)
+        return bool(stats.fields)
+
+
+_EMPTY = np.array([0.0, 0.0, 0.0, np.inf, -np.inf])  # count, mean, M2, min and max of no sample
+
+
+def _moments(shape):
+    """Return the stacked count, mean, M2, min and max arrays of buckets without samples."""
+    return np.broadcast_to(_EMPTY.reshape((5,) + (1,) * len(shape)), (5,) + shape).copy()
+
+
+def _merge(count, mean, m2, minimum, maximum):
+    """Merge bucket moments, one bucket per row, with Chan's formula."""
+    total = count.sum(axis=0)
+    safe = np.maximum(total, 1)
+    merged_mean = (count * mean).sum(axis=0) / safe
+    merged_m2 = (m2 + count * (mean - merged_mean) ** 2).sum(axis=0)
+    return total, merged_mean, merged_m2, minimum.min(axis=0, initial=np.inf), maximum.max(axis=0, initial=-np.inf)
+
+
+def _summary(count, mean, m2, minimum, maximum, ewma=None):
+    """Turn moment columns into lists of JSON-friendly statistics, None where there is no sample."""
+    empty = count == 0
+    summary = {
+        'count': count.astype(np.int64).tolist(),
+        'mean': _to_list(np.where(empty, np.nan, mean)),
+        'variance': _to_list(np.where(empty, np.nan, m2 / np.maximum(count, 1))),
+        'min': _to_list(np.where(empty, np.nan, minimum)),
+        'max': _to_list(np.where(empty, np.nan, maximum)),
+    }
+    if ewma is not None:
+        summary['ewma'] = _to_list(ewma)
+    return summary
+
+
+def _to_list(column):
+    """Convert a float column to a list, with NaN turned into None so it serializes to JSON null."""
+    return [None if value != value else value for value in column.tolist()]
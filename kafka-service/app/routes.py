@@ -1,9 +1,13 @@
-import io
 import logging
 
 from flask import Blueprint, request, jsonify, Response, current_app
 
+from .broadcaster import OVERFLOW_POLICIES, available_encodings
+from .decimation import parse_decimation, parse_frequency
 from .kafka_handler import KafkaService, KafkaStreamHandler
+from .pipelines import Pipeline
+from .snapshot import dumps
+from .timestamps import parse_duration
 
 kafka_blueprint = Blueprint('data', __name__, url_prefix="/api/v1/kafka-stream/")
 
@@ -28,6 +32,16 @@ def test_connection():
 def get_latest_data_all():
     """
     Get the latest data for all sensors.
+    The body is a pre-encoded snapshot refreshed at most once per KAFKA_SNAPSHOT_INTERVAL,
+    served with an ETag so that polls with a matching If-None-Match get a 304,
+    and gzip-compressed when the client accepts it.
+    The X-Latest-Version header holds the store version of the snapshot.
+
+    With `?since=<version>`, only the devices updated after that version are returned,
+    as {"version": <current version>, "data": {device_name: measurement}}.
+    Pass the returned version as `since` on the next poll.
+
+    With `?store=<name>`, the devices of the store a topic pipeline writes to are returned instead.
         ---
         tags:
           - Data Retrieval Functions
@@ -41,8 +55,28 @@ def get_latest_data_all():
     if not kafka_handler.running:
         return {'status': 'No stream running'}
 
-    message = kafka_handler.get_latest_data_for_all()
-    return message
+    store = request.args.get('store', default=None)
+    if store is not None:
+        if store not in kafka_handler.stores:
+            return {'status': 'Unknown store'}, 404
+        return Response(dumps(kafka_handler.stores[store].snapshot()), mimetype='application/json')
+
+    since = request.args.get('since', default=None, type=int)
+    if since is not None:
+        return Response(dumps(kafka_handler.get_latest_data_since(since)), mimetype='application/json')
+
+    snapshot = kafka_handler.snapshot.get()
+    gzipped = snapshot.gzipped if 'gzip' in request.accept_encodings else None
+    if gzipped is not None:
+        response = Response(gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(snapshot.etag + '-gzip')
+    else:
+        response = Response(snapshot.body, mimetype='application/json')
+        response.set_etag(snapshot.etag)
+    response.vary.add('Accept-Encoding')
+    response.headers['X-Latest-Version'] = str(snapshot.version)
+    return response.make_conditional(request)
 
 
 @kafka_blueprint.route('/<device_name>', methods=['GET'])
@@ -57,6 +91,28 @@ def subscribe_to_device(device_name):
     If no frequency is specified, the default frequency is 0,
     which means that the stream will be sampling base on the rate of the data being sent to the kafka.
     If the data rate is too high, it is recommended to specify a frequency to down sample the stream.
+    All the clients of a device asking for the same frequency share one ticker aligned on the wall clock,
+    so they receive the same samples.
+
+    Instead of a frequency, the optional argument decimate selects how the updates are thinned out:
+        nth:<n>                every n-th update
+        last:<duration>        the last update of every time bucket, like frequency
+        envelope:<duration>    per time bucket, the mean of every numeric field with its min and max,
+                               and the number of samples, so short peaks are not hidden
+        deadband:<threshold>   only the updates where a numeric field moved by more than threshold
+    Each decimation is computed once per device and spec, whatever the number of clients.
+
+    The optional argument encoding selects the wire format of the frames:
+        json     compact JSON, the default
+        msgpack  base64 encoded MessagePack
+        delta    a `full` event with the whole message, then `delta` events with only the changed keys
+    Each update is encoded once per encoding, whatever the number of clients.
+
+    The optional argument overflow selects what happens when the client falls behind:
+        coalesce     only the newest update is kept, the default unless KAFKA_STREAM_OVERFLOW says otherwise
+        drop-oldest  up to KAFKA_STREAM_QUEUE_SIZE updates are queued, the oldest ones are dropped
+        disconnect   the stream ends once KAFKA_STREAM_QUEUE_SIZE updates are pending
+    Clients leaving updates pending for KAFKA_STREAM_SLOW_TIMEOUT seconds are disconnected.
 
     :param device_name: Specify the device to subscribe to
     :return: A response that contains the stream of data
@@ -67,12 +123,31 @@ def subscribe_to_device(device_name):
     print(f"Received a POST request on endpoint {endpoint} from IP {remote_ip}")
     global kafka_service
     global kafka_handler
-    frequency = int(request.args.get('frequency', default=0))
+    frequency = request.args.get('frequency', default=None)
+    encoding = request.args.get('encoding', default='json')
+    overflow = request.args.get('overflow', default=None)
+    decimation = request.args.get('decimate', default=None)
     if not kafka_handler.running:
         return {'status': 'No stream running'}
-
-    current_app.logger.info(f"Subscribing to {device_name} with frequency {frequency}")
-    response = Response(kafka_handler.get_latest_data_stream(device_name, frequency), content_type='text/event-stream')
+    if encoding not in available_encodings():
+        return {'status': f"Unsupported encoding, use one of {', '.join(available_encodings())}"}, 400
+    if overflow is not None and overflow not in OVERFLOW_POLICIES:
+        return {'status': f"Unsupported overflow policy, use one of {', '.join(OVERFLOW_POLICIES)}"}, 400
+    try:
+        frequency = parse_frequency(frequency)
+    except ValueError as e:
+        return {'status': str(e)}, 400
+    if decimation is not None:
+        if frequency:
+            return {'status': "Use either frequency or decimate"}, 400
+        try:
+            parse_decimation(decimation)
+        except ValueError as e:
+            return {'status': str(e)}, 400
+
+    current_app.logger.info(f"Subscribing to {device_name} with frequency {frequency} and encoding {encoding}")
+    response = Response(kafka_handler.get_latest_data_stream(device_name, frequency, encoding, overflow, decimation),
+                        content_type='text/event-stream')
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['Connection'] = 'keep-alive'
 
@@ -99,7 +174,7 @@ def get_latest_data(device_name):
     if not kafka_handler.running:
         return {'status': 'No stream running'}
 
-    if device_name in kafka_handler.data and device_name in kafka_handler.flag:
+    if device_name in kafka_handler.data:
         message = kafka_handler.get_latest_data_for_single(str(device_name))
         current_app.logger.setLevel(logging.WARNING)
         return message, 200
@@ -107,6 +182,194 @@ def get_latest_data(device_name):
     return {'status': 'Device not ready'}, 404
 
 
+@kafka_blueprint.route('/history/<string:device_name>', methods=['GET'])
+def get_history(device_name):
+    """
+    The get_history function returns the recent samples of a device kept in memory by the kafka-dispatcher.
+        Args:
+            device_name (str): The name of the device to get the history from.
+            seconds (float): Optional query parameter, how many seconds of history to return.
+
+    :param device_name: Get the history for a specific device
+    :return: The message times and the values of every flattened field, oldest first
+    """
+    global kafka_handler
+
+    if not kafka_handler.running:
+        return {'status': 'No stream running'}
+
+    seconds = request.args.get('seconds', default=None, type=float)
+    history = kafka_handler.get_history(device_name, seconds)
+    if history is None:
+        return {'status': 'Device not ready'}, 404
+    return history, 200
+
+
+@kafka_blueprint.route('/stats/<string:device_name>', methods=['GET'])
+def get_stats(device_name):
+    """
+    The get_stats function returns the rolling statistics of a device kept in memory by the kafka-dispatcher.
+        For every numeric field: count, mean, variance, min and max since the first sample,
+        and the same plus an EWMA over every window of KAFKA_STATS_WINDOWS.
+
+    :param device_name: Get the statistics for a specific device
+    :return: The statistics of every numeric field, null where a window has no sample
+    """
+    global kafka_handler
+
+    if not kafka_handler.running:
+        return {'status': 'No stream running'}
+
+    stats = kafka_handler.get_stats(device_name)
+    if stats is None:
+        return {'status': 'Device not ready'}, 404
+    return stats, 200
+
+
+@kafka_blueprint.route('/stale', methods=['GET'])
+def get_stale_devices():
+    """
+    The get_stale_devices function lists the devices that went silent, the least recently seen first.
+        Args:
+            older_than (str): Optional query parameter, a duration like 30s or 5m, defaults to KAFKA_OFFLINE_AFTER.
+            limit (int): Optional query parameter, the maximum number of devices returned.
+
+    :return: The devices not seen for older_than, with the epoch time they were last seen
+    """
+    global kafka_handler
+
+    if not kafka_handler.running:
+        return {'status': 'No stream running'}
+
+    older_than = request.args.get('older_than', default=None)
+    try:
+        older_than = parse_duration(older_than) if older_than is not None else None
+    except ValueError as e:
+        return {'status': str(e)}, 400
+    limit = request.args.get('limit', default=None, type=int)
+    return kafka_handler.get_stale_devices(older_than, limit), 200
+
+
+@kafka_blueprint.route('/presence', methods=['GET'])
+def subscribe_to_presence():
+    """
+    This allows client to get the online and offline transitions of the devices as a stream.
+    A device goes offline after KAFKA_OFFLINE_AFTER seconds without any message, and online when it is seen again.
+    The transitions found in the same check, every KAFKA_PRESENCE_INTERVAL seconds, are sent as one event:
+        {"time": ..., "online": [[device_name, last_seen], ...], "offline": [[device_name, last_seen], ...]}
+    The first event is the latest one published. The optional argument encoding selects json or msgpack.
+
+    :return: A response that contains the stream of transitions
+    """
+    global kafka_handler
+    encoding = request.args.get('encoding', default='json')
+    if not kafka_handler.running:
+        return {'status': 'No stream running'}
+    if encoding not in available_encodings():
+        return {'status': f"Unsupported encoding, use one of {', '.join(available_encodings())}"}, 400
+
+    response = Response(kafka_handler.presence.subscribe(encoding), content_type='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Connection'] = 'keep-alive'
+    return response
+
+
+@kafka_blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    The get_metrics function returns the metrics of the kafka-dispatcher in the Prometheus text format:
+    messages and bytes consumed per topic, decode and flatten times, consumer lag per partition,
+    rebalances, consumer resets, stream subscribers and the size of the latest store.
+
+    :return: The metrics as text/plain
+    """
+    global kafka_handler
+
+    return Response(kafka_handler.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@kafka_blueprint.route('/admin/topics', methods=['GET'])
+def list_topics():
+    """
+    The list_topics function returns the consumed topics and the pipeline of each one.
+
+    :return: A list of pipelines, as accepted by add_topic
+    """
+    global kafka_handler
+
+    return jsonify(kafka_handler.pipelines.describe())
+
+
+@kafka_blueprint.route('/admin/topics/<string:topic>', methods=['PUT'])
+def add_topic(topic):
+    """
+    The add_topic function starts consuming a topic, or changes its pipeline, without restarting the consumer.
+    The optional JSON body holds the pipeline options:
+        stages   a subset of decode, flatten, filter, store and fanout, default all but filter
+        store    the latest store the messages are written to, default 'latest', the one behind /latest
+        devices  with the filter stage, the device name prefixes to keep
+        fields   with the filter stage, the flattened fields to keep
+    For example {"stages": ["decode", "store"], "store": "ml_result"} keeps the payloads of a topic as they are,
+    in their own store served by /latest?store=ml_result.
+
+    :param topic: The Kafka topic
+    :return: The pipeline of the topic
+    """
+    global kafka_handler
+
+    options = request.get_json(silent=True) or {}
+    if not isinstance(options, dict):
+        return {'status': 'The body must be a JSON object'}, 400
+    try:
+        pipeline = Pipeline(topic, **options)
+    except (TypeError, ValueError) as e:
+        return {'status': f"Invalid pipeline: {e}"}, 400
+    kafka_handler.pipelines.add(pipeline)
+    return pipeline.describe(), 200
+
+
+@kafka_blueprint.route('/admin/topics/<string:topic>', methods=['DELETE'])
+def remove_topic(topic):
+    """
+    The remove_topic function stops consuming a topic. The devices it stored stay in their store.
+
+    :param topic: The Kafka topic
+    :return: A dictionary with a status key
+    """
+    global kafka_handler
+
+    if not kafka_handler.pipelines.remove(topic):
+        return {'status': 'Unknown topic'}, 404
+    return {'status': 'Topic removed'}, 200
+
+
+@kafka_blueprint.route('/admin/dead-letters', methods=['GET'])
+def list_dead_letters():
+    """
+    The list_dead_letters function returns the messages the dispatcher quarantined because
+    they could not be decoded or processed, the most recent last.
+
+    :return: A dictionary with the total number of quarantined messages and the records kept in memory
+    """
+    global kafka_handler
+
+    limit = request.args.get('limit', default=None, type=int)
+    return {'total': kafka_handler.dead_letters.total, 'records': kafka_handler.dead_letters.records(limit)}, 200
+
+
+@kafka_blueprint.route('/admin/latency', methods=['GET'])
+def get_latency():
+    """
+    The get_latency function returns the latency of the messages through the dispatcher, by stage, topic and
+    device class, with quantiles estimated from the kafka_latency_seconds histogram of /metrics.
+
+    :return: A dictionary of {stage: {topic: {device_class: {'count', 'mean', 'p50', 'p90', 'p99'}}}}, in seconds
+    """
+    global kafka_handler
+
+    return kafka_handler.get_latency(), 200
+
+
 @kafka_blueprint.route('/stop', methods=['GET'])
 def stop_stream_endpoint():
     """
@@ -0,0 +1,378 @@
+import json
+import mmap
+import os
+import struct
+from time import sleep
+
+from .latest_store import LatestStore, LatestView, writer_lock
+from .snapshot import dumps
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is listed in requirements.txt
+    orjson = None
+
+"""
+This module provides the shared latest store, which lets several gunicorn workers serve
+the latest data of one consumer.
+
+The store is a file mapped in memory, /dev/shm keeps it in RAM. The first process that locks `<path>.lock`
+becomes the writer: it consumes Kafka into a SharedLatestStore, which copies every stored message to the file.
+The other processes open a SharedLatestView, which follows the file and serves it like a LatestStore.
+
+The file is laid out as:
+    header   magic, layout, slots, slot_bytes, ring_size, count, head, version
+    ring     ring_size entries of (version, slot), the slots written in version order
+    slots    `slots` fixed size slots of (seq, version, time_ns, flag, body_len, name_len, name, JSON body)
+A device keeps its slot until the writer evicts it: the slot is then written with an empty body and the version
+of the eviction, and given to the next new device. A reader drops a device when it reads its slot emptied,
+or taken by another device. Every slot is a seqlock: the writer makes seq odd,
+writes the slot and makes it even again, and a reader retries until it reads the same even seq before and after.
+Readers walk the ring from where they stopped, and scan every slot when the writer lapped them.
+
+"""
+
+MAGIC = b'KAFKASHM'
+LAYOUT = 1
+
+_HEADER = struct.Struct('<8sIIIIQQQ')  # magic, layout, slots, slot_bytes, ring_size, count, head, version
+_COUNT_OFFSET = 24
+_HEAD_OFFSET = 32
+_VERSION_OFFSET = 40
+_RING_OFFSET = 64
+_RING = struct.Struct('<QI4x')  # version, slot
+_SLOT = struct.Struct('<QQqQIH2x')  # seq, version, time_ns, flag, body_len, name_len
+_U64 = struct.Struct('<Q')
+
+
+def _layout(slots, slot_bytes, ring_size):
+    """Return the offset of the first slot and the size of the file."""
+    slots_offset = _RING_OFFSET + ring_size * _RING.size
+    slots_offset += -slots_offset % 64
+    return slots_offset, slots_offset + slots * slot_bytes
+
+
+def open_shared_store(path, devices=8192, slot_bytes=4096, shards=16, tolerance=None):
+    """
+    The open_shared_store function opens the shared latest store at path.
+    The first process to lock it becomes the writer, until it exits.
+
+    :param path: The store file, on a tmpfs such as /dev/shm
+    :param devices: Number of slots, the devices after that are only kept by the writer
+    :param slot_bytes: Size of a slot, messages that do not fit are only kept by the writer
+    :param shards: Number of independently locked shards in the local copy of the store
+    :param tolerance: Allowed out-of-order delay in nanoseconds, see LatestStore
+    :return: A SharedLatestStore in the writer, a SharedLatestView in every other process
+    """
+    lock = writer_lock(f"{path}.lock")
+    if lock is None:
+        return SharedLatestView(path, shards, tolerance)
+    return SharedLatestStore(path, lock, devices, slot_bytes, shards=shards, tolerance=tolerance)
+
+
+class SharedLatestStore(LatestStore):
+    """
+    SharedLatestStore is the LatestStore of the writer process, every stored message is also written to the file.
+    When the file was left by a previous writer with the same layout, its devices are restored and its slots reused.
+    """
+
+    def __init__(self, path, lock, devices=8192, slot_bytes=4096, ring_size=None, shards=16, tolerance=None):
+        """
+        Instantiated the class.
+
+        :param path: The store file
+        :param lock: The locked file descriptor of `<path>.lock`, released by close
+        :param devices: Number of slots
+        :param slot_bytes: Size of a slot
+        :param ring_size: Number of ring entries, four per slot by default
+        :param shards: Number of independently locked shards
+        :param tolerance: Allowed out-of-order delay in nanoseconds
+        """
+        super().__init__(shards, tolerance)
+        self.path = path
+        self.slots = devices
+        self.slot_bytes = slot_bytes
+        self.ring_size = ring_size or max(4096, 4 * devices)
+        self.skipped = {'full': 0, 'oversized': 0}  # messages only kept by the writer
+        self._lock_fd = lock
+        self._slots_offset, size = _layout(self.slots, self.slot_bytes, self.ring_size)
+        self._index = {}  # {device_name: (slot, name length)}
+        self._free = []  # slots emptied by an eviction, given to the next new devices
+        self._count = 0
+        self._head = 0
+        self._map = self._open(size)
+
+    def _open(self, size):
+        """Map the file, adopting it if its layout matches, and create it otherwise."""
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            fd = None
+        if fd is not None:
+            try:
+                if os.fstat(fd).st_size == size:
+                    shared = mmap.mmap(fd, size)
+                    if _HEADER.unpack_from(shared)[:5] == (MAGIC, LAYOUT, self.slots, self.slot_bytes, self.ring_size):
+                        self._adopt(shared)
+                        return shared
+                    shared.close()
+            finally:
+                os.close(fd)
+        # readers keep the previous file mapped until they see the new one, so it is replaced and never resized
+        temporary = f"{self.path}.tmp"
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            shared = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(shared, 0, MAGIC, LAYOUT, self.slots, self.slot_bytes, self.ring_size, 0, 0, self.version)
+        os.replace(temporary, self.path)
+        return shared
+
+    def _adopt(self, shared):
+        """Restore the devices of a file left by a previous writer."""
+        self._count, self._head, version = _HEADER.unpack_from(shared)[5:]
+        self.version = max(self.version, version)
+        restored = []
+        for slot in range(self._count):
+            offset = self._slots_offset + slot * self.slot_bytes
+            seq, version, time_ns, flag, body_len, name_len = _SLOT.unpack_from(shared, offset)
+            start = offset + _SLOT.size
+            if seq & 1 or _SLOT.size + name_len + body_len > self.slot_bytes:
+                # the previous writer stopped in the middle of this slot, drop its message
+                body_len = 0
+                name_len = min(name_len, self.slot_bytes - _SLOT.size)
+                _SLOT.pack_into(shared, offset, seq + (seq & 1), 0, 0, 0, 0, name_len)
+            if not body_len:
+                self._free.append(slot)  # evicted, or never written
+                continue
+            device_name = shared[start:start + name_len].decode('utf-8', errors='replace')
+            self._index[device_name] = (slot, name_len)
+            restored.append((version, device_name, _loads(shared[start + name_len:start + name_len + body_len]),
+                                 time_ns, flag))
+        for version, device_name, msg_json, time_ns, flag in sorted(restored, key=lambda record: record[0]):
+            self._apply(device_name, msg_json, time_ns, flag, version)
+        print(f"Shared store: {len(restored)} devices restored from {self.path}")
+
+    def _stored(self, device_name, msg_json, time_ns, flag, version):
+        shared = self._map
+        slot = self._index.get(device_name)
+        if slot is None:
+            slot = self._place(device_name)
+            if slot is None:
+                return
+        slot, name_len = slot
+        body = dumps(msg_json)
+        if _SLOT.size + name_len + len(body) > self.slot_bytes:
+            self.skipped['oversized'] += 1
+            return
+        offset = self._slots_offset + slot * self.slot_bytes
+        seq = _U64.unpack_from(shared, offset)[0] + 1
+        _SLOT.pack_into(shared, offset, seq, version, time_ns, flag, len(body), name_len)
+        start = offset + _SLOT.size + name_len
+        shared[start:start + len(body)] = body
+        _U64.pack_into(shared, offset, seq + 1)
+        self._publish(version, slot)
+
+    def _publish(self, version, slot):
+        """Add the slot written at version to the ring, and move the version of the file to it."""
+        shared = self._map
+        _RING.pack_into(shared, _RING_OFFSET + self._head % self.ring_size * _RING.size, version, slot)
+        self._head += 1
+        # readers read the version before the head, so the head is written first
+        _U64.pack_into(shared, _HEAD_OFFSET, self._head)
+        _U64.pack_into(shared, _VERSION_OFFSET, version)
+
+    def set_limits(self, max_devices=0, ttl=0, memory_budget=0):
+        """
+        The set_limits function bounds the store like LatestStore.set_limits.
+        A write places its device before evicting the one over the limit, so the file needs at least one slot
+        more than max_devices, and one more per other consumer thread writing new devices at the same time.
+        """
+        if max_devices and max_devices >= self.slots:
+            raise ValueError(f"The shared store has {self.slots} slots, it needs more than the {max_devices} devices "
+                             f"allowed, see KAFKA_SHARED_STORE_DEVICES")
+        super().set_limits(max_devices, ttl, memory_budget)
+
+    def _removed(self, device_name, version):
+        slot = self._index.pop(device_name, None)
+        if slot is None:
+            return
+        slot, name_len = slot
+        shared = self._map
+        offset = self._slots_offset + slot * self.slot_bytes
+        seq = _U64.unpack_from(shared, offset)[0] + 1
+        _SLOT.pack_into(shared, offset, seq, version, 0, 0, 0, name_len)
+        _U64.pack_into(shared, offset, seq + 1)
+        self._free.append(slot)
+        self._publish(version, slot)
+
+    def _place(self, device_name):
+        """Give a slot to a new device. Returns (slot, name length), or None when it cannot be shared."""
+        name = device_name.encode('utf-8')
+        if self._count >= self.slots and not self._free:
+            self.skipped['full'] += 1
+            return None
+        if _SLOT.size + len(name) > self.slot_bytes or len(name) > 0xffff:
+            self.skipped['oversized'] += 1
+            return None
+        shared = self._map
+        slot = self._free.pop() if self._free else self._count
+        offset = self._slots_offset + slot * self.slot_bytes
+        seq = _U64.unpack_from(shared, offset)[0] + 1
+        _SLOT.pack_into(shared, offset, seq, 0, 0, 0, 0, len(name))
+        shared[offset + _SLOT.size:offset + _SLOT.size + len(name)] = name
+        _U64.pack_into(shared, offset, seq + 1)
+        if slot == self._count:
+            self._count += 1
+            _U64.pack_into(shared, _COUNT_OFFSET, self._count)
+        self._index[device_name] = (slot, len(name))
+        return self._index[device_name]
+
+    def close(self):
+        """Unmap the file and let another process become the writer. The file is kept for the next writer."""
+        self._map.close()
+        os.close(self._lock_fd)
+
+
+class SharedLatestView(LatestView):
+    """
+    SharedLatestView follows the file of the writer.
+    """
+
+    def __init__(self, path, shards=16, tolerance=None):
+        """
+        Instantiated the class. The file is opened by the first sync, so the writer may start after the readers.
+
+        :param path: The store file
+        :param shards: Number of independently locked shards
+        :param tolerance: Allowed out-of-order delay in nanoseconds, only used to answer watermark
+        """
+        super().__init__(shards, tolerance)
+        self.path = path
+        self._map = None
+        self._inode = None
+        self._head = 0
+        self._names = {}  # {slot: device_name} of the devices read from the slots
+        self._slot_of = {}  # {device_name: slot}
+
+    def sync(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return []
+        if inode != self._inode and not self._attach():
+            return []
+        shared = self._map
+        version = _U64.unpack_from(shared, _VERSION_OFFSET)[0]
+        if version == self.version:
+            return []
+        count, head = struct.unpack_from('<QQ', shared, _COUNT_OFFSET)
+        slots = None
+        if self._head is not None and head - self._head <= self.ring_size:
+            slots = dict.fromkeys(
+                _RING.unpack_from(shared, _RING_OFFSET + position % self.ring_size * _RING.size)[1]
+                for position in range(self._head, head))
+            if _U64.unpack_from(shared, _HEAD_OFFSET)[0] - self.ring_size > self._head:
+                slots = None  # the writer lapped the entries while they were read
+        if slots is None:
+            slots = range(count)
+        changes = []
+        evicted = []
+        for slot in slots:
+            record = self._read(slot)
+            if record is None:
+                continue
+            device_name = record[1]
+            previous = self._names.get(slot)
+            if previous is not None and previous != device_name and self._slot_of.get(previous) == slot:
+                evicted.append(previous)  # the writer evicted it and gave its slot to another device
+            # messages written after the version was read are left to the next sync, which reads their ring entries
+            if self.device_version(device_name) < record[0] <= version:
+                if record[2] is None:
+                    if self._slot_of.get(device_name) == slot:
+                        evicted.append(device_name)
+                else:
+                    changes.append((slot,) + record)
+        for device_name in evicted:
+            self._names.pop(self._slot_of.pop(device_name), None)
+            self._drop(device_name)
+        changes.sort(key=lambda record: record[1])
+        for slot, record_version, device_name, msg_json, time_ns, flag in changes:
+            self._apply(device_name, msg_json, time_ns, flag, record_version)
+            moved = self._slot_of.get(device_name)
+            if moved is not None and moved != slot:
+                self._names.pop(moved, None)
+            self._names[slot] = device_name
+            self._slot_of[device_name] = slot
+        self._head = head
+        self.version = version
+        return [(device_name, msg_json) for _, _, device_name, msg_json, _, _ in changes]
+
+    def _attach(self):
+        """Map the current file of the writer, and start over from an empty copy."""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            size = os.fstat(fd).st_size
+            if size < _RING_OFFSET:
+                return False
+            shared = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            inode = os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+        magic, layout, slots, slot_bytes, ring_size = _HEADER.unpack_from(shared)[:5]
+        if magic != MAGIC or layout != LAYOUT or _layout(slots, slot_bytes, ring_size)[1] != size:
+            shared.close()
+            return False
+        if self._map is not None:
+            # the writer replaced the file, forget the devices of the previous one
+            self._map.close()
+            self._reset()
+            self._names.clear()
+            self._slot_of.clear()
+        self._map = shared
+        self._inode = inode
+        self.slot_bytes = slot_bytes
+        self.ring_size = ring_size
+        self._slots_offset = _layout(slots, slot_bytes, ring_size)[0]
+        self._head = None  # scan every slot on the first sync
+        return True
+
+    def _read(self, slot):
+        """
+        Read a slot under its seqlock. Returns (version, device_name, measurement, time_ns, flag),
+        the measurement is None when the slot was emptied by an eviction or not written yet.
+        Returns None when the slot could not be read.
+        """
+        shared = self._map
+        offset = self._slots_offset + slot * self.slot_bytes
+        for _ in range(100):
+            seq, version, time_ns, flag, body_len, name_len = _SLOT.unpack_from(shared, offset)
+            if seq & 1:
+                sleep(0)
+                continue
+            start = offset + _SLOT.size
+            end = start + name_len + body_len
+            if end > offset + self.slot_bytes:
+                continue
+            name = shared[start:start + name_len]
+            body = shared[start + name_len:end]
+            if _U64.unpack_from(shared, offset)[0] != seq:
+                continue
+            return version, name.decode('utf-8', errors='replace'), _loads(body) if body_len else None, time_ns, flag
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def _loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
@@ -0,0 +1,116 @@
+import gzip
+import hashlib
+import json
+import threading
+from time import monotonic
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is listed in requirements.txt
+    orjson = None
+
+"""
+This module provides the SnapshotCache class, which keeps a pre-encoded JSON snapshot of the latest store.
+
+The snapshot is rebuilt at most once per interval and only when the store changed.
+Devices whose message did not change since the previous build reuse their encoded fragment.
+
+"""
+
+
+class Snapshot:
+    """An encoded snapshot of the latest store, with its ETag and an optional gzip variant."""
+
+    __slots__ = ('body', 'version', 'etag', 'gzip_level', '_gzipped', '_lock')
+
+    def __init__(self, body, version, gzip_level=0):
+        self.body = body
+        self.version = version  # the store version the snapshot includes
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.gzip_level = gzip_level
+        self._gzipped = None
+        self._lock = threading.Lock()
+
+    @property
+    def gzipped(self):
+        """The body compressed with gzip, computed once on first use. None when gzip is disabled."""
+        if not self.gzip_level:
+            return None
+        if self._gzipped is None:
+            with self._lock:
+                if self._gzipped is None:
+                    self._gzipped = gzip.compress(self.body, compresslevel=self.gzip_level)
+        return self._gzipped
+
+
+class SnapshotCache:
+    """
+    SnapshotCache serves the whole latest store as pre-encoded JSON bytes.
+    """
+
+    def __init__(self, store, interval=1.0, gzip_level=6):
+        """
+        Instantiated the class.
+
+        :param store: The LatestStore to snapshot
+        :param interval: Minimum number of seconds between two rebuilds
+        :param gzip_level: Compression level of the gzip variant, 0 disables it
+        """
+        self.store = store
+        self.interval = interval
+        self.gzip_level = gzip_level
+        self.builds = 0
+        self._lock = threading.Lock()
+        self._fragments = {}  # {device_name: (msg_json, encoded fragment)}
+        self._version = None
+        self._built_at = float('-inf')
+        self._snapshot = None
+
+    def get(self):
+        """
+        The get function returns the current snapshot, rebuilding it first
+        if the interval elapsed and the store changed since the last build.
+        While one caller rebuilds, the others keep getting the previous snapshot.
+
+        :return: A Snapshot
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and (monotonic() - self._built_at < self.interval
+                                     or self.store.version == self._version):
+            return snapshot
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            if self._snapshot is None or self.store.version != self._version:
+                self._rebuild()
+            self._built_at = monotonic()
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def _rebuild(self):
+        version = self.store.version
+        fragments = {}
+        for device_name, msg_json in self.store.snapshot().items():
+            cached = self._fragments.get(device_name)
+            if cached is None or cached[0] is not msg_json:
+                cached = (msg_json, dumps(str(device_name)) + b':' + dumps(msg_json))  # object keys are strings
+            fragments[device_name] = cached
+        self._fragments = fragments
+        body = b'{' + b','.join(fragment for _, fragment in fragments.values()) + b'}'
+        self._snapshot = Snapshot(body, version, self.gzip_level)
+        self._version = version
+        self.builds += 1
+
+
+def dumps(obj):
+    """
+    The dumps function encodes obj to compact JSON bytes,
+    using orjson when it is installed and the standard json module otherwise.
+
+    :param obj: The object to encode
+    :return: The JSON document in bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,135 @@
+from flask import request
+from flask_socketio import Namespace, SocketIO, join_room, leave_room
+
+"""
+This module provides the KafkaSocketIO namespace, which streams the latest data of many devices over one socket.
+
+The sockets subscribed to the same set of devices share one room. A background task reads the devices changed
+since its previous tick from the latest store, and emits one sensor_data event per room holding all the changed
+devices of its set, so a socket gets at most one event per tick whatever the number of devices it follows.
+
+"""
+
+socketio = SocketIO()
+
+
+class KafkaSocketIO(Namespace):
+    """
+    KafkaSocketIO is a Socket.IO namespace driven by the LatestStore of a KafkaStreamHandler.
+
+    Events from the client:
+        subscribe   {"devices": [device_name, ...]}, acknowledged with the current data of those devices
+        unsubscribe {"devices": [device_name, ...]}
+    A malformed event is acknowledged with {"error": reason} and changes nothing.
+
+    Events to the client:
+        sensor_data {device_name: measurement, ...}, the changed devices of the socket, at most once per tick
+    """
+
+    def __init__(self, namespace, handler, tick=0.2):
+        """
+        Instantiated the class.
+
+        :param namespace: The Socket.IO namespace, such as '/kafka'
+        :param handler: The KafkaStreamHandler whose latest store is streamed
+        :param tick: Seconds between two pushes
+        """
+        super().__init__(namespace)
+        self.handler = handler
+        self.tick = tick
+        self.version = handler.data.version
+        self.sessions = {}  # {sid: set of device_name}
+        self.groups = {}  # {frozenset of device_name: [room, number of sockets]}
+        self.rooms = 0  # rooms opened so far, to name the next one
+        self.task = None
+
+    def on_subscribe(self, data):
+        try:
+            devices = _device_list(data)
+        except ValueError as e:
+            return {'error': str(e)}
+        subscribed = self.sessions.setdefault(request.sid, set())
+        previous = frozenset(subscribed)
+        subscribed.update(devices)
+        self._move(previous, frozenset(subscribed))
+        if self.task is None:
+            self.task = self.socketio.start_background_task(self.run)
+        return {device_name: self.handler.data.get(device_name) for device_name in devices}
+
+    def on_unsubscribe(self, data):
+        try:
+            devices = _device_list(data)
+        except ValueError as e:
+            return {'error': str(e)}
+        subscribed = self.sessions.get(request.sid, set())
+        previous = frozenset(subscribed)
+        subscribed.difference_update(devices)
+        self._move(previous, frozenset(subscribed))
+
+    def on_disconnect(self, *args):
+        subscribed = self.sessions.pop(request.sid, set())
+        self._leave_group(frozenset(subscribed))  # the server already took the socket out of its rooms
+
+    def run(self):
+        """
+        The run function is the background task pushing the updates, one push every `tick` seconds.
+        """
+        while True:
+            self.socketio.sleep(self.tick)
+            self.push()
+
+    def push(self):
+        """
+        The push function emits the devices updated since the previous push, one event per room
+        with the changed devices of its set. Each event is encoded once, whatever the number of sockets in the room.
+
+        :return: The number of rooms updated
+        """
+        self.version, changed = self.handler.data.changed_since(self.version)
+        if not changed:
+            return 0
+        pushed = 0
+        for devices, (room, _) in list(self.groups.items()):
+            if len(changed) < len(devices):
+                payload = {device_name: msg_json for device_name, msg_json in changed.items() if device_name in devices}
+            else:
+                payload = {device_name: changed[device_name] for device_name in devices if device_name in changed}
+            if payload:
+                self.emit('sensor_data', payload, room=room)
+                pushed += 1
+        return pushed
+
+    def _move(self, previous, devices):
+        """Move the socket of the current request from the room of its previous set of devices to the new one."""
+        if devices == previous:
+            return
+        if previous:
+            leave_room(self.groups[previous][0])
+            self._leave_group(previous)
+        if devices:
+            group = self.groups.get(devices)
+            if group is None:
+                self.rooms += 1
+                group = self.groups[devices] = [f"devices-{self.rooms}", 0]
+            group[1] += 1
+            join_room(group[0])
+
+    def _leave_group(self, devices):
+        group = self.groups.get(devices)
+        if group is None:
+            return
+        group[1] -= 1
+        if group[1] <= 0:
+            del self.groups[devices]
+
+
+def _device_list(data):
+    """Read the device names of a subscribe or unsubscribe event, a list or a single name is accepted."""
+    devices = data.get('devices', []) if isinstance(data, dict) else data
+    if isinstance(devices, str):
+        devices = [devices]
+    if devices is None:
+        return []
+    if not isinstance(devices, (list, tuple)) or not all(isinstance(device, (str, int)) for device in devices):
+        raise ValueError('Expected {"devices": [device_name, ...]}')
+    return [str(device_name) for device_name in devices]
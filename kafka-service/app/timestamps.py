@@ -0,0 +1,79 @@
+import re
+from datetime import datetime, timezone
+
+from dateutil.parser import isoparse
+
+"""
+This module provides parse_time_ns, which turns the `time` field of a message into epoch nanoseconds.
+
+Devices send either ISO 8601 strings or numeric epoch times in seconds, milliseconds,
+microseconds or nanoseconds. Naive ISO strings are taken as UTC.
+It also provides parse_duration, which reads the durations of the settings and query arguments, like 10s or 5m.
+
+"""
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_DURATION = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*$')
+_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, None: 1}
+
+
+def parse_time_ns(value):
+    """
+    The parse_time_ns function converts a message time to an integer number of nanoseconds since the epoch.
+
+    :param value: The `time` of a message, an ISO 8601 string or a number
+    :return: The epoch time in nanoseconds, or None if value cannot be parsed
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return _epoch_to_ns(value)
+    if not isinstance(value, str):
+        return None
+    if value[4:5] != '-':
+        try:
+            return _epoch_to_ns(float(value))
+        except ValueError:
+            pass
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            parsed = isoparse(value)
+        except (ValueError, OverflowError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    delta = parsed - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1000
+
+
+def _epoch_to_ns(value):
+    """Scale a numeric epoch time to nanoseconds, guessing the unit from its magnitude."""
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    magnitude = abs(value)
+    if magnitude < 1e11:
+        scale = 1_000_000_000
+    elif magnitude < 1e14:
+        scale = 1_000_000
+    elif magnitude < 1e17:
+        scale = 1_000
+    else:
+        scale = 1
+    whole = int(value)
+    # scale the integer and fractional parts separately, a float epoch in nanoseconds is past double precision
+    return whole * scale + round((value - whole) * scale)
+
+
+def parse_duration(text):
+    """
+    The parse_duration function converts a duration like 500ms, 30s, 5m or 1h to seconds.
+
+    :param text: The duration, a number without unit is in seconds
+    :return: The number of seconds
+    """
+    match = _DURATION.match(str(text))
+    if match is None:
+        raise ValueError(f"Invalid duration {text}, use durations like 30s, 5m or 1h")
+    return float(match.group(1)) * _UNITS[match.group(2)]
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+from time import monotonic, sleep
+
+from .snapshot import dumps
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is listed in requirements.txt
+    msgpack = None
+
+"""
+This module provides the WarmStart class, which persists the latest store to a local file
+so a restarted kafka-dispatcher serves the last known values before the devices send again.
+
+The file starts with a header line naming the record format, followed by one record per device:
+    KAFKA-LATEST 1 msgpack   a stream of MessagePack arrays [device_name, time_ns, measurement]
+    KAFKA-LATEST 1 json      one JSON array [device_name, time_ns, measurement] per line
+The file is written to a temporary name and renamed, so a crash never leaves a truncated snapshot.
+Loaded entries go through the newest-wins update of the store, so live messages replace them.
+
+"""
+
+MAGIC = b'KAFKA-LATEST 1 '
+
+
+class WarmStart:
+    """
+    WarmStart saves the latest store every `interval` seconds from a background thread, and loads it at startup.
+    Saving holds each shard lock only to copy references, and yields between shards,
+    and the record of a device is only encoded again when its message changed.
+    """
+
+    def __init__(self, store, path, interval=30):
+        """
+        Instantiated the class.
+
+        :param store: The LatestStore to persist
+        :param path: The snapshot file, an empty path disables the warm start
+        :param interval: Seconds between two saves, a save is skipped when the store did not change
+        """
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.format = 'msgpack' if msgpack is not None else 'json'
+        self.saves = 0
+        self.loaded = 0  # number of devices restored by the last load
+        self.running = False
+        self._lock = threading.Lock()
+        self._records = {}  # {device_name: (msg_json, encoded record)}
+        self._version = None
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def load(self):
+        """
+        The load function restores the devices of the snapshot file into the store.
+        A missing or unreadable file leaves the store as it is.
+
+        :return: The number of devices restored
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return 0
+        begin = monotonic()
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.readline().rstrip(b'\n')
+                body = f.read()
+            if not header.startswith(MAGIC):
+                raise ValueError(f"{self.path} is not a snapshot of the latest store")
+            restored = 0
+            for device_name, time_ns, msg_json in _decode(header[len(MAGIC):].decode('ascii'), body):
+                restored += self.store.update(device_name, msg_json, time_ns=time_ns)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Error loading the warm start snapshot: {e}")
+            return 0
+        self.loaded = restored
+        print(f"Warm start: {restored} devices restored from {self.path} in {monotonic() - begin:.3f}s")
+        return restored
+
+    def save(self, force=False):
+        """
+        The save function writes the store to the snapshot file if it changed since the previous save.
+
+        :param force: Write even if the store did not change
+        :return: True if the file was written
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            version = self.store.version
+            if version == self._version and not force:
+                return False
+            encode = _ENCODERS[self.format]
+            records = {}
+            chunks = [MAGIC + self.format.encode('ascii') + b'\n']
+            for items in self.store.shard_items():
+                for device_name, time_ns, msg_json in items:
+                    cached = self._records.get(device_name)
+                    if cached is None or cached[0] is not msg_json:
+                        cached = (msg_json, encode(device_name, time_ns, msg_json))
+                    records[device_name] = cached
+                    chunks.append(cached[1])
+                sleep(0)  # let the consumer threads run between two shards
+            self._records = records
+            temporary = f"{self.path}.tmp"
+            with open(temporary, 'wb') as f:
+                f.writelines(chunks)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+            self._version = version
+            self.saves += 1
+            return True
+
+    def start(self):
+        """
+        The start function starts the background thread saving the store every `interval` seconds.
+        """
+        if not self.enabled or self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        The stop function stops the background thread and writes a last snapshot.
+        """
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.enabled:
+            self.save()
+
+    def _run(self):
+        deadline = monotonic() + self.interval
+        while self.running:
+            sleep(min(1.0, max(0.0, deadline - monotonic())))
+            if monotonic() >= deadline:
+                deadline = monotonic() + self.interval
+                try:
+                    self.save()
+                except (OSError, TypeError, ValueError) as e:
+                    print(f"Error saving the warm start snapshot: {e}")
+
+
+def _encode_msgpack(device_name, time_ns, msg_json):
+    return msgpack.packb([device_name, time_ns, msg_json])
+
+
+def _encode_json(device_name, time_ns, msg_json):
+    return dumps([device_name, time_ns, msg_json]) + b'\n'
+
+
+_ENCODERS = {'msgpack': _encode_msgpack, 'json': _encode_json}
+
+
+def _decode(record_format, body):
+    """Yield the (device_name, time_ns, measurement) records of a snapshot body."""
+    if record_format == 'msgpack':
+        if msgpack is None:
+            raise ValueError("the snapshot is MessagePack encoded and msgpack is not installed")
+        unpacker = msgpack.Unpacker(raw=False, strict_map_key=False, max_buffer_size=max(len(body), 1))
+        unpacker.feed(body)
+        yield from unpacker
+    elif record_format == 'json':
+        for line in body.splitlines():
+            if line:
+                yield json.loads(line)
+    else:
+        raise ValueError(f"Unsupported snapshot format {record_format}")
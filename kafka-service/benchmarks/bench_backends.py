@@ -0,0 +1,101 @@
+"""
+Benchmark of the latest store backends: memory, shared and redis.
+
+For each backend it times, per device:
+    update   LatestStore.update in the process consuming Kafka, including the copy to the backend
+    flush    the pipelined write of the redis backend, amortized over the devices of the flush
+    sync     the copy of an updated device into the LatestView of another worker
+    get      a read from the LatestView, which is what the routes of every worker do
+    direct   a read from the backend itself, like another service reading the Redis hash with HMGET
+Without --redis-url the redis backend runs against the stand-in server of tests.fakes,
+which measures the client and the round trip on localhost, not a real Redis. Run from the kafka-service directory:
+
+    python -m benchmarks.bench_backends --devices 2000 --redis-url redis://localhost:6379/0
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import redis
+
+from app.backends import BACKENDS, open_latest_store
+from app.flattener import flatten_json
+from benchmarks.common import timed
+from tests.fakes import FakeRedisServer, sensor_payload
+
+
+def message(device_index, seq, groups):
+    msg_json = sensor_payload(device_index, seq, groups)
+    msg_json['values'] = flatten_json(msg_json['values'])
+    return msg_json
+
+
+def open_pair(backend, directory, args):
+    """Open the store of the consuming process and the view of another worker, in this process."""
+    if backend == 'memory':
+        store = open_latest_store('memory')
+        return store, store
+    if backend == 'shared':
+        options = dict(path=os.path.join(directory, 'latest'), devices=args.devices)
+    else:
+        options = dict(url=args.redis_url, prefix=f"bench-{time.time_ns()}", lock_path=os.path.join(directory, 'lock'),
+                       flush_interval=3600)
+    return open_latest_store(backend, **options), open_latest_store(backend, **options)
+
+
+def direct_read(backend, store, view, args):
+    """Return a function reading one device from the backend, without the local copy of the view."""
+    if backend == 'memory':
+        return store.get
+    if backend == 'shared':
+        slots = {device_name: slot for device_name, (slot, _) in store._index.items()}
+        return lambda device_name: view._read(slots[device_name])
+    client = redis.Redis.from_url(args.redis_url)
+    key = f"{store.prefix}:latest"
+    return lambda device_name: client.hmget(key, device_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=8, help='x/y/z groups per payload')
+    parser.add_argument('--rounds', type=int, default=5, help='updates per device')
+    parser.add_argument('--redis-url', default=None, help='a Redis server, the stand-in server is used if omitted')
+    args = parser.parse_args()
+
+    server = None
+    if args.redis_url is None:
+        server = FakeRedisServer()
+        args.redis_url = server.url
+    devices = [f"sensor-{i}" for i in range(args.devices)]
+    rounds = [[message(i, r * args.devices + i, args.groups) for i in range(args.devices)] for r in range(args.rounds)]
+    count = args.devices * args.rounds
+
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as directory:
+        for backend in BACKENDS:
+            store, view = open_pair(backend, directory, args)
+            update = flush = sync = 0.0
+            for r, messages in enumerate(rounds):
+                update += timed(lambda: [store.update(device_name, msg_json, time_ns=r * args.devices + i)
+                                         for i, (device_name, msg_json) in enumerate(zip(devices, messages))])
+                if backend == 'redis':
+                    flush += timed(store.flush)
+                if view is not store:
+                    sync += timed(view.sync)
+            get = timed(lambda: [view.get(device_name) for device_name in devices])
+            read = direct_read(backend, store, view, args)
+            direct = timed(lambda: [read(device_name) for device_name in devices])
+            assert view.snapshot() == store.snapshot()
+            print(f"{backend:>7}: update {update / count * 1e6:6.2f} us, flush {flush / count * 1e6:6.2f} us, "
+                  f"sync {sync / count * 1e6:6.2f} us, get {get / len(devices) * 1e6:6.2f} us, "
+                  f"direct {direct / len(devices) * 1e6:7.2f} us per device")
+            store.close()
+            if view is not store:
+                view.close()
+    if server is not None:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the SSE wire encodings of the Broadcaster: json, msgpack and delta.
+
+One device is published `--updates` times to `--clients` subscribers per encoding.
+Like the lab machines, only a few of the flattened fields change between two messages.
+The clients are driven from one thread, right after each publish, so that no frame is coalesced
+and the CPU time is the cost of encoding and handing out the frames.
+Bytes per second assume `--rate` updates per second. Run from the kafka-service directory:
+
+    python -m benchmarks.bench_encoding --clients 100 --updates 5000 --rate 10
+"""
+import argparse
+import random
+import time
+
+from app.broadcaster import Broadcaster, available_encodings
+from app.flattener import flatten_json
+from tests.fakes import sensor_payload
+
+
+def updates(count, groups, changing):
+    """Generate the messages of one device as stored by the handler, `changing` fields move per update."""
+    message = sensor_payload(0, 0, groups)
+    message['values'] = flatten_json(message['values'])
+    fields = list(message['values'])
+    for seq in range(count):
+        message = dict(message, time=sensor_payload(0, seq)['time'], values=dict(message['values']))
+        for field in random.sample(fields, changing):
+            message['values'][field] = random.random()
+        yield message
+
+
+def run(encoding, messages, clients):
+    broadcaster = Broadcaster(heartbeat=60)
+    streams = [broadcaster.subscribe("sensor-0", messages[0], encoding=encoding) for _ in range(clients)]
+    for stream in streams:
+        next(stream)
+    sent = 0
+    begin = time.process_time()
+    for message in messages[1:]:
+        broadcaster.publish("sensor-0", message)
+        for stream in streams:
+            sent += len(next(stream))
+    cpu = time.process_time() - begin
+    for stream in streams:
+        stream.close()
+    return sent, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=10, help='updates per second of the device')
+    parser.add_argument('--groups', type=int, default=8, help='x/y/z groups per payload')
+    parser.add_argument('--changing', type=int, default=3, help='fields changing per update')
+    args = parser.parse_args()
+
+    messages = list(updates(args.updates + 1, args.groups, args.changing))
+    for encoding in available_encodings():
+        sent, cpu = run(encoding, messages, args.clients)
+        per_frame = sent / args.updates / args.clients
+        print(f"{encoding:>8}: {per_frame:>7,.0f} bytes/frame, {per_frame * args.rate:>9,.0f} bytes/s per client, "
+              f"{cpu / args.updates / args.clients * 1e6:>6.2f} us CPU per frame per client, "
+              f"{cpu / args.updates * args.rate * 100:>6.3f}% of a core for {args.clients} clients")
+
+
+if __name__ == '__main__':
+    main()
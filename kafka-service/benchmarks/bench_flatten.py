@@ -0,0 +1,53 @@
+"""
+Microbenchmark of flatten_json against the per-device compiled layouts of Flattener.
+
+The payloads mimic the lab sensors: a few groups of x/y/z readings,
+a couple of scalar fields and a two level nested status block.
+Run from the kafka-service directory:
+
+    python -m benchmarks.bench_flatten --devices 100 --messages 200000
+"""
+import argparse
+
+from app.flattener import Flattener, flatten_json
+from benchmarks.common import timed
+from tests.fakes import sensor_payload
+
+
+def realistic_values(device_index, seq, groups):
+    values = sensor_payload(device_index, seq, groups)['values']
+    values['temperature'] = 21.5 + seq % 7
+    values['state'] = 'RUNNING'
+    values['status'] = {'spindle': {'speed': 1200 + seq % 50, 'load': 0.42}, 'alarm': False}
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--groups', type=int, default=8, help='x/y/z groups per payload')
+    args = parser.parse_args()
+
+    payloads = [(f"sensor-{i % args.devices}", realistic_values(i % args.devices, i, args.groups))
+                for i in range(min(args.messages, 10 * args.devices))]
+    stream = [payloads[i % len(payloads)] for i in range(args.messages)]
+    flattener = Flattener()
+
+    def general():
+        for _, values in stream:
+            flatten_json(values)
+
+    def cached():
+        for device_name, values in stream:
+            flattener.flatten(device_name, values)
+
+    leaves = len(flatten_json(stream[0][1]))
+    for name, func in (('flatten_json', general), ('Flattener', cached)):
+        elapsed = timed(func)
+        print(f"{name:>12}: {args.messages / elapsed:>12,.0f} msg/s ({leaves} leaves per message)")
+    print(f"cache hits {flattener.hits}, misses {flattener.misses}")
+
+
+if __name__ == '__main__':
+    main()
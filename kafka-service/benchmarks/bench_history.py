@@ -0,0 +1,67 @@
+"""
+Memory benchmark of the in-memory device history with 5k devices.
+
+It fills every ring buffer and compares the memory used with keeping
+the same samples as lists of flattened message dictionaries.
+Run from the kafka-service directory:
+
+    python -m benchmarks.bench_history --devices 5000 --samples 600
+"""
+import argparse
+import tracemalloc
+
+from app.history import HistoryStore
+from app.flattener import flatten_json
+from benchmarks.common import timed
+from tests.fakes import sensor_payload
+
+
+def fill_history(store, devices, samples, fields, start=0):
+    values = [flatten_json(sensor_payload(i, 0, fields)['values']) for i in range(devices)]
+    for seq in range(start, start + samples):
+        for device in range(devices):
+            store.append(f"sensor-{device}", values[device], timestamp=seq)
+
+
+def fill_dicts(history, devices, samples, fields):
+    for seq in range(samples):
+        for device in range(devices):
+            msg = flatten_json(sensor_payload(device, seq, fields)['values'])
+            history.setdefault(f"sensor-{device}", []).append(msg)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    elapsed = timed(func, *args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=600)
+    parser.add_argument('--fields', type=int, default=4, help='measurement groups of x/y/z per message')
+    parser.add_argument('--baseline-samples', type=int, default=60,
+                        help='samples per device for the list of dicts baseline, which is much bigger')
+    args = parser.parse_args()
+
+    store = HistoryStore(capacity=args.samples, memory_budget=1 << 40)
+    # the ring buffers are allocated on the first sample, so one traced pass measures their footprint
+    current, _, _ = measure(fill_history, store, args.devices, 1, args.fields)
+    elapsed = timed(fill_history, store, args.devices, args.samples, args.fields, 1)
+    per_sample = current / (args.devices * args.samples)
+    rate = args.devices * args.samples / elapsed
+    print(f"ring buffers: {current / 2 ** 20:8.1f} MiB for {args.devices} devices x {args.samples} samples "
+          f"({per_sample:.0f} B/sample, accounted {store.nbytes / 2 ** 20:.1f} MiB, {rate:,.0f} appends/s)")
+
+    baseline = {}
+    current, peak, elapsed = measure(fill_dicts, baseline, args.devices, args.baseline_samples, args.fields)
+    per_sample = current / (args.devices * args.baseline_samples)
+    print(f"list of dicts: {per_sample:.0f} B/sample, "
+          f"{per_sample * args.devices * args.samples / 2 ** 20:.1f} MiB extrapolated to {args.samples} samples")
+
+
+if __name__ == '__main__':
+    main()
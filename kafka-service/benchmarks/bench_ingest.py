@@ -0,0 +1,38 @@
+"""
+Throughput benchmark of the single message loop against the batched ingestion loop.
+
+Run from the kafka-service directory:
+
+    python -m benchmarks.bench_ingest --messages 200000 --devices 200
+"""
+import argparse
+
+from app.kafka_handler import KafkaStreamHandler
+from benchmarks.common import timed
+from tests.fakes import FakeKafkaService, make_messages
+
+
+def run(loop, messages, batch_size, linger):
+    handler = KafkaStreamHandler(batch_size=batch_size, linger=linger)
+    handler.running = True
+    service = FakeKafkaService(messages, handler)
+    target = handler.storing_latest_batch if loop == 'batch' else handler.storing_latest
+    return timed(target, service), handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.devices)
+    for loop in ('single', 'batch'):
+        elapsed, handler = run(loop, messages, args.batch_size, 0)
+        print(f"{loop:>6}: {args.messages / elapsed:>12,.0f} msg/s "
+              f"({elapsed:.2f}s, {len(handler.data)} devices stored)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Benchmark of the SSE streams served by gevent, like the gunicorn deployment, against the asyncio serving mode.
+
+For each mode a server process is started on a KafkaStreamHandler without Kafka: a publisher thread stores
+a message for each of `--devices` devices `--rate` times per second. The gevent server is gevent.pywsgi,
+which the gunicorn gevent workers use, with the stream route of routes.py and no connection limit.
+The asyncio server is KafkaASGI behind uvicorn. Then `--clients` streams are opened
+from this process, spread over the devices, and kept for `--seconds` seconds. It reports the time to open
+them all, the frames received, the delay from the publish to the client, and the memory and CPU of the server.
+The clients run on the same host and take CPU too. Run from the kafka-service directory:
+
+    python -m benchmarks.bench_serving --clients 10000 --devices 100 --rate 1
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+PATH = '/api/v1/kafka-stream/'
+
+
+def publish(handler, devices, rate):
+    """Store a message for every device `rate` times per second, the send time goes first in the message."""
+    seq = 0
+    while True:
+        seq += 1
+        for i in range(devices):
+            handler.store_latest(f"sensor-{i}", {"sent": time.time(), "time": seq, "values": {"x": seq, "y": i}})
+        time.sleep(1 / rate)
+
+
+def serve_gevent(port, devices, rate):
+    from gevent import monkey
+    monkey.patch_all()
+    from flask import Flask, Response
+    from gevent.pywsgi import WSGIServer
+
+    from app.kafka_handler import KafkaStreamHandler
+
+    handler = KafkaStreamHandler()
+    handler.running = True
+    app = Flask(__name__)
+
+    @app.route(f"{PATH}<device_name>")
+    def stream(device_name):
+        response = Response(handler.get_latest_data_stream(device_name), content_type='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    threading.Thread(target=publish, args=(handler, devices, rate), daemon=True).start()
+    server = WSGIServer(('127.0.0.1', port), app, log=None, backlog=4096)
+    server.start()
+    print('listening', flush=True)
+    server.serve_forever()
+
+
+def serve_asyncio(port, devices, rate):
+    import uvicorn
+
+    from app.asgi import KafkaASGI
+    from app.kafka_handler import KafkaStreamHandler
+
+    handler = KafkaStreamHandler()
+    handler.running = True
+    threading.Thread(target=publish, args=(handler, devices, rate), daemon=True).start()
+    server = uvicorn.Server(uvicorn.Config(KafkaASGI(handler), host='127.0.0.1', port=port, backlog=4096,
+                                           log_level='warning'))
+
+    async def serve():
+        serving = asyncio.ensure_future(server.serve())
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.01)
+        print('listening', flush=True)
+        await serving
+
+    asyncio.run(serve())
+
+
+async def client(port, device_name, stats, opened, stop):
+    """Read the SSE stream of a device, chunked, and record the delay of every frame."""
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f"GET {PATH}{device_name} HTTP/1.1\r\nHost: bench\r\n\r\n".encode('ascii'))
+        await reader.readuntil(b'\r\n\r\n')
+    except OSError as e:
+        stats['errors'] += 1
+        opened.release()
+        print(f"connection error: {e}")
+        return
+    opened.release()
+    buffer = b''
+    try:
+        while not stop.is_set():
+            size = int((await reader.readline()).strip() or b'0', 16)
+            if size == 0:
+                break
+            buffer += (await reader.readexactly(size + 2))[:-2]
+            now = time.time()
+            *frames, buffer = buffer.split(b'\n\n')
+            for frame in frames:
+                start = frame.find(b'"sent":')
+                if start < 0:
+                    continue
+                stats['frames'] += 1
+                if stats['measuring'] and len(stats['delays']) < 200000:
+                    stats['delays'].append(now - float(frame[start + 7:frame.index(b',', start)]))
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        stats['errors'] += 1
+    finally:
+        writer.close()
+
+
+def process_usage(pid):
+    """The CPU seconds and the resident memory in MB of a process, read from /proc."""
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu, int(fields[21]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+async def load(port, args, pid):
+    stats = {'frames': 0, 'errors': 0, 'delays': [], 'measuring': False}
+    stop = asyncio.Event()
+    opened = asyncio.Semaphore(200)  # connections being opened at once
+    tasks = []
+    begin = time.monotonic()
+    for i in range(args.clients):
+        await opened.acquire()
+        tasks.append(asyncio.ensure_future(client(port, f"sensor-{i % args.devices}", stats, opened, stop)))
+    for _ in range(200):
+        await opened.acquire()
+    connect = time.monotonic() - begin
+    await asyncio.sleep(1)
+
+    cpu_begin, _ = process_usage(pid)
+    frames_begin = stats['frames']
+    stats['measuring'] = True
+    begin = time.monotonic()
+    await asyncio.sleep(args.seconds)
+    elapsed = time.monotonic() - begin
+    cpu_end, rss = process_usage(pid)
+    stats['measuring'] = False
+    frames = stats['frames'] - frames_begin
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return connect, frames / elapsed, (cpu_end - cpu_begin) / elapsed, rss, stats
+
+
+def run(mode, args):
+    port = args.port
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_serving', '--serve', mode, '--port', str(port),
+                               '--devices', str(args.devices), '--rate', str(args.rate)],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        connect, frame_rate, cpu, rss, stats = asyncio.run(load(port, args, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+    expected = args.clients * args.rate
+    delays = sorted(stats['delays']) or [float('nan')]
+    print(f"{mode:>7}: {args.clients} streams opened in {connect:.1f} s, {stats['errors']} errors, "
+          f"{frame_rate:,.0f} frames/s of {expected:,.0f}, delay median {statistics.median(delays) * 1000:.1f} ms "
+          f"p99 {delays[int(len(delays) * 0.99)] * 1000:.1f} ms, server {cpu:.0%} CPU {rss:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=1, help='messages per second and device')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--port', type=int, default=9102)
+    parser.add_argument('--modes', default='gevent,asyncio')
+    parser.add_argument('--serve', choices=('gevent', 'asyncio'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve == 'gevent':
+        serve_gevent(args.port, args.devices, args.rate)
+        return
+    if args.serve == 'asyncio':
+        serve_asyncio(args.port, args.devices, args.rate)
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < args.clients + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.clients + 1000), hard))
+    for mode in args.modes.split(','):
+        run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
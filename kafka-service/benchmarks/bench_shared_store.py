@@ -0,0 +1,114 @@
+"""
+Benchmark of the shared latest store.
+
+It times LatestStore.update against SharedLatestStore.update, which also copies the message to the file,
+then runs a writer process updating `--devices` devices for `--seconds` seconds while `--readers`
+processes follow the file, and reports how many updates each reader copied and how long a message
+took to reach them. Run from the kafka-service directory:
+
+    python -m benchmarks.bench_shared_store --devices 2000 --readers 4
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from app.flattener import flatten_json
+from app.latest_store import LatestStore
+from app.shared_store import open_shared_store
+from benchmarks.common import timed
+from tests.fakes import sensor_payload
+
+
+def message(device_index, seq, groups):
+    msg_json = sensor_payload(device_index, seq, groups)
+    msg_json['values'] = flatten_json(msg_json['values'])
+    return msg_json
+
+
+def write(store, messages, devices):
+    for seq, msg_json in enumerate(messages):
+        store.update(f"dev{seq % devices}", msg_json, time_ns=seq)
+
+
+def writer(path, devices, groups, seconds, ready, results):
+    store = open_shared_store(path, devices=devices)
+    ready.wait()
+    seq = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        msg_json = message(seq % devices, seq, groups)
+        msg_json['sent'] = time.time()
+        store.update(f"dev{seq % devices}", msg_json, time_ns=seq)
+        seq += 1
+        if seq % 100 == 0:
+            time.sleep(0)
+    store.close()
+    results.put(seq)
+
+
+def reader(path, seconds, interval, ready, results):
+    view = open_shared_store(path)
+    ready.wait()
+    delays = []
+    synced = 0
+    busy = 0.0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        begin = time.perf_counter()
+        changes = view.sync()
+        now = time.time()
+        busy += time.perf_counter() - begin
+        synced += len(changes)
+        delays.extend(now - msg_json['sent'] for _, msg_json in changes)
+        time.sleep(interval)
+    results.put((synced, busy, delays))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=8, help='x/y/z groups per payload')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between two syncs of a reader')
+    args = parser.parse_args()
+
+    messages = [message(i % args.devices, i, args.groups) for i in range(50000)]
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as directory:
+        local = timed(lambda: write(LatestStore(), messages, args.devices))
+        shared_store = open_shared_store(os.path.join(directory, 'single'), devices=args.devices)
+        shared = timed(lambda: write(shared_store, messages, args.devices))
+        shared_store.close()
+        print(f"update: LatestStore {local / len(messages) * 1e6:.2f} us, "
+              f"SharedLatestStore {shared / len(messages) * 1e6:.2f} us")
+
+        path = os.path.join(directory, 'latest')
+        ready = multiprocessing.Barrier(args.readers + 1)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=writer, args=(path, args.devices, args.groups, args.seconds,
+                                                                  ready, results))]
+        processes[0].start()
+        time.sleep(0.5)  # the writer locks the file first
+        for _ in range(args.readers):
+            processes.append(multiprocessing.Process(target=reader, args=(path, args.seconds, args.interval,
+                                                                          ready, results)))
+            processes[-1].start()
+        for _ in range(args.readers + 1):
+            result = results.get()
+            if isinstance(result, int):
+                print(f"writer:   {result / args.seconds:10,.0f} updates/s")
+                continue
+            synced, busy, delays = result
+            delays.sort()
+            print(f"reader: {synced / args.seconds:10,.0f} updates/s copied, {busy / args.seconds:.1%} busy, "
+                  f"delay median {statistics.median(delays) * 1000:.1f} ms, "
+                  f"p99 {delays[int(len(delays) * 0.99)] * 1000:.1f} ms")
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of the warm start snapshot of the latest store.
+
+It fills a LatestStore with `--devices` flattened sensor messages, then times a full save,
+a save after `--changed` devices were updated, and a load into an empty store, for each record format.
+While saving, a thread keeps updating the store to show how long the ingestion path waits.
+Run from the kafka-service directory:
+
+    python -m benchmarks.bench_warm_start --devices 10000
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from app.flattener import flatten_json
+from app.latest_store import LatestStore
+from app.warm_start import WarmStart, msgpack
+from benchmarks.common import timed
+from tests.fakes import sensor_payload
+
+
+def message(device_index, seq, groups):
+    msg_json = sensor_payload(device_index, seq, groups)
+    msg_json['values'] = flatten_json(msg_json['values'])
+    return msg_json
+
+
+def ingest_while(func, store, devices, groups):
+    """Run func while a writer thread updates the store, return the longest single update in seconds."""
+    done = threading.Event()
+    longest = [0.0]
+
+    def writer():
+        seq = devices
+        while not done.is_set():
+            msg_json = message(seq % devices, seq, groups)
+            begin = time.perf_counter()
+            store.update(msg_json['device_name'], msg_json, time_ns=seq)
+            longest[0] = max(longest[0], time.perf_counter() - begin)
+            seq += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        func()
+    finally:
+        done.set()
+        thread.join()
+    return longest[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=8, help='x/y/z groups per payload')
+    parser.add_argument('--changed', type=int, default=1000, help='devices updated between two saves')
+    args = parser.parse_args()
+
+    formats = ['msgpack', 'json'] if msgpack is not None else ['json']
+    with tempfile.TemporaryDirectory() as directory:
+        for record_format in formats:
+            path = os.path.join(directory, f'latest.{record_format}')
+            store = LatestStore()
+            for i in range(args.devices):
+                msg_json = message(i, i, args.groups)
+                store.update(msg_json['device_name'], msg_json, time_ns=i)
+            saver = WarmStart(store, path)
+            saver.format = record_format
+
+            full = timed(saver.save)
+            for i in range(args.changed):
+                msg_json = message(i, args.devices + i, args.groups)
+                store.update(msg_json['device_name'], msg_json, time_ns=args.devices + i)
+            incremental = timed(saver.save)
+            longest = ingest_while(lambda: saver.save(force=True), store, args.devices, args.groups)
+
+            restored = LatestStore()
+            load = timed(WarmStart(restored, path).load)
+            print(f"{record_format:>8}: {os.path.getsize(path) / 1e6:6.2f} MB, full save {full * 1000:7.1f} ms, "
+                  f"save after {args.changed} updates {incremental * 1000:7.1f} ms, "
+                  f"load {load * 1000:7.1f} ms ({len(restored)} devices), "
+                  f"longest store update while saving {longest * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
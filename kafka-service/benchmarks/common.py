@@ -0,0 +1,14 @@
+"""
+Helpers shared by the kafka-dispatcher benchmarks.
+
+The stand-ins for Kafka and Redis and the generated sensor messages live in tests/fakes.py,
+so the numbers do not depend on a running Kafka broker.
+"""
+import time
+
+
+def timed(func, *args, **kwargs):
+    """Run func and return the elapsed wall-clock time in seconds."""
+    begin = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - begin
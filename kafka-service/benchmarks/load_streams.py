@@ -0,0 +1,73 @@
+"""
+Load test of the SSE endpoint /api/v1/kafka-stream/<device_name> of a running kafka-dispatcher.
+
+It opens `--clients` concurrent streams on one device, optionally with `?frequency=`,
+counts the frames they receive and, when `--pid` is given and the server runs on this host,
+reports the CPU time the server process used during the test.
+
+    python -m benchmarks.load_streams http://localhost:9002 sensor-1 --clients 200 --frequency 1 --pid 1234
+"""
+import argparse
+import os
+import threading
+import time
+
+import requests
+
+
+def cpu_seconds(pid):
+    """The user plus system CPU time of a process, read from /proc."""
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def client(url, stop, counts, index):
+    try:
+        with requests.get(url, stream=True, timeout=(5, 30)) as response:
+            for line in response.iter_lines():
+                if stop.is_set():
+                    break
+                if line.startswith(b'data:'):
+                    counts[index] += 1
+    except requests.RequestException as e:
+        print(f"client {index}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_url', help='such as http://localhost:9002')
+    parser.add_argument('device_name')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--frequency', type=float, default=0)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--pid', type=int, help='pid of the server, to report its CPU time')
+    args = parser.parse_args()
+
+    url = f"{args.base_url.rstrip('/')}/api/v1/kafka-stream/{args.device_name}"
+    if args.frequency:
+        url += f"?frequency={args.frequency:g}"
+    stop = threading.Event()
+    counts = [0] * args.clients
+    threads = [threading.Thread(target=client, args=(url, stop, counts, i), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(1)  # let every client connect before measuring
+    begin_counts = sum(counts)
+    begin_cpu = cpu_seconds(args.pid) if args.pid else None
+    begin = time.monotonic()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - begin
+    frames = sum(counts) - begin_counts
+    stop.set()
+
+    print(f"{args.clients} clients, frequency {args.frequency}: {frames / elapsed:,.1f} frames/s in total, "
+          f"{frames / elapsed / args.clients:.2f} frames/s per client")
+    if begin_cpu is not None:
+        cpu = cpu_seconds(args.pid) - begin_cpu
+        print(f"server CPU: {cpu / elapsed * 100:.1f}% of a core, {cpu / max(frames, 1) * 1e6:.1f} us per frame")
+
+
+if __name__ == '__main__':
+    main()
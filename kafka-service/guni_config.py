@@ -1,10 +1,18 @@
+import os
+
 pidfile = 'kafka-dispatcher.pid'
 worker_tmp_dir = '/dev/shm'
 
-# Websocket gevent worker
+# Websocket gevent worker, serves the Socket.IO namespace and the plain HTTP routes
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
 # Normal gevent worker
-worker_class = 'gevent'
-workers = 1
+# worker_class = 'gevent'
+# Every worker serves /latest and the streams, but only one of them can consume Kafka.
+# With the shared or redis latest store backend the worker writing the store consumes and the others follow it,
+# with the memory backend each worker would only see its share of the partitions, so there is one worker.
+# Socket.IO clients need the websocket transport, or sticky sessions, with more than one worker.
+latest_backend = os.environ.get('KAFKA_LATEST_BACKEND', 'shared' if os.environ.get('KAFKA_SHARED_STORE') else 'memory')
+workers = int(os.environ.get('KAFKA_WORKERS', 4)) if latest_backend != 'memory' else 1
 worker_connections = 1000
 timeout = 60
 keepalive = 5
@@ -1,6 +1,7 @@
 from app import create_app
+from app.sockets import socketio
 
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=app.config['DATA_DISPATCHER_PORT'])
+    socketio.run(app, host='0.0.0.0', port=app.config['DATA_DISPATCHER_PORT'])
@@ -0,0 +1,9 @@
+import uvicorn
+
+from app import create_asgi_app
+from config import DevelopmentConfig
+
+app = create_asgi_app()
+
+if __name__ == '__main__':
+    uvicorn.run(app, host='0.0.0.0', port=int(DevelopmentConfig.DATA_DISPATCHER_PORT or 9002), backlog=2048)
@@ -0,0 +1,248 @@
+"""
+Stand-ins for Kafka and Redis, and generated sensor messages, shared by the tests and the benchmarks.
+
+They replay messages through the real handler code, so neither needs a running Kafka broker nor Redis server.
+"""
+import json
+import random
+import socket
+import socketserver
+import threading
+
+
+class FakeMessage:
+    """A stand-in for confluent_kafka.Message holding a pre-encoded value."""
+
+    def __init__(self, value, topic='sensor_data', partition=0, offset=0):
+        self._value = value
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+
+    def value(self):
+        return self._value
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def error(self):
+        return None
+
+
+class FakeKafkaService:
+    """
+    A stand-in for KafkaService that replays a fixed list of messages once,
+    then stops the handler it is feeding.
+    """
+
+    def __init__(self, messages, handler):
+        self.messages = messages
+        self.handler = handler
+        self.position = 0
+
+    def consume(self):
+        if self.position >= len(self.messages):
+            self.handler.running = False
+            return None
+        msg = self.messages[self.position]
+        self.position += 1
+        return msg
+
+    def batch_consume(self, batch_size=50, timeout=1):
+        if self.position >= len(self.messages):
+            self.handler.running = False
+            return []
+        batch = self.messages[self.position:self.position + batch_size]
+        self.position += len(batch)
+        return batch
+
+    catchup = {}
+
+    def catching_up(self, msgs):
+        return False
+
+    def subscribe(self, topics):
+        pass
+
+    def reset_consumer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeRedisServer:
+    """
+    A stand-in for a Redis server on 127.0.0.1, speaking the protocol for the commands the Redis backend sends:
+    PING, AUTH, SELECT, GET, SET, DEL, HSET, HMGET, HGETALL, ZADD, ZRANGEBYSCORE, MULTI and EXEC.
+    It is enough to test and benchmark the backend without a server, use a real one for real numbers.
+    """
+
+    def __init__(self):
+        self.strings = {}
+        self.hashes = {}
+        self.sorted_sets = {}
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._connections = []
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                fake._connections.append(self.connection)
+                queued = None
+                while True:
+                    try:
+                        command = fake._read_command(self.rfile)
+                    except (OSError, ValueError):
+                        return
+                    if command is None:
+                        return
+                    fake.commands += 1
+                    name = command[0].upper()
+                    if queued is not None and name not in (b'EXEC', b'MULTI'):
+                        queued.append(command)
+                        reply = b'+QUEUED\r\n'
+                    elif name == b'MULTI':
+                        queued = []
+                        reply = b'+OK\r\n'
+                    elif name == b'EXEC':
+                        with fake._lock:
+                            replies = [fake._run(queued_command) for queued_command in queued or []]
+                        queued = None
+                        reply = b'*%d\r\n' % len(replies) + b''.join(replies)
+                    else:
+                        with fake._lock:
+                            reply = fake._run(command)
+                    self.wfile.write(reply)
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.url = f"redis://127.0.0.1:{self.port}/0"
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        """Stop the server and drop the connections of its clients."""
+        self._server.shutdown()
+        self._server.server_close()
+        for connection in self._connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        return [rfile.read(int(rfile.readline()[1:-2]) + 2)[:-2] for _ in range(int(line[1:-2]))]
+
+    def _run(self, command):
+        name, args = command[0].upper().decode(), command[1:]
+        if name in ('PING', 'AUTH', 'SELECT', 'CLIENT'):
+            return b'+OK\r\n'
+        if name == 'GET':
+            return _bulk(self.strings.get(args[0]))
+        if name == 'SET':
+            self.strings[args[0]] = args[1]
+            return b'+OK\r\n'
+        if name == 'DEL':
+            removed = sum(store.pop(key, None) is not None for key in args
+                          for store in (self.strings, self.hashes, self.sorted_sets))
+            return b':%d\r\n' % removed
+        if name == 'HSET':
+            fields = self.hashes.setdefault(args[0], {})
+            added = sum(field not in fields for field in args[1::2])
+            fields.update(zip(args[1::2], args[2::2]))
+            return b':%d\r\n' % added
+        if name == 'HDEL':
+            fields = self.hashes.get(args[0], {})
+            return b':%d\r\n' % sum(fields.pop(field, None) is not None for field in args[1:])
+        if name == 'HMGET':
+            fields = self.hashes.get(args[0], {})
+            return b'*%d\r\n' % len(args[1:]) + b''.join(_bulk(fields.get(field)) for field in args[1:])
+        if name == 'HGETALL':
+            fields = self.hashes.get(args[0], {})
+            return b'*%d\r\n' % (2 * len(fields)) + b''.join(_bulk(field) + _bulk(value)
+                                                              for field, value in fields.items())
+        if name == 'ZADD':
+            members = self.sorted_sets.setdefault(args[0], {})
+            added = sum(member not in members for member in args[2::2])
+            members.update((member, float(score)) for score, member in zip(args[1::2], args[2::2]))
+            return b':%d\r\n' % added
+        if name == 'ZREM':
+            members = self.sorted_sets.get(args[0], {})
+            return b':%d\r\n' % sum(members.pop(member, None) is not None for member in args[1:])
+        if name == 'ZREMRANGEBYRANK':
+            members = self.sorted_sets.get(args[0], {})
+            ranked = sorted((score, member) for member, score in members.items())
+            start, stop = (int(arg) + len(ranked) if int(arg) < 0 else int(arg) for arg in args[1:3])
+            removed = ranked[max(start, 0):stop + 1] if stop >= 0 else []
+            for _, member in removed:
+                del members[member]
+            return b':%d\r\n' % len(removed)
+        if name == 'ZRANGEBYSCORE':
+            low, high = args[1], args[2]
+            low_open = low.startswith(b'(')
+            low, high = float(low.lstrip(b'(')), float(high)
+            members = sorted((score, member) for member, score in self.sorted_sets.get(args[0], {}).items()
+                             if (score > low if low_open else score >= low) and score <= high)
+            if b'WITHSCORES' in (arg.upper() for arg in args[3:]):
+                return b'*%d\r\n' % (2 * len(members)) + b''.join(_bulk(member) + _bulk(b'%r' % score)
+                                                                   for score, member in members)
+            return b'*%d\r\n' % len(members) + b''.join(_bulk(member) for _, member in members)
+        return b'-ERR unknown command %s\r\n' % name.encode()
+
+
+def _bulk(value):
+    return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def sensor_payload(device_index, seq, fields=8):
+    """
+    Build a realistic nested sensor message, similar to what the lab devices publish.
+
+    :param device_index: Index of the device sending the message
+    :param seq: Sequence number, used to build an increasing timestamp
+    :param fields: Number of measurement groups in the payload
+    :return: The message as a dictionary
+    """
+    return {
+        "device_name": f"sensor-{device_index}",
+        "identifier": "",
+        "time": f"2024-01-01T00:{seq // 60000 % 60:02d}:{seq // 1000 % 60:02d}.{seq % 1000:03d}000",
+        "values": {
+            f"axis{i}": {"x": random.random(), "y": random.random(), "z": random.random()}
+            for i in range(fields)
+        },
+    }
+
+
+def make_messages(count, devices, topic='sensor_data'):
+    """
+    Generate `count` encoded messages spread round robin over `devices` devices.
+
+    :return: A list of FakeMessage
+    """
+    return [
+        FakeMessage(json.dumps(sensor_payload(i % devices, i)).encode('utf-8'), topic=topic, offset=i)
+        for i in range(count)
+    ]
+
+
+def encode_message(device_name, time, identifier="", **values):
+    """Encode a sensor message of a device as a FakeMessage of the sensor_data topic."""
+    return FakeMessage(json.dumps({
+        "device_name": device_name,
+        "identifier": identifier,
+        "time": time,
+        "values": values,
+    }).encode('utf-8'))
@@ -0,0 +1,99 @@
+import asyncio
+import gzip
+import json
+
+import uvicorn
+from flask import Flask
+
+from app.asgi import KafkaASGI
+from app.kafka_handler import KafkaStreamHandler
+
+
+def make_app(wsgi_app=None):
+    handler = KafkaStreamHandler()
+    handler.running = True
+    handler.store_latest("a", {"time": 1, "values": {"x": 1}})
+    return KafkaASGI(handler, wsgi_app=wsgi_app), handler
+
+
+async def call(app, path, query=b'', headers=()):
+    """Run one request through the app, return the status, the headers and the body."""
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': list(headers)},
+              receive, send)
+    return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def test_latest_is_the_snapshot_with_etag_and_gzip():
+    app, handler = make_app()
+
+    status, headers, body = asyncio.run(call(app, '/api/v1/kafka-stream/latest'))
+    assert status == 200 and json.loads(body) == {"a": {"time": 1, "values": {"x": 1}}}
+    assert headers[b'x-latest-version'] == str(handler.data.version).encode('ascii')
+
+    not_modified = asyncio.run(call(app, '/api/v1/kafka-stream/latest', headers=[(b'if-none-match', headers[b'etag'])]))
+    assert not_modified[0] == 304 and not_modified[2] == b''
+
+    status, headers, body = asyncio.run(call(app, '/api/v1/kafka-stream/latest',
+                                             headers=[(b'accept-encoding', b'gzip, deflate')]))
+    assert headers[b'content-encoding'] == b'gzip' and json.loads(gzip.decompress(body))["a"]["values"] == {"x": 1}
+
+    since = asyncio.run(call(app, '/api/v1/kafka-stream/latest', query=b'since=0'))
+    assert json.loads(since[2])['version'] == handler.data.version
+    assert asyncio.run(call(app, '/api/v1/kafka-stream/latest/a'))[:1] == (200,)
+    assert asyncio.run(call(app, '/api/v1/kafka-stream/latest/b'))[0] == 404
+
+
+def test_other_routes_go_to_the_wsgi_app():
+    flask_app = Flask(__name__)
+    flask_app.add_url_rule('/api/v1/kafka-stream/metrics', 'metrics', lambda: 'metrics')
+    app, _ = make_app(flask_app)
+
+    assert app.static == {'metrics'}
+    assert asyncio.run(call(app, '/api/v1/kafka-stream/metrics'))[::2] == (200, b'metrics')
+    assert asyncio.run(call(app, '/api/v1/kafka-stream/history/a'))[0] == 404
+    assert asyncio.run(call(app, '/api/v1/kafka-stream/a', query=b'encoding=xml'))[0] == 400
+    for frequency in (b'-1', b'nan', b'inf', b'0.0001'):
+        assert asyncio.run(call(app, '/api/v1/kafka-stream/a', query=b'frequency=' + frequency))[0] == 400
+
+
+def test_stream_over_http_until_the_client_disconnects():
+    app, handler = make_app()
+
+    async def scenario():
+        server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning'))
+        serving = asyncio.ensure_future(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        writer.write(b'GET /api/v1/kafka-stream/latest/a HTTP/1.1\r\nHost: test\r\n\r\n')
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.lower().split(b'content-length: ')[1].split(b'\r\n')[0])
+        assert json.loads(await reader.readexactly(length)) == {"time": 1, "values": {"x": 1}}
+
+        writer.write(b'GET /api/v1/kafka-stream/a HTTP/1.1\r\nHost: test\r\n\r\n')  # same connection
+        assert b'text/event-stream' in await reader.readuntil(b'\r\n\r\n')
+        assert b'data: {"time":1' in await reader.readuntil(b'\n\n')
+        handler.store_latest("a", {"time": 2, "values": {"x": 2}})
+        assert b'data: {"time":2' in await reader.readuntil(b'\n\n')
+        assert handler.broadcaster.subscriber_count("a") == 1
+
+        writer.close()
+        for _ in range(100):
+            if handler.broadcaster.subscriber_count("a") == 0:
+                break
+            await asyncio.sleep(0.01)
+        server.should_exit = True
+        await serving
+        return handler.broadcaster.subscriber_count("a")
+
+    assert asyncio.run(scenario()) == 0
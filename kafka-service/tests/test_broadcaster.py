@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import time
+
+import base64
+import json
+
+import msgpack
+import pytest
+
+from app.broadcaster import Broadcaster, encode_json
+
+
+def test_publish_without_subscribers_is_a_no_op():
+    broadcaster = Broadcaster()
+    broadcaster.publish("a", {"time": 1})
+    assert broadcaster.subscriber_count() == 0
+
+
+def test_subscriber_receives_initial_then_published_frames():
+    broadcaster = Broadcaster(heartbeat=5)
+    stream = broadcaster.subscribe("a", initial={"time": 1})
+
+    assert next(stream) == encode_json({"time": 1})
+    assert broadcaster.subscriber_count("a") == 1
+
+    threading.Timer(0.05, broadcaster.publish, args=("a", {"time": 2})).start()
+    assert next(stream) == encode_json({"time": 2})
+
+    stream.close()
+    assert broadcaster.subscriber_count() == 0
+
+
+def test_updates_are_coalesced_and_shared():
+    broadcaster = Broadcaster(heartbeat=5)
+    first = broadcaster.subscribe("a", initial={"time": 1})
+    second = broadcaster.subscribe("a")
+    next(first)
+    next(second)
+
+    for t in range(2, 6):
+        broadcaster.publish("a", {"time": t})
+
+    frame = next(first)
+    assert frame == encode_json({"time": 5})
+    assert next(second) is frame
+
+
+def test_heartbeat_and_close():
+    broadcaster = Broadcaster(heartbeat=0.01)
+    stream = broadcaster.subscribe("a", initial={"time": 1})
+    next(stream)
+
+    assert next(stream) == ": keep-alive\n\n"
+
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(stream))
+    reader.start()
+    broadcaster.close()
+    reader.join(timeout=1)
+
+    assert not reader.is_alive()
+    assert broadcaster.subscriber_count() == 0
+
+
+def test_rate_group_subscribers_share_one_ticker():
+    broadcaster = Broadcaster(heartbeat=5)
+    first = broadcaster.subscribe("a", initial={"time": 1}, frequency=0.05)
+    second = broadcaster.subscribe("a", frequency=0.05)
+    assert next(first) == next(second) == encode_json({"time": 1})
+    assert broadcaster.ticker_count() == 1
+
+    for t in range(2, 6):
+        broadcaster.publish("a", {"time": t})
+
+    frame = next(first)
+    assert frame == encode_json({"time": 5})
+    assert next(second) is frame
+
+    first.close()
+    second.close()
+    assert broadcaster.ticker_count() == 0
+    assert broadcaster.subscriber_count() == 0
+
+
+def test_json_frames_are_compact():
+    assert encode_json({"time": 1, "values": {"a": 1.5, "b": None}}) == \
+        'data: {"time":1,"values":{"a":1.5,"b":null}}\n\n'
+
+
+def test_msgpack_frames_are_base64():
+    broadcaster = Broadcaster(heartbeat=5)
+    stream = broadcaster.subscribe("a", initial={"time": 1, "values": {"x": 2}}, encoding='msgpack')
+
+    frame = next(stream)
+    assert frame.startswith("data: ") and frame.endswith("\n\n")
+    assert msgpack.unpackb(base64.b64decode(frame[6:-2])) == {"time": 1, "values": {"x": 2}}
+    stream.close()
+
+
+def _event(frame):
+    event, data = frame.rstrip("\n").split("\n")
+    return event[len("event: "):], json.loads(data[len("data: "):])
+
+
+def test_delta_frames_send_changed_keys_and_full_after_a_gap():
+    broadcaster = Broadcaster(heartbeat=5)
+    stream = broadcaster.subscribe("a", initial={"time": 1, "values": {"x": 1, "y": 2}}, encoding='delta')
+    assert _event(next(stream)) == ("full", {"time": 1, "values": {"x": 1, "y": 2}})
+
+    broadcaster.publish("a", {"time": 2, "values": {"x": 1, "y": 3}})
+    assert _event(next(stream)) == ("delta", {"time": 2, "values": {"y": 3}})
+
+    # the client misses an update, the next frame cannot be a delta
+    broadcaster.publish("a", {"time": 3, "values": {"x": 4, "y": 3}})
+    broadcaster.publish("a", {"time": 4, "values": {"x": 4, "y": 5}})
+    assert _event(next(stream)) == ("full", {"time": 4, "values": {"x": 4, "y": 5}})
+
+    # a removed field needs a full frame too
+    broadcaster.publish("a", {"time": 5, "values": {"x": 4}})
+    assert _event(next(stream)) == ("full", {"time": 5, "values": {"x": 4}})
+    stream.close()
+
+
+def test_frames_are_encoded_once_per_encoding():
+    broadcaster = Broadcaster(heartbeat=5)
+    streams = [broadcaster.subscribe("a", initial={"time": 1}, encoding=encoding)
+               for encoding in ('json', 'json', 'delta', 'delta')]
+    for stream in streams:
+        next(stream)
+
+    broadcaster.publish("a", {"time": 2, "values": {}})
+    frames = [next(stream) for stream in streams]
+    assert frames[0] is frames[1]
+    assert frames[2] is frames[3]
+    assert frames[2].startswith("event: full")
+
+
+def test_unknown_encoding_is_rejected():
+    with pytest.raises(ValueError):
+        next(Broadcaster().subscribe("a", encoding='xml'))
+
+
+def test_drop_oldest_keeps_the_newest_updates():
+    broadcaster = Broadcaster(heartbeat=5, queue_size=2)
+    stream = broadcaster.subscribe("a", initial={"time": 1}, overflow='drop-oldest')
+    next(stream)
+
+    for t in range(2, 6):
+        broadcaster.publish("a", {"time": t})
+
+    assert [next(stream), next(stream)] == [encode_json({"time": 4}), encode_json({"time": 5})]
+    assert broadcaster.dropped == 2
+
+
+def test_disconnect_policy_ends_the_stream_of_a_full_queue():
+    broadcaster = Broadcaster(heartbeat=5, queue_size=2)
+    slow = broadcaster.subscribe("a", initial={"time": 1}, overflow='disconnect')
+    fast = broadcaster.subscribe("a")
+    next(slow)
+    next(fast)
+
+    for t in range(2, 5):
+        broadcaster.publish("a", {"time": t})
+        assert next(fast) == encode_json({"time": t})
+
+    assert list(slow) == []
+    assert broadcaster.evicted['overflow'] == 1
+    assert broadcaster.subscriber_count("a") == 1
+
+
+def test_slow_and_idle_subscribers_are_evicted():
+    broadcaster = Broadcaster(heartbeat=0.01, slow_timeout=0.05, idle_timeout=0.05)
+    slow = broadcaster.subscribe("a", initial={"time": 1})
+    next(slow)
+    broadcaster.publish("a", {"time": 2})
+    time.sleep(0.1)
+    broadcaster.publish("a", {"time": 3})
+    assert broadcaster.evicted['slow'] == 1
+    assert broadcaster.subscriber_count() == 0
+    assert list(slow) == []
+
+    idle = broadcaster.subscribe("b", initial={"time": 1})
+    frames = list(idle)
+    assert frames[0] == encode_json({"time": 1})
+    assert set(frames[1:]) == {": keep-alive\n\n"}
+    assert broadcaster.evicted['idle'] == 1
+
+
+def test_async_subscribers_are_woken_from_the_publishing_thread():
+    broadcaster = Broadcaster(heartbeat=0.05)
+
+    async def scenario():
+        streams = [broadcaster.subscribe_async("a", initial={"time": 1}) for _ in range(3)]
+        assert [await stream.__anext__() for stream in streams] == [encode_json({"time": 1})] * 3
+        assert await streams[0].__anext__() == ": keep-alive\n\n"
+        publisher = threading.Timer(0.01, broadcaster.publish, ("a", {"time": 2}))
+        publisher.start()
+        frames = await asyncio.gather(*(stream.__anext__() for stream in streams))
+        threading.Timer(0.01, broadcaster.close).start()
+        remaining = [[frame async for frame in stream] for stream in streams]
+        return frames, remaining
+
+    frames, remaining = asyncio.run(scenario())
+
+    assert frames == [encode_json({"time": 2})] * 3
+    assert remaining == [[], [], []]
+    assert broadcaster.subscriber_count() == 0
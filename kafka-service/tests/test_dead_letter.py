@@ -0,0 +1,37 @@
+import json
+
+from app.dead_letter import DeadLetterBuffer
+
+
+def test_keeps_the_last_records():
+    buffer = DeadLetterBuffer(capacity=2)
+    for i in range(3):
+        buffer.add("sensor_data", f"bad {i}".encode(), ValueError(f"error {i}"), partition=0, offset=i)
+
+    records = buffer.records()
+    assert buffer.total == 3
+    assert [record["offset"] for record in records] == [1, 2]
+    assert records[-1]["error"] == "ValueError"
+    assert records[-1]["message"] == "error 2"
+    assert records[-1]["value"] == "bad 2"
+    assert buffer.records(limit=1) == records[-1:]
+
+
+def test_truncates_and_encodes_values():
+    buffer = DeadLetterBuffer(max_value=4)
+    assert buffer.add("t", b"\xff\xfeabcdef", ValueError())["value"] == "��ab"
+    assert buffer.add("t", {"values": {"x": 1}}, KeyError("values"))["value"] == '{"va'
+
+
+def test_spills_to_a_rotated_file(tmp_path):
+    path = tmp_path / "dead_letters.jsonl"
+    buffer = DeadLetterBuffer(spill_path=str(path), spill_bytes=300)
+    for i in range(5):
+        buffer.add("sensor_data", b"x" * 100, ValueError(), offset=i)
+    buffer.close()
+
+    # two records exceed spill_bytes, so the file is rotated every two records and one previous file is kept
+    rotated = [json.loads(line) for line in (tmp_path / "dead_letters.jsonl.1").read_text().splitlines()]
+    current = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [record["offset"] for record in rotated] == [2, 3]
+    assert [record["offset"] for record in current] == [4]
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from app.broadcaster import Broadcaster, encode_json
+from app.decimation import make_decimator, parse_decimation, parse_frequency
+
+
+def test_parse_decimation():
+    assert parse_decimation("nth:10") == ('nth', 10)
+    assert parse_decimation("last:500ms") == ('last', 0.5)
+    assert parse_decimation("envelope:1m") == ('envelope', 60)
+    assert parse_decimation("deadband:0.5") == ('deadband', 0.5)
+    for text in ("median:1s", "nth:0", "nth:x", "envelope:", "deadband:-1", "last:1ms"):
+        with pytest.raises(ValueError):
+            parse_decimation(text)
+
+
+def test_parse_frequency():
+    assert parse_frequency(None) == parse_frequency("0") == 0
+    assert parse_frequency("0.5") == 0.5
+    for value in ("-1", "nan", "inf", "x", 0.001, float("-inf")):
+        with pytest.raises(ValueError):
+            parse_frequency(value)
+
+
+def test_envelope_keeps_the_peaks_of_a_bucket():
+    decimator = make_decimator(('envelope', 1))
+    assert decimator.flush() is None
+    for x in (1, 9, -3, 1):
+        assert decimator.feed({"time": x, "values": {"x": x, "state": "on"}}) is None
+
+    assert decimator.flush() == {"time": 1, "values": {"x": 2.0, "state": "on"}, "min": {"x": -3}, "max": {"x": 9},
+                                 "samples": 4}
+    assert decimator.flush() is None
+
+
+def test_deadband_only_lets_moves_through():
+    decimator = make_decimator(('deadband', 0.5))
+    decimator.start({"values": {"x": 1.0}})
+    sent = [x for x in (1.2, 1.5, 1.6, 1.9, 2.2, 0.0) if decimator.feed({"values": {"x": x}}) is not None]
+    assert sent == [1.6, 2.2, 0.0]
+    assert decimator.feed({"values": {"x": 0.0, "y": 1}}) is not None  # a new field
+
+
+def test_decimation_groups_are_shared_per_device_and_spec():
+    broadcaster = Broadcaster(heartbeat=5, overflow='drop-oldest')
+    first = broadcaster.subscribe("a", initial={"time": 0}, decimation="nth:3")
+    second = broadcaster.subscribe("a", decimation="nth:3")
+    every = broadcaster.subscribe("a", decimation="nth:1")
+    assert next(first) == next(second) == next(every) == encode_json({"time": 0})
+    assert broadcaster.group_count() == 2 and broadcaster.ticker_count() == 0
+
+    for t in range(1, 7):
+        broadcaster.publish("a", {"time": t})
+
+    frame = next(first)
+    assert json.loads(frame[len('data: '):]) == {"time": 3}
+    assert next(second) is frame
+    assert json.loads(next(first)[len('data: '):]) == {"time": 6}
+    assert [json.loads(next(every)[len('data: '):])["time"] for _ in range(6)] == [1, 2, 3, 4, 5, 6]
+
+    with pytest.raises(ValueError):
+        next(broadcaster.subscribe("a", frequency=1, decimation="nth:3"))
+    for stream in (first, second, every):
+        stream.close()
+    assert broadcaster.group_count() == 0 and broadcaster.subscriber_count() == 0
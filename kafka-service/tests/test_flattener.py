@@ -0,0 +1,48 @@
+import pytest
+
+from app.flattener import Flattener, ShapeMismatch, compile_layout, flatten_json
+
+PAYLOAD = {"spindle": {"speed": 1200, "load": {"avg": 0.4, "peak": 0.9}}, "status": "ok", "empty": {}}
+
+
+def test_compiled_layout_matches_flatten_json():
+    layout = compile_layout(PAYLOAD)
+    assert layout(PAYLOAD) == flatten_json(PAYLOAD)
+    assert layout({"spindle": {"speed": 1, "load": {"avg": 2, "peak": 3}}, "status": "x", "empty": {}}) == {
+        "spindle_speed": 1, "spindle_load_avg": 2, "spindle_load_peak": 3, "status": "x"}
+
+
+@pytest.mark.parametrize("payload", [
+    {"spindle": {"speed": 1200, "load": {"avg": 0.4}}, "status": "ok", "empty": {}},
+    {"spindle": {"speed": 1200, "load": {"avg": 0.4, "peak": 0.9}}, "status": "ok", "empty": {}, "extra": 1},
+    {"spindle": {"speed": {"rpm": 1}, "load": {"avg": 0.4, "peak": 0.9}}, "status": "ok", "empty": {}},
+    {"spindle": 5, "status": "ok", "empty": {}},
+])
+def test_compiled_layout_rejects_other_shapes(payload):
+    with pytest.raises(ShapeMismatch):
+        compile_layout(PAYLOAD)(payload)
+
+
+def test_keys_never_reach_the_generated_source():
+    payload = {"a'] + __import__('os').getcwd() + ['": 1}
+    assert compile_layout(payload)(payload) == flatten_json(payload)
+
+
+def test_flattener_caches_and_falls_back():
+    flattener = Flattener(max_mismatches=2)
+    assert flattener.flatten("dev", PAYLOAD) == flatten_json(PAYLOAD)
+    assert flattener.flatten("dev", PAYLOAD) == flatten_json(PAYLOAD)
+    assert (flattener.hits, flattener.misses) == (1, 1)
+
+    other = {"x": {"y": 1}}
+    assert flattener.flatten("dev", other) == {"x_y": 1}
+    assert flattener.flatten("dev", PAYLOAD) == flatten_json(PAYLOAD)
+    # two shape changes: the device now always takes the general path
+    assert flattener._layouts["dev"] is None
+    assert flattener.flatten("dev", other) == {"x_y": 1}
+
+
+def test_uncached_topics_skip_the_cache():
+    flattener = Flattener(uncached_topics=["ml_result"])
+    assert flattener.flatten("model", PAYLOAD, topic="ml_result") == flatten_json(PAYLOAD)
+    assert len(flattener) == 0
@@ -0,0 +1,72 @@
+import math
+
+import pytest
+
+from app.history import HistoryStore
+
+
+def test_ring_buffer_keeps_last_samples_in_order():
+    store = HistoryStore(capacity=3, max_age=100)
+    for i in range(5):
+        store.append("a", {"x": i, "label": "text"}, timestamp=1000 + i)
+
+    times, fields = store._devices["a"].query()
+
+    assert times.tolist() == [1002, 1003, 1004]
+    assert fields["x"].tolist() == [2, 3, 4]
+    assert all(math.isnan(value) for value in fields["label"])
+
+
+def test_query_limits_to_seconds_and_serializes_missing_as_none(monkeypatch):
+    monkeypatch.setattr('app.history.time', lambda: 1010.0)
+    store = HistoryStore(capacity=10, max_age=100)
+    store.append("a", {"x": 1}, timestamp=1000)
+    store.append("a", {"x": 2, "y": 5}, timestamp=1008)
+
+    assert store.query("a", seconds=5) == {'time': [1008.0], 'values': {'x': [2.0], 'y': [5.0]}}
+    assert store.query("a")['values']['y'] == [None, 5.0]
+    assert store.query("b") is None
+
+
+def test_query_counts_seconds_from_the_newest_sample():
+    store = HistoryStore(capacity=10, max_age=100)
+    store.append("a", {"x": 1}, timestamp=1000)
+    store.append("a", {"x": 2}, timestamp=1008)
+    store.append("a", {"x": 3}, timestamp=1004)  # late
+
+    assert store.query("a", seconds=5) == {'time': [1008.0, 1004.0], 'values': {'x': [2.0, 3.0]}}
+
+
+def test_values_that_are_not_a_dictionary_are_ignored():
+    store = HistoryStore(capacity=10)
+    store.append("a", [1, 2], timestamp=1000)
+    store.append("a", None, timestamp=1001)
+
+    assert "a" not in store
+
+
+def test_memory_budget_evicts_least_recently_updated_device():
+    column = 4 * 8
+    store = HistoryStore(capacity=4, memory_budget=column * 4, eviction='lru')
+    store.append("a", {"x": 1}, timestamp=1)
+    store.append("b", {"x": 1}, timestamp=2)
+    store.append("c", {"x": 1}, timestamp=3)
+
+    assert "a" not in store and "b" in store and "c" in store
+    assert store.evicted == 1
+    assert store.nbytes <= store.memory_budget
+
+
+def test_memory_budget_rejects_new_devices():
+    column = 4 * 8
+    store = HistoryStore(capacity=4, memory_budget=column * 4, eviction='reject')
+    for i, name in enumerate("abc"):
+        store.append(name, {"x": 1}, timestamp=i)
+
+    assert len(store) == 2 and "c" not in store
+    assert store.rejected == 1
+
+
+def test_unknown_eviction_policy():
+    with pytest.raises(ValueError):
+        HistoryStore(eviction='fifo')
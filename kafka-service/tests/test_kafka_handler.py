@@ -0,0 +1,262 @@
+import time
+
+import pytest
+from confluent_kafka import TopicPartition
+
+from app.kafka_handler import (KafkaService, KafkaStreamHandler, collapse_batch, device_key, loads, parse_lookback,
+                               rewind_on_assign)
+from tests.fakes import FakeKafkaService, FakeMessage, encode_message
+
+
+def test_device_key_appends_identifier():
+    assert device_key({"device_name": "cnc", "identifier": "run1"}) == "cnc_run1"
+    assert device_key({"device_name": "cnc"}) == "cnc"
+    assert device_key({}) == ""
+    assert device_key({"device_name": 123}) == "123"
+
+
+def test_loads_accepts_nan_payloads():
+    assert loads(b'{"values": {"x": NaN}}')["values"]["x"] != 0
+
+
+def test_collapse_batch_keeps_newest_per_device():
+    batch = [
+        encode_message("a", "2024-01-01T00:00:02", x=2),
+        encode_message("a", "2024-01-01T00:00:01", x=1),
+        encode_message("b", "2024-01-01T00:00:01", x=3),
+        FakeMessage(b"not json"),
+        encode_message("", "2024-01-01T00:00:05", x=4),
+    ]
+
+    latest = collapse_batch(batch)
+
+    assert sorted(latest) == ["a", "b"]
+    assert latest["a"] == ({"device_name": "a", "identifier": "", "time": "2024-01-01T00:00:02",
+                            "values": {"x": 2}}, "sensor_data", 1704067202_000_000_000)
+
+
+def test_batch_loop_matches_single_loop():
+    messages = [encode_message(f"dev{i % 3}", f"2024-01-01T00:00:{i:02d}", v={"x": i}) for i in range(30)]
+
+    single = KafkaStreamHandler(batch_size=1)
+    single.running = True
+    single.storing_latest(FakeKafkaService(messages, single))
+
+    batched = KafkaStreamHandler(batch_size=7, linger=0)
+    batched.running = True
+    batched.storing_latest_batch(FakeKafkaService(messages, batched))
+
+    assert batched.data.snapshot() == single.data.snapshot()
+    assert batched.data["dev2"]["values"] == {"v_x": 29}
+
+
+def test_batch_loop_hands_every_message_to_the_statistics_and_decimations():
+    messages = [encode_message("a", f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}", v={"x": i}) for i in range(201)]
+    messages.insert(100, encode_message("a", "2024-01-01T00:00:00", v={"x": -1}))  # older, not stored
+    handler = KafkaStreamHandler(batch_size=500, linger=0)
+    handler.running = True
+    handler.store_latest("a", {"device_name": "a", "time": "2023-12-31T23:59:59", "values": {"v_x": -2}})
+    every = handler.broadcaster.subscribe("a", handler.data.get("a"), overflow='drop-oldest')
+    fiftieth = handler.broadcaster.subscribe("a", handler.data.get("a"), decimation="nth:50", overflow='drop-oldest')
+    next(every), next(fiftieth)
+
+    handler.storing_latest_batch(FakeKafkaService(messages, handler))
+
+    assert handler.get_stats("a")["fields"]["v_x"]["count"] == 202
+    assert len(handler.get_history("a")["time"]) == 202
+    assert next(every).endswith('"v_x":200}}\n\n')
+    assert [next(fiftieth).split('"v_x":')[1].split('}')[0] for _ in range(4)] == ['49', '99', '149', '199']
+    every.close(), fiftieth.close()
+
+
+def test_statistics_follow_the_message_time_in_both_loops():
+    messages = [encode_message("a", f"2024-01-01T00:00:{i:02d}", v={"x": i}) for i in range(50)]  # 5 tau of 10s
+    ewma = []
+    for handler in (KafkaStreamHandler(batch_size=1), KafkaStreamHandler(batch_size=100, linger=0)):
+        handler.running = True
+        loop = handler.storing_latest_batch if handler.batch_size > 1 else handler.storing_latest
+        loop(FakeKafkaService(messages, handler))
+        ewma.append(handler.get_stats("a")["fields"]["v_x"]["windows"]["10s"]["ewma"])
+
+    assert ewma[0] == pytest.approx(ewma[1])
+    assert 49 - 10 < ewma[1] < 49
+
+
+def test_history_is_stamped_with_the_message_time():
+    handler = KafkaStreamHandler()
+    handler.store_latest("a", {"device_name": "a", "time": "2024-01-01T00:00:00Z", "values": {"v_x": 1}})
+    handler.store_latest("a", {"device_name": "a", "time": "2024-01-01T00:00:10Z", "values": {"v_x": 2}})
+    handler.store_latest("a", {"device_name": "a", "time": "2024-01-01T00:00:20Z", "values": [3]})
+
+    assert handler.get_history("a") == {'time': [1704067200.0, 1704067210.0], 'values': {'v_x': [1.0, 2.0]}}
+    assert handler.data["a"]["values"] == [3]
+
+
+class FakeConsumer:
+    def __init__(self, offsets, high):
+        self.offsets = offsets
+        self.high = high
+        self.assigned = None
+
+    def offsets_for_times(self, partitions, timeout=None):
+        for p in partitions:
+            p.offset = self.offsets.get(p.topic, -1)
+        return partitions
+
+    def get_watermark_offsets(self, partition, timeout=None):
+        return 0, self.high
+
+    def assign(self, partitions):
+        self.assigned = [(p.topic, p.partition, p.offset) for p in partitions]
+
+
+def test_parse_lookback():
+    assert parse_lookback("sensor_data=300, ml_result=3600") == {"sensor_data": 300, "ml_result": 3600}
+    assert parse_lookback("60") == {"*": 60}
+    assert parse_lookback("") == {}
+
+
+def test_rewind_on_assign_seeks_to_the_lookback():
+    consumer = FakeConsumer({"sensor_data": 40, "slb_out": -1}, high=100)
+    partitions = [TopicPartition("sensor_data", 0), TopicPartition("slb_out", 0), TopicPartition("ml_result", 0)]
+
+    catchup = rewind_on_assign(consumer, partitions, {"sensor_data": 300, "slb_out": 60})
+
+    assert consumer.assigned == [("sensor_data", 0, 40), ("slb_out", 0, -1), ("ml_result", 0, -1)]
+    assert catchup == {("sensor_data", 0): 99}
+
+
+class RewoundKafkaService(FakeKafkaService):
+    """A FakeKafkaService whose messages are a catch-up up to `target`, followed by live messages."""
+
+    catching_up = KafkaService.catching_up
+    _end_catchup = KafkaService._end_catchup
+
+    def __init__(self, messages, handler, target):
+        super().__init__(messages, handler)
+        self.metrics = handler.metrics
+        self.catchup = {("sensor_data", 0): target}
+        self._catchup_started = time.monotonic()
+        self._catchup_messages = 0
+
+
+def test_catch_up_only_updates_the_store():
+    handler = KafkaStreamHandler(batch_size=5, linger=0)
+    handler.history.capacity = 0
+    published = []
+    handler.broadcaster.publish = lambda device_name, msg_json: published.append((device_name, msg_json["time"]))
+    messages = [encode_message(f"dev{i % 2}", i, x=i) for i in range(12)]
+    for offset, msg in enumerate(messages):
+        msg._offset = offset
+    service = RewoundKafkaService(messages, handler, target=9)
+    handler.running = True
+
+    batches = []
+    consume = service.batch_consume
+    service.batch_consume = lambda *args: batches.append(list(published)) or consume(*args)
+    handler.storing_latest_batch(service)
+
+    # the first two batches catch up, the newest of each device is published when the catch-up ends
+    assert batches[1] == []
+    assert sorted(batches[2]) == [("dev0", 8), ("dev1", 9)]
+    assert published[2:] == [("dev0", 10), ("dev1", 11)]
+    assert 'kafka_catchup_messages_total 10' in handler.metrics.render()
+    assert 'kafka_catchup_active 0' in handler.metrics.render()
+
+
+class BrokerError:
+    def code(self):
+        return -195  # _TRANSPORT
+
+    def __str__(self):
+        return "broker transport failure"
+
+
+class FailedMessage(FakeMessage):
+    def error(self):
+        return BrokerError()
+
+
+def test_poison_messages_are_quarantined():
+    handler = KafkaStreamHandler(batch_size=10, linger=0)
+    flatten = handler.flattener.flatten
+
+    def failing_flatten(device_name, values, topic):
+        if device_name == "bad":
+            raise RuntimeError("cannot flatten")
+        return flatten(device_name, values, topic)
+
+    handler.flattener.flatten = failing_flatten
+    service = FakeKafkaService([
+        encode_message("a", 1, x=1),
+        FakeMessage(b"not json", offset=7),
+        encode_message("bad", 1, x=1),
+        encode_message("b", 1, x=2),
+    ], handler)
+    handler.running = True
+    handler.storing_latest_batch(service)
+
+    assert sorted(handler.data.snapshot()) == ["a", "b"]
+    records = handler.dead_letters.records()
+    assert [(record["offset"], record["error"]) for record in records] == [(7, "JSONDecodeError"),
+                                                                           (None, "RuntimeError")]
+    assert '"device_name":"bad"' in records[1]["value"]
+    metrics = handler.metrics.render()
+    assert 'kafka_dead_letters_total{topic="sensor_data",reason="RuntimeError"} 1' in metrics
+    assert 'kafka_dead_letter_buffer 2' in metrics
+    assert 'kafka_consumer_resets_total 0' in metrics
+
+
+def test_broker_errors_reset_the_consumer():
+    handler = KafkaStreamHandler(batch_size=1)
+    handler.reset_backoff = 0
+    service = FakeKafkaService([FailedMessage(b""), FakeMessage(b"not json"), encode_message("a", 1, x=1)], handler)
+    handler.running = True
+    handler.storing_latest(service)
+
+    assert "a" in handler.data
+    assert handler.dead_letters.total == 1
+    assert 'kafka_consumer_resets_total 1' in handler.metrics.render()
+
+
+def test_unexpected_errors_do_not_stop_the_batch_loop():
+    handler = KafkaStreamHandler(batch_size=10, linger=0)
+    service = FakeKafkaService([encode_message("a", 1, x=1)], handler)
+    consume = service.batch_consume
+    failures = [RuntimeError("consumer closed")]
+
+    def failing_once(batch_size, timeout):
+        if failures:
+            raise failures.pop()
+        return consume(batch_size, timeout)
+
+    service.batch_consume = failing_once
+    handler.running = True
+    handler.storing_latest_batch(service)
+
+    assert handler.data["a"]["values"] == {"x": 1}
+
+
+def test_reset_backoff_doubles_up_to_the_maximum():
+    handler = KafkaStreamHandler()
+    handler.reset_backoff, handler.reset_backoff_max = 0.001, 0.003
+    handler.running = True
+    service = FakeKafkaService([], handler)
+
+    delays = [handler.reset_backoff]
+    for _ in range(3):
+        delays.append(handler._reset_consumer(service, delays[-1]))
+
+    assert delays == [0.001, 0.002, 0.003, 0.003]
+
+
+def test_evicted_devices_are_forgotten_by_the_handler():
+    handler = KafkaStreamHandler()
+    handler.running = True
+    handler.data.set_limits(max_devices=1)
+    handler.store_latest("a", {"time": 1, "values": {"x": 1}})
+    handler.store_latest("b", {"time": 1, "values": {"x": 1}})
+
+    assert "a" not in handler.data and handler.get_history("a") is None and handler.get_stats("a") is None
+    assert handler.presence.counts() == {'online': 1, 'offline': 0}
+    assert 'kafka_latest_evicted_total{store="latest",reason="count"} 1' in handler.metrics.render()
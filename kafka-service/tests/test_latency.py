@@ -0,0 +1,58 @@
+import itertools
+import json
+import time
+
+from app.kafka_handler import KafkaStreamHandler
+from app.latency import LatencyTracker, device_class
+from app.metrics import Metrics
+from tests.fakes import FakeKafkaService, FakeMessage
+
+
+def test_device_class_drops_the_trailing_number():
+    assert device_class("sensor-12") == "sensor"
+    assert device_class("camera_1") == "camera"
+    assert device_class("robot_arm") == "robot_arm"
+    assert device_class("1234") == "1234"
+
+
+def test_summary_interpolates_quantiles_and_caps_the_classes():
+    histogram = Metrics().histogram('latency_seconds', 'Latency', ('stage', 'topic', 'device_class'),
+                                    buckets=(0.1, 0.2, 0.4))
+    tracker = LatencyTracker(histogram, max_classes=1)
+    for i in range(10):
+        tracker.stored("sensor-1", {"device_name": "sensor-1", "time": 100}, "sensor_data", 100_000_000_000,
+                       polled_at=100.15, poll_perf=time.perf_counter())
+    tracker.stored("robot", {"device_name": "robot"}, "sensor_data", 0, polled_at=100, poll_perf=time.perf_counter())
+    tracker.emitted("sensor-1", 0.5)  # past the largest bound
+    tracker.emitted("unknown", 0.3)
+
+    report = tracker.report()
+    produce = report['produce']['sensor_data']['sensor']
+    assert produce['count'] == 10 and abs(produce['p50'] - 0.15) < 1e-9 and abs(produce['p90'] - 0.19) < 1e-9
+    assert 'other' not in report['produce']['sensor_data']  # the robot message has no time
+    assert report['store']['sensor_data']['other']['count'] == 1
+    assert report['emit'] == {'sensor_data': {'sensor': {'count': 1, 'mean': 0.5, 'p50': 0.4, 'p90': 0.4, 'p99': 0.4}}}
+
+
+def test_consumed_messages_are_measured_up_to_the_stream_clients():
+    messages = [FakeMessage(json.dumps({"device_name": f"sensor-{i % 2}", "time": 998 + i // 2,
+                                        "values": {"x": i}}).encode("utf-8")) for i in range(4)]
+    handler = KafkaStreamHandler(batch_size=2, linger=0)
+    handler.latency.wall_clock = itertools.count(1000).__next__  # each poll comes 2s after the messages it returns
+    handler.latency.clock = itertools.count(0, 0.5).__next__  # each poll and store takes 0.5s
+    handler.running = True
+    handler.store_latest("sensor-0", {"device_name": "sensor-0", "time": 1, "values": {"x": -1}})
+    stream = handler.broadcaster.subscribe("sensor-0", handler.data.get("sensor-0"))
+    next(stream)
+    handler.storing_latest_batch(FakeKafkaService(messages, handler))
+    next(stream)
+    stream.close()
+
+    report = handler.get_latency()
+    assert report['produce']['sensor_data']['sensor']['count'] == 4
+    assert report['produce']['sensor_data']['sensor']['mean'] == 2
+    assert report['store']['sensor_data']['sensor']['count'] == 4
+    assert report['store']['sensor_data']['sensor']['mean'] == 0.75  # 0.5s and 1s after each of the 2 polls
+    assert report['emit']['sensor_data']['sensor']['count'] == 1
+    assert 'kafka_latency_seconds_count{stage="emit",topic="sensor_data",device_class="sensor"} 1' \
+        in handler.metrics.render()
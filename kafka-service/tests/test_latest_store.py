@@ -0,0 +1,153 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from app.latest_store import LatestStore
+
+
+class YieldingMessage(dict):
+    """A message that gives up the GIL while it is compared, to widen any race window."""
+
+    def get(self, key, default=None):
+        time.sleep(0)
+        return super().get(key, default)
+
+
+@pytest.fixture
+def tight_switch_interval():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_update_is_newest_wins():
+    store = LatestStore(shards=4)
+
+    assert store.update("a", {"time": "2024-01-01T00:00:02"})
+    assert not store.update("a", {"time": "2024-01-01T00:00:01"})
+    assert store.update("a", {"time": "2024-01-01T00:00:03"})
+
+    assert store["a"]["time"] == "2024-01-01T00:00:03"
+    assert store.flag("a") == 1
+    assert "a" in store and "b" not in store
+    assert store.snapshot() == {"a": {"time": "2024-01-01T00:00:03"}}
+
+
+def test_no_lost_updates_with_eight_consumers(tight_switch_interval):
+    consumers, devices, writes = 8, 64, 2048
+    store = LatestStore(shards=8)
+    start = threading.Barrier(consumers)
+
+    def consume(worker):
+        start.wait()
+        for seq in range(writes):
+            # every worker writes increasing times to its own devices and to the shared ones
+            own = f"own-{worker}-{seq % devices}"
+            shared = f"shared-{seq % devices}"
+            store.update(own, YieldingMessage(time=f"{seq:08d}", worker=worker))
+            store.update(shared, YieldingMessage(time=f"{seq:08d}.{worker}", worker=worker))
+
+    threads = [threading.Thread(target=consume, args=(w,)) for w in range(consumers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(store) == consumers * devices + devices
+    for worker in range(consumers):
+        for device in range(devices):
+            # each own device received writes // devices increasing messages, all of them must count
+            assert store.flag(f"own-{worker}-{device}") == writes // devices - 1
+    for device in range(devices):
+        last_seq = writes - devices + device
+        assert store[f"shared-{device}"]["time"] == f"{last_seq:08d}.{consumers - 1}"
+
+
+def test_versions_are_global_and_monotonic():
+    store = LatestStore(shards=4)
+    start = store.version
+    store.update("a", {"time": "1"})
+    store.update("b", {"time": "1"})
+    store.update("a", {"time": "0"})
+
+    assert store.version == start + 2
+    assert store.device_version("a") == start + 1
+    assert store.device_version("b") == start + 2
+
+
+def test_changed_since_returns_only_newer_devices():
+    store = LatestStore(shards=4)
+    for name in "abcd":
+        store.update(name, {"time": "1"})
+    version, data = store.changed_since(0)
+    assert sorted(data) == ["a", "b", "c", "d"]
+
+    store.update("c", {"time": "2"})
+    store.update("a", {"time": "2"})
+    new_version, data = store.changed_since(version)
+
+    assert new_version == version + 2
+    assert data == {"c": {"time": "2"}, "a": {"time": "2"}}
+    assert store.changed_since(new_version) == (new_version, {})
+
+
+def test_newest_wins_across_timestamp_formats():
+    store = LatestStore()
+    store.update("a", {"time": "2024-01-01T00:00:10Z"})
+
+    assert not store.update("a", {"time": 1704067205})
+    assert store.update("a", {"time": 1704067211000})
+    assert store.event_time_ns("a") == 1704067211 * 1_000_000_000
+
+
+def test_watermark_counts_late_messages():
+    second = 1_000_000_000
+    store = LatestStore(tolerance=2 * second)
+    store.update("a", {"time": 100})
+
+    store.update("a", {"time": 99})
+    store.update("a", {"time": 100})
+    store.update("a", {"time": 97})
+
+    assert store.watermark("a") == 98 * second
+    assert (store.out_of_order, store.late, store.late_count("a")) == (1, 1, 1)
+    assert LatestStore().watermark("a") is None
+
+
+def test_eviction_by_count_and_memory_drops_the_least_recently_updated():
+    store = LatestStore(shards=4)
+    store.set_limits(max_devices=3)
+    evicted = []
+    store.on_evict = evicted.append
+    for t, device_name in enumerate(["a", "b", "c", "a", "d", "e"], start=1):
+        store.update(device_name, {"time": t, "values": {"x": t}})
+
+    assert evicted == ["b", "c"] and sorted(store) == ["a", "d", "e"]
+    assert store.evicted['count'] == 2 and "b" not in store and store.flag("a") == 1
+    assert set(store.changed_since(0)[1]) == {"a", "d", "e"}
+    store.update("b", {"time": 1, "values": {"x": 1}})  # an evicted device comes back as a new one
+    assert store.flag("b") == 0 and "a" not in store
+
+    one = store.nbytes / len(store)
+    store.set_limits(memory_budget=int(one * 1.5))
+    store.update("f", {"time": 7, "values": {"x": 7}})
+    assert sorted(store) == ["b", "f"]  # a write evicts EVICT_BATCH devices at most
+    assert store.evict() == 1 and sorted(store) == ["f"] and store.evicted['memory'] == 3 and store.nbytes == one
+
+
+def test_eviction_by_ttl_sweeps_silent_devices():
+    store = LatestStore(shards=4)
+    store.set_limits(ttl=0.05)
+    store.update("a", {"time": 1, "values": {"x": 1}})
+    store.update("b", {"time": 1, "values": {"x": 1}})
+    assert store.evict() == 0
+    time.sleep(0.06)
+    store.update("b", {"time": 2, "values": {"x": 2}})
+
+    assert sorted(store) == ["b"] and store.evicted['ttl'] == 1
+    time.sleep(0.06)
+    version = store.version
+    assert store.evict() == 1 and len(store) == 0 and store.nbytes == 0 and store.version > version
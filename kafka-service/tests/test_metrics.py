@@ -0,0 +1,64 @@
+from app.kafka_handler import KafkaStreamHandler, consumer_lag
+from app.metrics import KafkaMetrics, Metrics
+from tests.fakes import FakeKafkaService, make_messages
+
+
+def test_render_counters_gauges_and_histograms():
+    metrics = Metrics()
+    messages = metrics.counter('messages_total', 'Messages', ('topic',))
+    seconds = metrics.histogram('decode_seconds', 'Decode time', buckets=(0.1, 1))
+    metrics.callback('devices', 'Devices', lambda: 3)
+
+    messages.inc(2, ('sensor_data',))
+    messages.inc(1, ('ml_"result',))
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    seconds.observe(5)
+
+    lines = metrics.render().splitlines()
+    assert '# TYPE messages_total counter' in lines
+    assert 'messages_total{topic="sensor_data"} 2' in lines
+    assert 'messages_total{topic="ml_\\"result"} 1' in lines
+    assert 'decode_seconds_bucket{le="0.1"} 1' in lines
+    assert 'decode_seconds_bucket{le="1"} 2' in lines
+    assert 'decode_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'decode_seconds_sum 5.55' in lines
+    assert 'decode_seconds_count 3' in lines
+    assert 'devices 3' in lines
+
+
+def test_consumer_lag_skips_unknown_partitions():
+    stats = {"topics": {"sensor_data": {"partitions": {
+        "0": {"consumer_lag": 12},
+        "1": {"consumer_lag": -1},
+        "-1": {"consumer_lag": 0},
+    }}}}
+    assert consumer_lag(stats) == {("sensor_data", "0"): 12}
+
+
+def test_consumer_lag_is_merged_over_the_consumers():
+    metrics = KafkaMetrics()
+    metrics.set_consumer_lag('first', {("sensor_data", "0"): 12, ("sensor_data", "1"): 3})
+    metrics.set_consumer_lag('second', {("sensor_data", "2"): 5})
+    metrics.set_consumer_lag('second', {("sensor_data", "1"): 4, ("sensor_data", "2"): 6})  # partition 1 moved
+
+    lines = metrics.render().splitlines()
+    assert 'kafka_consumer_lag{topic="sensor_data",partition="0"} 12' in lines
+    assert 'kafka_consumer_lag{topic="sensor_data",partition="1"} 4' in lines
+    assert 'kafka_consumer_lag{topic="sensor_data",partition="2"} 6' in lines
+    metrics.drop_consumer_lag('first')
+    assert 'partition="0"' not in metrics.render()
+
+
+def test_batch_loop_reports_traffic():
+    messages = make_messages(100, devices=10)
+    handler = KafkaStreamHandler(batch_size=30, linger=0)
+    handler.running = True
+    handler.storing_latest_batch(FakeKafkaService(messages, handler))
+
+    text = handler.metrics.render()
+    assert 'kafka_messages_total{topic="sensor_data"} 100' in text
+    assert f'kafka_bytes_total{{topic="sensor_data"}} {sum(len(msg.value()) for msg in messages)}' in text
+    assert 'kafka_decode_seconds_count 4' in text
+    assert 'kafka_latest_devices{store="latest"} 10' in text
+    assert 'kafka_consumer_resets_total 0' in text
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from app.kafka_handler import KafkaStreamHandler
+from app.pipelines import Pipeline, PipelineRegistry
+from tests.fakes import FakeKafkaService, FakeMessage
+
+
+def encode(device_name, topic, time, values):
+    return FakeMessage(json.dumps({"device_name": device_name, "time": time, "values": values}).encode('utf-8'),
+                       topic=topic)
+
+
+def test_pipeline_stages_are_ordered_and_validated():
+    pipeline = Pipeline('ml_result', stages=['fanout', 'store'])
+    assert pipeline.stages == ('decode', 'store', 'fanout')
+    assert not pipeline.flatten and pipeline.fanout
+    with pytest.raises(ValueError):
+        Pipeline('ml_result', stages=['decode', 'transcode'])
+
+
+def test_filter_keeps_listed_devices_and_fields():
+    pipeline = Pipeline('sensor_data', stages=['flatten', 'filter'], devices=['cnc'], fields=['x'])
+    assert pipeline.accepts('cnc-1') and not pipeline.accepts('robot-1')
+    assert pipeline.select({'x': 1, 'y': 2}) == {'x': 1}
+
+
+def test_registry_version_changes_with_the_topics():
+    registry = PipelineRegistry.from_config('sensor_data,slb_out', '{"ml_result": {"stages": ["decode", "store"]}}')
+    assert registry.topics() == ['sensor_data', 'slb_out', 'ml_result']
+    registry.add(Pipeline('ml_result', store='ml'))
+    assert registry.version == 0 and registry.store_of('ml_result') == 'ml'
+    registry.add(Pipeline('new_topic'))
+    assert registry.remove('slb_out')
+    assert not registry.remove('slb_out')
+    assert registry.version == 2
+    assert registry.topics() == ['sensor_data', 'ml_result', 'new_topic']
+
+
+class SubscribingKafkaService(FakeKafkaService):
+    """A FakeKafkaService only returning the messages of the subscribed topics."""
+
+    def __init__(self, messages, handler, topics):
+        super().__init__(messages, handler)
+        self.subscriptions = []
+        self.topics = topics
+
+    def subscribe(self, topics):
+        self.subscriptions.append(topics)
+        self.topics = topics
+
+    def batch_consume(self, batch_size=50, timeout=1):
+        return [msg for msg in super().batch_consume(batch_size, timeout) if msg.topic() in self.topics]
+
+
+def test_batch_loop_runs_the_pipeline_of_each_topic():
+    handler = KafkaStreamHandler(batch_size=10, linger=0)
+    handler.pipelines = PipelineRegistry([
+        Pipeline('sensor_data'),
+        Pipeline('ml_result', stages=['decode', 'store'], store='ml_result'),
+    ])
+    messages = [
+        encode('cnc', 'sensor_data', 1, {'a': {'b': 1}}),
+        encode('cnc', 'ml_result', 2, {'a': {'b': 2}}),
+        encode('cnc', 'slb_out', 3, {'a': {'b': 3}}),
+    ]
+    messages.append(encode('robot', 'slb_out', 4, {'a': 4}))
+    service = SubscribingKafkaService(messages, handler, handler.pipelines.topics())
+    consume = service.batch_consume
+
+    def add_topic_after_first_poll(batch_size, timeout):
+        msgs = consume(batch_size, timeout)
+        handler.pipelines.add(Pipeline('slb_out', stages=['decode', 'filter', 'store'], devices=['robot']))
+        return msgs
+
+    service.batch_consume = add_topic_after_first_poll
+    handler.batch_size = 3
+    handler.running = True
+    handler.storing_latest_batch(service)
+
+    assert service.subscriptions == [['sensor_data', 'ml_result', 'slb_out']]
+    assert handler.data['cnc']['values'] == {'a_b': 1}
+    assert handler.data['robot']['values'] == {'a': 4}
+    assert handler.stores['ml_result']['cnc']['values'] == {'a': {'b': 2}}
+    assert handler.history.query('cnc')['values'] == {'a_b': [1.0]}
+
+
+@pytest.mark.parametrize("batch_size", [1, 10])
+def test_only_the_main_store_fans_out(batch_size):
+    handler = KafkaStreamHandler(batch_size=batch_size, linger=0)
+    handler.pipelines = PipelineRegistry([Pipeline('sensor_data'), Pipeline('ml_result', store='ml_result')])
+    messages = [
+        encode('cnc', 'sensor_data', 1, {'x': 1}),
+        encode('cnc', 'ml_result', 2, {'x': 20}),
+        encode('cnc', 'sensor_data', 3, {'x': 3}),
+        encode('cnc', 'ml_result', 4, {'x': 40}),
+    ]
+    handler.running = True
+    loop = handler.storing_latest_batch if batch_size > 1 else handler.storing_latest
+    loop(SubscribingKafkaService(messages, handler, handler.pipelines.topics()))
+
+    assert handler.pipelines.get('ml_result').stages == ('decode', 'flatten', 'store')
+    assert handler.stores['ml_result']['cnc']['values'] == {'x': 40}
+    assert handler.history.query('cnc')['values'] == {'x': [1.0, 3.0]}
+    assert handler.get_stats('cnc')['fields']['x']['max'] == 3
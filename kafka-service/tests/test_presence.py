@@ -0,0 +1,64 @@
+import itertools
+import json
+import threading
+import time
+
+from app.kafka_handler import KafkaStreamHandler
+from app.presence import PresenceIndex
+
+
+def test_stale_lists_silent_devices_least_recently_seen_first():
+    index = PresenceIndex(offline_after=30)
+    for i, device_name in enumerate(["a", "b", "c", "d"]):
+        index.touch(device_name, now=100 + i * 10)
+    index.touch("a", now=135)
+    index.check(now=161)  # b, c and d went offline
+
+    assert index.stale(28, now=161) == [["b", 110], ["c", 120], ["d", 130]]
+    assert index.stale(28, now=161, limit=2) == [["b", 110], ["c", 120]]
+    assert index.stale(45, now=161) == [["b", 110]]
+    assert index.stale(100, now=161) == []
+    assert index.counts() == {'online': 1, 'offline': 3}
+
+
+def test_check_publishes_online_and_offline_transitions():
+    index = PresenceIndex(offline_after=30)
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(itertools.islice(index.subscribe(), 3)))
+    reader.start()
+    while index.broadcaster.subscriber_count() == 0:
+        time.sleep(0.001)
+    index.touch("a", now=100)
+    index.touch("b", now=101)
+
+    assert index.check(now=102) == {'time': 102, 'online': [["a", 100], ["b", 101]], 'offline': []}
+    assert index.check(now=103) is None
+    index.touch("b", now=125)
+    assert index.check(now=131) == {'time': 131, 'online': [], 'offline': [["a", 100]]}
+    index.touch("a", now=140)
+    index.touch("c", now=141)
+    index.discard("b")
+    assert index.check(now=142) == {'time': 142, 'online': [["a", 140], ["c", 141]], 'offline': []}
+
+    reader.join(timeout=1)
+    assert [json.loads(frame[len('data: '):])['time'] for frame in received] == [102, 131, 142]
+
+
+def test_a_device_back_before_the_check_has_no_transition():
+    index = PresenceIndex(offline_after=30)
+    index.touch("a", now=100)
+    index.check(now=101)
+    index.check(now=140)
+    index.touch("a", now=141)
+    index.check(now=200)  # a came back and went silent again between two published checks
+
+    assert index.check(now=201) is None
+    assert index.stale(30, now=201) == [["a", 141]]
+
+
+def test_handler_touches_devices_it_stores():
+    handler = KafkaStreamHandler()
+    handler.store_latest("a", {"time": 1, "values": {"x": 1}})
+
+    assert handler.get_stale_devices(0)['devices'][0][0] == "a"
+    assert handler.get_stale_devices()['devices'] == []
@@ -0,0 +1,108 @@
+import time
+
+import pytest
+import redis
+
+from app.backends import open_latest_store
+from app.kafka_handler import KafkaStreamHandler
+from app.redis_store import RedisLatestStore, RedisLatestView
+from tests.fakes import FakeKafkaService, FakeRedisServer, encode_message
+
+
+@pytest.fixture
+def server():
+    server = FakeRedisServer()
+    yield server
+    server.close()
+
+
+def message(i, **values):
+    return {"time": i, "values": values}
+
+
+def test_writer_flushes_and_views_follow(server, tmp_path):
+    lock = str(tmp_path / 'writer.lock')
+    writer = open_latest_store('redis', url=server.url, prefix='test', lock_path=lock, flush_interval=60)
+    view = open_latest_store('redis', url=server.url, prefix='test', lock_path=lock)
+    assert isinstance(writer, RedisLatestStore) and isinstance(view, RedisLatestView)
+
+    for i in range(6):
+        writer.update(f"dev{i % 3}", message(i, x=i), time_ns=i)
+    assert view.sync() == []  # nothing flushed yet
+    commands = server.commands
+    assert writer.flush() == 3
+    assert server.commands - commands == 5  # MULTI, HSET, ZADD, SET, EXEC for the whole batch
+    assert view.sync() == [("dev0", message(3, x=3)), ("dev1", message(4, x=4)), ("dev2", message(5, x=5))]
+    assert view.version == writer.version
+    assert view.flag("dev1") == 1
+
+    since = view.version
+    writer.update("dev1", message(7, x=7), time_ns=7)
+    writer.flush()
+    assert view.sync() == [("dev1", message(7, x=7))]
+    assert view.changed_since(since) == (writer.version, {"dev1": message(7, x=7)})
+    writer.close()
+
+    # the next writer restores the devices from Redis
+    writer = open_latest_store('redis', url=server.url, prefix='test', lock_path=lock, flush_interval=60)
+    assert isinstance(writer, RedisLatestStore)
+    assert writer.snapshot() == view.snapshot()
+    assert writer.version >= view.version
+    writer.close()
+
+
+def test_evictions_are_removed_from_redis(server):
+    writer = RedisLatestStore(redis.Redis.from_url(server.url), 'test', flush_interval=60)
+    writer.set_limits(max_devices=2)
+    view = RedisLatestView(redis.Redis.from_url(server.url), 'test')
+    for i, device_name in enumerate(["a", "b"]):
+        writer.update(device_name, message(i, x=i), time_ns=i)
+    writer.flush()
+    view.sync()
+
+    writer.update("c", message(2, x=2), time_ns=2)
+    assert writer.flush() == 2
+    assert sorted(server.hashes[b'test:latest']) == [b'b', b'c'] and b'a' not in server.sorted_sets[b'test:changes']
+    assert view.sync() == [("c", message(2, x=2))]
+    assert view.snapshot() == writer.snapshot() and view.version == writer.version
+    writer.close()
+
+
+def test_failed_flushes_are_sent_again(server):
+    writer = RedisLatestStore(redis.Redis.from_url(server.url), 'test', flush_interval=60)
+    view = RedisLatestView(redis.Redis.from_url(server.url), 'test')
+    server.close()
+    writer.update("a", message(1), time_ns=1)
+    assert writer.flush() == 0
+    assert writer.errors == 1
+
+    replacement = FakeRedisServer()
+    for client in (writer.client, view.client):
+        client.connection_pool.connection_kwargs['port'] = replacement.port
+        client.connection_pool.reset()
+    writer.update("b", message(1), time_ns=1)
+    assert writer.flush() == 2
+    view.sync()
+    assert sorted(view.snapshot()) == ["a", "b"]
+    writer.close()
+    replacement.close()
+
+
+def test_worker_follows_the_consuming_worker_through_redis(server, tmp_path, monkeypatch):
+    monkeypatch.setenv('KAFKA_LATEST_BACKEND', 'redis')
+    monkeypatch.setenv('KAFKA_REDIS_URL', server.url)
+    monkeypatch.setenv('KAFKA_REDIS_PREFIX', f"test{time.monotonic_ns()}")
+    monkeypatch.setenv('KAFKA_REDIS_FLUSH_INTERVAL', '60')
+    consumer = KafkaStreamHandler(batch_size=10, linger=0)
+    follower = KafkaStreamHandler()
+    assert not consumer.data.read_only and follower.data.read_only
+
+    consumer.running = True
+    messages = [encode_message(f"dev{i % 2}", i, v={"x": i}) for i in range(5)]
+    consumer.storing_latest_batch(FakeKafkaService(messages, consumer))
+    consumer.data.flush()
+    follower._follow_latest_store()
+
+    assert follower.data.snapshot() == consumer.data.snapshot()
+    consumer.data.close()
+    follower.data.close()
@@ -0,0 +1,85 @@
+import math
+import random
+import statistics
+
+import pytest
+
+from app.rolling_stats import DeviceStats, RollingStats, parse_windows
+
+
+def test_parse_windows():
+    assert parse_windows('10s, 1m,5m,,2') == {'10s': 10.0, '1m': 60.0, '5m': 300.0, '2': 2.0}
+    assert parse_windows('') == {}
+    with pytest.raises(ValueError):
+        parse_windows('10 minutes')
+
+
+def test_totals_match_two_pass_statistics_and_skip_text(monkeypatch):
+    monkeypatch.setattr('app.rolling_stats.time', lambda: 1000.0)
+    rng = random.Random(1)
+    samples = [1e6 + rng.gauss(0, 1) for _ in range(500)]
+    stats = RollingStats(windows=parse_windows('10s'))
+    for i, value in enumerate(samples):
+        stats.update("a", {"x": value, "label": "text", "flag": True}, timestamp=1000.0 - 5 + i / 100)
+    stats.update("a", {"x": "n/a", "label": 3.0}, timestamp=1000.0)
+
+    fields = stats.query("a")['fields']
+
+    assert list(fields) == ["x"]
+    x = fields["x"]
+    assert x['count'] == 500
+    assert x['mean'] == pytest.approx(statistics.fmean(samples))
+    assert x['variance'] == pytest.approx(statistics.pvariance(samples), rel=1e-6)
+    assert (x['min'], x['max']) == (min(samples), max(samples))
+    assert x['windows']['10s']['count'] == 500
+    assert x['windows']['10s']['variance'] == pytest.approx(statistics.pvariance(samples), rel=1e-6)
+    assert stats.query("b") is None
+
+
+def test_windows_forget_old_buckets(monkeypatch):
+    stats = RollingStats(windows=parse_windows('10s,1m'), buckets=5)
+    for t in range(0, 60):  # from a time aligned on the buckets of both windows
+        stats.update("a", {"x": float(t), "y": 1.0 if t < 5 else None}, timestamp=12000.0 + t)
+
+    monkeypatch.setattr('app.rolling_stats.time', lambda: 12059.5)
+    fields = stats.query("a")['fields']
+
+    short = fields["x"]['windows']['10s']
+    assert 10 <= short['count'] <= 12
+    assert short['max'] == 59.0 and short['min'] == 60 - short['count']
+    assert short['mean'] == pytest.approx(statistics.fmean(range(60 - short['count'], 60)))
+    assert fields["x"]['windows']['1m']['count'] == 60
+    assert fields["y"]['count'] == 5
+    assert fields["y"]['windows']['10s'] == {'count': 0, 'mean': None, 'variance': None, 'min': None, 'max': None,
+                                             'ewma': 1.0}
+
+
+def test_ewma_follows_a_step_with_the_window_as_time_constant():
+    stats = RollingStats(windows=parse_windows('10s,1m'))
+    stats.update("a", {"x": 0.0}, timestamp=100.0)
+    stats.update("a", {"x": 1.0}, timestamp=110.0)
+
+    windows = stats.query("a")['fields']["x"]['windows']
+
+    assert windows['10s']['ewma'] == pytest.approx(1 - math.exp(-1))
+    assert windows['1m']['ewma'] == pytest.approx(1 - math.exp(-1 / 6))
+
+
+def test_memory_budget_rejects_new_devices():
+    field_bytes = DeviceStats([10.0], 2).nbytes_per_field()
+    stats = RollingStats(windows=parse_windows('10s'), buckets=2, memory_budget=field_bytes * 2)
+    stats.update("a", {"x": 1, "y": 2}, timestamp=1)
+    stats.update("b", {"x": 1}, timestamp=1)
+
+    assert "a" in stats and "b" not in stats
+    assert stats.nbytes == field_bytes * 2 and stats.rejected == 1
+    stats.discard("a")
+    assert stats.nbytes == 0 and len(stats) == 0
+
+
+def test_text_only_devices_get_no_statistics(monkeypatch):
+    stats = RollingStats(windows=parse_windows('10s'))
+    monkeypatch.setattr('app.rolling_stats.DeviceStats', None)  # allocating would raise
+    stats.update("a", {"label": "text", "flag": True, "missing": None}, timestamp=1)
+
+    assert "a" not in stats and stats.query("a") is None and stats.nbytes == 0
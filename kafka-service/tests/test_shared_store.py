@@ -0,0 +1,137 @@
+import pytest
+
+from app.kafka_handler import KafkaStreamHandler
+from app.shared_store import SharedLatestStore, SharedLatestView, open_shared_store
+from tests.fakes import FakeKafkaService, encode_message
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'latest.shm')
+
+
+def message(i, **values):
+    return {"time": i, "values": values}
+
+
+def test_first_opener_writes_and_the_others_follow(path):
+    writer = open_shared_store(path, devices=16, slot_bytes=512)
+    view = open_shared_store(path)
+    assert isinstance(writer, SharedLatestStore)
+    assert isinstance(view, SharedLatestView)
+    assert view.sync() == []
+
+    for i in range(6):
+        writer.update(f"dev{i % 3}", message(i, x=i), time_ns=i)
+    assert view.sync() == [("dev0", message(3, x=3)), ("dev1", message(4, x=4)), ("dev2", message(5, x=5))]
+    assert view.snapshot() == writer.snapshot()
+    assert view.version == writer.version
+    assert view.flag("dev2") == writer.flag("dev2") == 1
+    assert view.event_time_ns("dev1") == 4
+
+    since = view.version
+    writer.update("dev1", message(7, x=7), time_ns=7)
+    assert view.sync() == [("dev1", message(7, x=7))]
+    assert view.changed_since(since) == (writer.version, {"dev1": message(7, x=7)})
+    with pytest.raises(TypeError):
+        view.update("dev1", message(8))
+
+    view.close()
+    writer.close()
+
+
+def test_readers_scan_the_slots_when_the_ring_was_lapped(path):
+    writer = open_shared_store(path, devices=4, slot_bytes=256)
+    writer.ring_size = 4096  # the default minimum
+    view = open_shared_store(path)
+    view.sync()
+    for i in range(5000):
+        writer.update(f"dev{i % 4}", message(i, x=i), time_ns=i)
+
+    assert sorted(device_name for device_name, _ in view.sync()) == ["dev0", "dev1", "dev2", "dev3"]
+    assert view.snapshot() == writer.snapshot()
+    writer.close()
+
+
+def test_views_follow_the_evictions_of_the_writer(path):
+    writer = open_shared_store(path, devices=3, slot_bytes=256)
+    with pytest.raises(ValueError):
+        writer.set_limits(max_devices=3)
+    writer.set_limits(max_devices=2)
+    view = open_shared_store(path)
+    evicted = []
+    view.on_evict = evicted.append
+    for i, device_name in enumerate(["a", "b"]):
+        writer.update(device_name, message(i, x=i), time_ns=i)
+    view.sync()
+
+    writer.update("c", message(2, x=2), time_ns=2)  # evicts a
+    writer.update("d", message(3, x=3), time_ns=3)  # evicts b, and takes the slot of a
+    assert sorted(writer._index) == ["c", "d"] and writer._count == 3 and writer.skipped['full'] == 0
+    assert view.sync() == [("c", message(2, x=2)), ("d", message(3, x=3))]
+    assert evicted == ["a", "b"] and view.snapshot() == writer.snapshot() and view.version == writer.version
+
+    writer.set_limits(max_devices=1)
+    writer.evict()  # c is evicted and its slot left empty
+    assert view.sync() == [] and evicted == ["a", "b", "c"] and view.snapshot() == writer.snapshot()
+    with pytest.raises(TypeError):
+        view.set_limits(max_devices=1)
+    writer.close()
+
+
+def test_devices_that_do_not_fit_stay_with_the_writer(path):
+    writer = open_shared_store(path, devices=2, slot_bytes=128)
+    view = open_shared_store(path)
+    writer.update("a", message(1), time_ns=1)
+    writer.update("b", message(1, text="x" * 200), time_ns=1)
+    writer.update("c", message(1), time_ns=1)
+
+    assert writer.skipped == {'full': 1, 'oversized': 1}
+    assert "c" in writer
+    view.sync()
+    assert sorted(view.snapshot()) == ["a"]
+    writer.close()
+
+
+def test_a_new_writer_restores_the_file(path):
+    writer = open_shared_store(path, devices=8, slot_bytes=256)
+    view = open_shared_store(path)
+    writer.update("a", message(1, x=1), time_ns=1)
+    writer.update("b", message(2, x=2), time_ns=2)
+    view.sync()
+    writer.close()
+
+    writer = open_shared_store(path, devices=8, slot_bytes=256)
+    assert isinstance(writer, SharedLatestStore)
+    assert writer.snapshot() == {"a": message(1, x=1), "b": message(2, x=2)}
+    assert not writer.update("a", message(0, x=0), time_ns=0)  # newest-wins goes on from the restored messages
+    writer.update("a", message(3, x=3), time_ns=3)
+    assert view.sync() == [("a", message(3, x=3))]
+    writer.close()
+
+    # another layout replaces the file, and the readers start over from it
+    writer = open_shared_store(path, devices=16, slot_bytes=256)
+    writer.update("c", message(1), time_ns=1)
+    assert view.sync() == [("c", message(1))]
+    assert sorted(view.snapshot()) == ["c"]
+    writer.close()
+
+
+def test_worker_follows_the_consuming_worker(path, monkeypatch):
+    monkeypatch.setenv('KAFKA_SHARED_STORE', path)
+    consumer = KafkaStreamHandler(batch_size=10, linger=0)
+    follower = KafkaStreamHandler()
+    assert not consumer.data.read_only and follower.data.read_only
+    published = []
+    follower.broadcaster.publish = lambda device_name, msg_json: published.append(device_name)
+
+    consumer.running = True
+    messages = [encode_message(f"dev{i % 2}", i, v={"x": i}) for i in range(5)]
+    consumer.storing_latest_batch(FakeKafkaService(messages, consumer))
+    follower._follow_latest_store()
+
+    assert follower.data.snapshot() == consumer.data.snapshot()
+    assert follower.data["dev0"]["values"] == {"v_x": 4}
+    assert sorted(published) == ["dev0", "dev1"]
+    assert "dev1" in follower.history
+    consumer.data.close()
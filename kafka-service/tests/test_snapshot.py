@@ -0,0 +1,54 @@
+import gzip
+import json
+
+from app.latest_store import LatestStore
+from app.snapshot import SnapshotCache
+
+
+def test_snapshot_encodes_the_store():
+    store = LatestStore(shards=2)
+    store.update("a", {"time": "1", "values": {"x": 1}})
+    store.update("b", {"time": "1", "values": {"y": 2.5}})
+
+    snapshot = SnapshotCache(store, interval=0, gzip_level=1).get()
+
+    assert json.loads(snapshot.body) == store.snapshot()
+    assert gzip.decompress(snapshot.gzipped) == snapshot.body
+
+
+def test_snapshot_keys_are_strings():
+    store = LatestStore(shards=2)
+    store.update(123, {"time": "1", "values": {"x": 1}})
+
+    assert json.loads(SnapshotCache(store, interval=0).get().body) == {"123": {"time": "1", "values": {"x": 1}}}
+
+
+def test_snapshot_is_reused_until_store_changes():
+    store = LatestStore(shards=2)
+    store.update("a", {"time": "1"})
+    cache = SnapshotCache(store, interval=0)
+
+    first = cache.get()
+    assert cache.get() is first
+    assert cache.builds == 1
+
+    store.update("a", {"time": "2"})
+    second = cache.get()
+    assert second is not first and second.etag != first.etag
+    assert json.loads(second.body) == {"a": {"time": "2"}}
+
+
+def test_snapshot_rebuilds_at_most_once_per_interval():
+    store = LatestStore(shards=2)
+    store.update("a", {"time": "1"})
+    cache = SnapshotCache(store, interval=3600)
+    first = cache.get()
+
+    store.update("a", {"time": "2"})
+
+    assert cache.get() is first
+
+
+def test_gzip_can_be_disabled():
+    store = LatestStore()
+    assert SnapshotCache(store, gzip_level=0).get().gzipped is None
@@ -0,0 +1,90 @@
+from flask import Flask
+from flask_socketio import SocketIO
+
+from app.kafka_handler import KafkaStreamHandler
+from app.sockets import KafkaSocketIO
+
+
+def make_client():
+    app = Flask(__name__)
+    socketio = SocketIO(app, async_mode='threading')
+    handler = KafkaStreamHandler()
+    namespace = KafkaSocketIO('/kafka', handler, tick=3600)
+    socketio.on_namespace(namespace)
+    return socketio.test_client(app, namespace='/kafka'), namespace, handler
+
+
+def test_subscribe_acknowledges_current_data():
+    client, namespace, handler = make_client()
+    handler.store_latest("a", {"time": 1, "values": {"x": 1}})
+
+    ack = client.emit('subscribe', {"devices": ["a", "b"]}, namespace='/kafka', callback=True)
+
+    assert ack == {"a": {"time": 1, "values": {"x": 1}}, "b": None}
+    assert list(namespace.sessions.values()) == [{"a", "b"}]
+
+
+def test_malformed_subscribe_is_answered_with_an_error():
+    client, namespace, handler = make_client()
+    client.emit('subscribe', {"devices": ["a"]}, namespace='/kafka')
+
+    for data in (5, {"devices": 5}, {"devices": [["a"]]}):
+        ack = client.emit('subscribe', data, namespace='/kafka', callback=True)
+        assert ack == {'error': 'Expected {"devices": [device_name, ...]}'}
+    assert client.emit('unsubscribe', 5, namespace='/kafka', callback=True) == ack
+    assert list(namespace.groups) == [frozenset({"a"})]
+
+
+def test_push_sends_changed_subscribed_devices_once_per_tick():
+    client, namespace, handler = make_client()
+    client.emit('subscribe', {"devices": ["a", "b"]}, namespace='/kafka')
+    client.get_received('/kafka')
+
+    handler.store_latest("a", {"time": 1, "values": {"x": 1}})
+    handler.store_latest("a", {"time": 2, "values": {"x": 2}})
+    handler.store_latest("c", {"time": 1, "values": {"x": 3}})
+
+    assert namespace.push() == 1
+    received = client.get_received('/kafka')
+    assert [(event['name'], event['args']) for event in received] == [
+        ('sensor_data', [{"a": {"time": 2, "values": {"x": 2}}}])]
+
+    client.emit('unsubscribe', {"devices": ["a"]}, namespace='/kafka')
+    handler.store_latest("a", {"time": 3, "values": {"x": 3}})
+    assert namespace.push() == 0
+    assert client.get_received('/kafka') == []
+
+
+def test_disconnect_releases_subscriptions():
+    client, namespace, handler = make_client()
+    client.emit('subscribe', {"devices": ["a"]}, namespace='/kafka')
+
+    client.disconnect(namespace='/kafka')
+
+    assert namespace.sessions == {}
+    assert namespace.groups == {}
+
+
+def test_push_sends_one_event_per_socket_with_all_its_devices():
+    client, namespace, handler = make_client()
+    client.emit('subscribe', {"devices": ["a", "b"]}, namespace='/kafka')
+    other = namespace.socketio.test_client(client.app, namespace='/kafka')
+    other.emit('subscribe', {"devices": ["b"]}, namespace='/kafka')
+    other.emit('subscribe', {"devices": ["a"]}, namespace='/kafka')
+    client.get_received('/kafka')
+    other.get_received('/kafka')
+    assert len(namespace.groups) == 1
+
+    handler.store_latest("a", {"time": 1, "values": {"x": 1}})
+    handler.store_latest("b", {"time": 1, "values": {"y": 2}})
+
+    assert namespace.push() == 1
+    for socket in (client, other):
+        assert [(event['name'], event['args']) for event in socket.get_received('/kafka')] == [
+            ('sensor_data', [{"a": {"time": 1, "values": {"x": 1}}, "b": {"time": 1, "values": {"y": 2}}}])]
+
+    other.emit('unsubscribe', {"devices": ["a"]}, namespace='/kafka')
+    handler.store_latest("a", {"time": 2, "values": {"x": 2}})
+    assert namespace.push() == 1
+    assert other.get_received('/kafka') == []
+    assert len(client.get_received('/kafka')) == 1
@@ -0,0 +1,27 @@
+import pytest
+
+from app.timestamps import parse_time_ns
+
+SECOND = 1_000_000_000
+BASE = 1704067200 * SECOND  # 2024-01-01T00:00:00Z
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2024-01-01T00:00:00", BASE),
+    ("2024-01-01T00:00:00Z", BASE),
+    ("2024-01-01T02:00:00+02:00", BASE),
+    ("2024-01-01 00:00:01.5", BASE + SECOND + SECOND // 2),
+    ("2024-01-01T00:00:00.1234Z", BASE + 123_400_000),
+    (1704067200, BASE),
+    (1704067200.25, BASE + SECOND // 4),
+    (1704067200000, BASE),
+    ("1704067200000000", BASE),
+    (BASE, BASE),
+])
+def test_parse_time_ns(value, expected):
+    assert parse_time_ns(value) == expected
+
+
+@pytest.mark.parametrize("value", [None, True, "", "yesterday", float('nan'), {"t": 1}])
+def test_parse_time_ns_rejects_unusable_values(value):
+    assert parse_time_ns(value) is None
@@ -0,0 +1,63 @@
+import pytest
+
+from app import warm_start
+from app.latest_store import LatestStore
+from app.warm_start import WarmStart
+
+
+@pytest.mark.parametrize('record_format', ['msgpack', 'json'])
+def test_save_and_load_round_trip(tmp_path, record_format):
+    path = str(tmp_path / 'latest.snapshot')
+    store = LatestStore(shards=4)
+    for i in range(50):
+        store.update(f"dev{i}", {"time": i, "values": {"x": i, "label": f"run{i}"}}, time_ns=i)
+    saver = WarmStart(store, path)
+    saver.format = record_format
+    assert saver.save()
+    assert not saver.save()  # the store did not change
+
+    restored = LatestStore(shards=4)
+    assert WarmStart(restored, path).load() == 50
+    assert restored.snapshot() == store.snapshot()
+    assert restored.event_time_ns("dev7") == 7
+
+
+def test_live_messages_override_restored_entries(tmp_path):
+    path = str(tmp_path / 'latest.snapshot')
+    store = LatestStore()
+    store.update("dev", {"time": 10, "values": {"x": 1}}, time_ns=10)
+    WarmStart(store, path).save()
+
+    restarted = LatestStore()
+    restarted.update("dev", {"time": 20, "values": {"x": 2}}, time_ns=20)
+    WarmStart(restarted, path).load()
+    assert restarted["dev"]["values"] == {"x": 2}
+
+    reloaded = LatestStore()
+    WarmStart(reloaded, path).load()
+    assert reloaded.update("dev", {"time": 11, "values": {"x": 3}}, time_ns=11)
+
+
+def test_unchanged_devices_are_not_encoded_again(tmp_path, monkeypatch):
+    store = LatestStore()
+    for i in range(10):
+        store.update(f"dev{i}", {"values": {"x": i}}, time_ns=1)
+    saver = WarmStart(store, str(tmp_path / 'latest.snapshot'))
+    saver.save()
+
+    encoded = []
+    encode = warm_start._ENCODERS[saver.format]
+    monkeypatch.setitem(warm_start._ENCODERS, saver.format, lambda *record: encoded.append(record) or encode(*record))
+    store.update("dev3", {"values": {"x": 30}}, time_ns=2)
+    saver.save()
+    assert [record[0] for record in encoded] == ["dev3"]
+
+
+def test_bad_or_missing_files_leave_the_store_empty(tmp_path):
+    store = LatestStore()
+    assert WarmStart(store, str(tmp_path / 'missing')).load() == 0
+    corrupt = tmp_path / 'corrupt'
+    corrupt.write_bytes(b'something else\n')
+    assert WarmStart(store, str(corrupt)).load() == 0
+    assert WarmStart(store, '').load() == 0
+    assert len(store) == 0